@@ -0,0 +1,597 @@
+"""
+Benchmarks for the producer, indexer and blackhole.
+
+Generates a synthetic nzb tree (and a matching mock UD mount) in a work
+directory, stubs TMDB with an in-process fake, and measures:
+
+- producer: cold scan and warm restart throughput of load_nzb_data, with
+  --tmdb-offline resolving titles from an imported local TMDB dataset
+- parser: LordNzb vs the streaming parser (equivalence, time, peak memory)
+- api: p50/p99 latency and QPS of /api searches and /download under load
+- blackhole: index build and match latency against the mock mount
+
+Results are printed (or written with --output) as JSON so runs can be
+compared between releases:
+
+  python benchmark.py --nzbs 20000 --db-rows 500000 --output results.json
+"""
+import argparse
+import datetime
+import gzip
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, quote_plus
+
+import nzbparse
+import themoviedb
+
+
+WORDS = [
+  "the", "last", "night", "city", "dark", "house", "king", "river", "star", "war",
+  "love", "dead", "lost", "secret", "blue", "iron", "man", "girl", "game", "world",
+  "silent", "storm", "black", "mirror", "ghost", "winter", "summer", "empire", "hunter", "line",
+  "broken", "golden", "wild", "shadow", "fire", "ice", "crown", "road", "home", "island",
+]
+QUALITIES = ["720p", "1080p", "2160p"]
+SOURCES = ["BluRay", "WEB-DL", "WEBRip", "HDTV"]
+CODECS = ["x264", "x265", "H.264", "HEVC"]
+GROUPS = ["NTb", "FLUX", "SPARKS", "GECKOS", "RARBG", "CMRG", "NOGRP"]
+SEGMENT_BYTES = 716800
+
+NZB_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+  '<!DOCTYPE nzb PUBLIC "-//newzBin//DTD NZB 1.1//EN" "http://www.newzbin.com/DTD/nzb/nzb-1.1.dtd">\n' \
+  '<nzb xmlns="http://www.newzbin.com/DTD/2003/nzb">\n <head><meta type="category">Video</meta></head>\n'
+
+
+def percentile(sorted_values, pct):
+  if not sorted_values:
+    return None
+  index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+  return sorted_values[index]
+
+
+def latency_summary(latencies, wall):
+  latencies = sorted(latencies)
+  return {
+    "requests": len(latencies),
+    "qps": round(len(latencies) / wall, 1) if wall > 0 else None,
+    "p50_ms": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+    "p99_ms": round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+    "max_ms": round(latencies[-1] * 1000, 3) if latencies else None,
+  }
+
+
+class FakeTMDb(object):
+  """
+  Stands in for themoviedb.TMDb. Answers searches from the title alone so
+  every title resolves to the same ids on every run, and counts calls.
+  Each call takes `latency` seconds, to stand in for the network.
+  """
+
+  latency = 0
+
+  class Result(object):
+
+    def __init__(self, **kwargs):
+      self.__dict__.update(kwargs)
+
+  def __init__(self, **kwargs):
+    self.calls = 0
+    self.lock = threading.Lock()
+
+  def count(self):
+    with self.lock:
+      self.calls += 1
+    if self.latency:
+      time.sleep(self.latency)
+
+  def ids_for(self, title):
+    return sum(ord(c) * (i + 1) for i, c in enumerate(title.lower())) % 900000 + 1000
+
+  def search(self):
+    fake = self
+
+    class Search(object):
+
+      def tv(self, title):
+        fake.count()
+        return [FakeTMDb.Result(id=fake.ids_for(title))]
+
+      def movies(self, title):
+        fake.count()
+        return [FakeTMDb.Result(id=fake.ids_for(title))]
+
+    return Search()
+
+  def tv(self, tmdb_id):
+    fake = self
+
+    class Details(object):
+
+      def details(self, append_to_response=None):
+        fake.count()
+        return FakeTMDb.Result(
+          id=tmdb_id, original_name=f"Show {tmdb_id}", name=f"Show {tmdb_id}",
+          first_air_date=datetime.date(2000 + tmdb_id % 24, 1, 1),
+          external_ids=FakeTMDb.Result(imdb_id=f"tt{tmdb_id:07d}", tvdb_id=tmdb_id + 7))
+
+    return Details()
+
+  def movie(self, tmdb_id):
+    fake = self
+
+    class Details(object):
+
+      def details(self, append_to_response=None):
+        fake.count()
+        return FakeTMDb.Result(
+          id=tmdb_id, original_title=f"Movie {tmdb_id}", title=f"Movie {tmdb_id}",
+          release_date=datetime.date(1980 + tmdb_id % 44, 6, 1),
+          external_ids=FakeTMDb.Result(imdb_id=f"tt{tmdb_id:07d}"))
+
+    return Details()
+
+
+def random_title(rng, words):
+  return ".".join(w.capitalize() for w in rng.sample(WORDS, words))
+
+
+def release_tail(rng):
+  return f"{rng.choice(QUALITIES)}.{rng.choice(SOURCES)}.{rng.choice(CODECS)}-{rng.choice(GROUPS)}"
+
+
+# Returns [(relative dir, release name)] with roughly 1 movie to 3 episodes
+def release_names(count, rng):
+  releases = []
+  shows = [random_title(rng, rng.randint(1, 3)) for _ in range(max(1, count // 60))]
+  while len(releases) < count:
+    if rng.random() < 0.25:
+      title = random_title(rng, rng.randint(1, 4))
+      year = rng.randint(1970, 2024)
+      name = f"{title}.{year}.{release_tail(rng)}"
+      rel_dir = os.path.join("movies", title[0], f"{title} ({year})")
+    else:
+      show = rng.choice(shows)
+      season = rng.randint(1, 8)
+      name = f"{show}.S{season:02d}E{rng.randint(1, 24):02d}.{release_tail(rng)}"
+      rel_dir = os.path.join("shows", show, f"Season {season:02d}")
+    if rng.random() < 0.02:
+      name += "{{secret}}"
+    releases.append((rel_dir, name))
+  return releases
+
+
+def write_nzb(path, segments, rng):
+  with open(path, "w") as f:
+    f.write(NZB_HEADER)
+    per_file = max(1, segments // 2)
+    for file_no in range(0, segments, per_file):
+      f.write(f' <file poster="bench@example.com" date="1700000000" subject="&quot;part{file_no}.rar&quot; yEnc (1/{per_file})">\n')
+      f.write('  <groups><group>alt.binaries.bench</group></groups>\n  <segments>\n')
+      for number in range(file_no, min(segments, file_no + per_file)):
+        size = SEGMENT_BYTES if rng.random() < 0.95 else rng.randint(1000, SEGMENT_BYTES)
+        f.write(f'   <segment bytes="{size}" number="{number + 1}">{rng.getrandbits(64):x}@bench</segment>\n')
+      f.write('  </segments>\n </file>\n')
+    f.write('</nzb>\n')
+
+
+def generate_corpus(args, nzbs_dir):
+  rng = random.Random(args.seed)
+  started = time.perf_counter()
+  releases = release_names(args.nzbs, rng)
+  for rel_dir, name in releases:
+    os.makedirs(os.path.join(nzbs_dir, rel_dir), exist_ok=True)
+    write_nzb(os.path.join(nzbs_dir, rel_dir, name + ".nzb"), rng.randint(5, args.max_segments), rng)
+  return releases, time.perf_counter() - started
+
+
+# Mirrors the nzb tree, with a sparse file of the nzb's raw size per release
+# plus unrelated files, the way UD exposes completed downloads
+def generate_mount(args, producer, mount_dir, releases):
+  rng = random.Random(args.seed + 1)
+  started = time.perf_counter()
+  for rel_dir, name in releases:
+    nzb_path = os.path.join(producer.nzbs_root_dir, rel_dir, name + ".nzb")
+    raw_size = nzbparse.parse_nzb_metadata(nzb_path)['raw_size']
+    target_dir = os.path.join(mount_dir, rel_dir)
+    os.makedirs(target_dir, exist_ok=True)
+    file_name = nzbparse.nzb_password_regex.sub("", name)
+    with open(os.path.join(target_dir, file_name), "wb") as f:
+      f.truncate(raw_size)
+  for i in range(args.mount_extra_files):
+    target_dir = os.path.join(mount_dir, "other", f"{i % 97:02d}")
+    os.makedirs(target_dir, exist_ok=True)
+    with open(os.path.join(target_dir, f"unrelated.{i}.mkv"), "wb") as f:
+      f.truncate(rng.randint(1, 1 << 30))
+  return time.perf_counter() - started
+
+
+# Writes a local TMDB dataset for the corpus titles in the formats
+# `producer.py import-tmdb` reads, and imports it. Every tenth title is only
+# in the id exports, so its details still come from the API.
+def import_tmdb_fixture(producer, fake_tmdb, releases, work_dir):
+  fixture_dir = os.path.join(work_dir, "tmdb")
+  os.makedirs(fixture_dir, exist_ok=True)
+  titles = {}
+  for rel_dir, name in releases:
+    mtype = producer.MTYPE_SHOW if rel_dir.startswith("shows") else producer.MTYPE_MOVIE
+    parsed = producer.PTN.parse(name)
+    titles[(mtype, parsed["title"])] = parsed.get("year")
+  paths = {
+    "movie_ids": os.path.join(fixture_dir, "movie_ids.json.gz"),
+    "tv_ids": os.path.join(fixture_dir, "tv_series_ids.json.gz"),
+    "details": os.path.join(fixture_dir, "details.json.gz"),
+  }
+  with gzip.open(paths["movie_ids"], "wt") as movie_ids, gzip.open(paths["tv_ids"], "wt") as tv_ids, \
+      gzip.open(paths["details"], "wt") as details:
+    for i, ((mtype, title), year) in enumerate(sorted(titles.items(), key=lambda item: item[0])):
+      tmdb_id = fake_tmdb.ids_for(title)
+      is_show = mtype == producer.MTYPE_SHOW
+      ids_file = tv_ids if is_show else movie_ids
+      ids_file.write(json.dumps({"id": tmdb_id, "original_name" if is_show else "original_title": title,
+                                 "popularity": 1.0}) + "\n")
+      if i % 10 == 0:
+        continue
+      details.write(json.dumps({
+        "type": "tv" if is_show else "movie", "id": tmdb_id, "title": title,
+        "release_date": f"{year or 2000 + tmdb_id % 24}-01-01", "imdb_id": f"tt{tmdb_id:07d}",
+        "tvdb_id": tmdb_id + 7 if is_show else None}) + "\n")
+  started = time.perf_counter()
+  producer.import_tmdb([paths["movie_ids"]], [paths["tv_ids"]], [paths["details"]])
+  return {"titles": len(titles), "import_seconds": round(time.perf_counter() - started, 3)}
+
+
+def bench_producer(args, producer, fake_tmdb, releases):
+  results = {}
+  fake_tmdb.calls = 0
+  started = time.perf_counter()
+  producer.create_db_and_table()
+  producer.load_nzb_data()
+  wall = time.perf_counter() - started
+  results["cold_scan"] = {
+    "files": len(releases),
+    "seconds": round(wall, 3),
+    "files_per_sec": round(len(releases) / wall, 1),
+    "tmdb_calls": fake_tmdb.calls,
+    "tmdb_cache": producer.tmdb_cache.summary(),
+    "tmdb_offline": producer.offline_tmdb.summary(),
+  }
+
+  fake_tmdb.calls = 0
+  started = time.perf_counter()
+  producer.load_nzb_data()
+  wall = time.perf_counter() - started
+  results["warm_restart"] = {
+    "files": len(releases),
+    "seconds": round(wall, 3),
+    "files_per_sec": round(len(releases) / wall, 1),
+    "tmdb_calls": fake_tmdb.calls,
+  }
+
+  # A restart after a small share of the files changed
+  rng = random.Random(args.seed + 2)
+  touched = rng.sample(releases, max(1, len(releases) // 100))
+  for rel_dir, name in touched:
+    os.utime(os.path.join(producer.nzbs_root_dir, rel_dir, name + ".nzb"))
+  started = time.perf_counter()
+  producer.load_nzb_data()
+  wall = time.perf_counter() - started
+  results["restart_1pct_changed"] = {
+    "changed": len(touched),
+    "seconds": round(wall, 3),
+  }
+  return results
+
+
+# Pads the DB with rows that have no file behind them, so the API can be
+# measured against a DB much larger than the generated tree
+def pad_db(args, producer, releases):
+  if args.db_rows <= len(releases):
+    return 0
+  rng = random.Random(args.seed + 3)
+  padding = release_names(args.db_rows - len(releases), rng)
+  conn = producer.connect_db()
+  started = time.perf_counter()
+  batch = []
+  episodes = []
+
+  def flush():
+    with conn:
+      conn.executemany(producer.insert_nzb_query, batch)
+      conn.executemany(producer.insert_episodes_query, episodes)
+    batch.clear()
+    episodes.clear()
+
+  for i, (rel_dir, name) in enumerate(padding):
+    nzbo = producer.NZB()
+    nzbo.filename = f"pad{i}.{name}.nzb"
+    nzbo.path = None
+    nzbo.name = f"pad{i}.{name}"
+    nzbo.raw_size = rng.randint(1, 1 << 33)
+    parsed = name.split(".")
+    is_show = rel_dir.startswith("shows")
+    nzbo.mtype = producer.MTYPE_SHOW if is_show else producer.MTYPE_MOVIE
+    nzbo.title = " ".join(parsed[:2])
+    nzbo.year = None
+    nzbo.season = rng.randint(1, 8) if is_show else None
+    nzbo.episode = rng.randint(1, 24) if is_show else None
+    tmdb_id = rng.randint(1000, 900000)
+    nzbo.tmdb_id = tmdb_id
+    nzbo.tmdb_original_name = nzbo.tmdb_name = f"{'Show' if is_show else 'Movie'} {tmdb_id}"
+    nzbo.tmdb_release_date = "2001-01-01"
+    nzbo.tmdb_year = 2001
+    nzbo.imdb_id = f"tt{tmdb_id:07d}"
+    nzbo.tvdb_id = tmdb_id + 7 if is_show else None
+    nzbo.added_at = int(time.time()) - rng.randint(0, 5 * 365 * 24 * 3600)
+    batch.append(producer.nzb_row(nzbo))
+    if nzbo.episode is not None:
+      episodes.append((nzbo.episode, nzbo.filename, nzbo.raw_size))
+    if len(batch) >= 5000:
+      flush()
+  if batch:
+    flush()
+  with conn:
+    conn.execute(producer.bump_data_version_query)
+  conn.execute("PRAGMA optimize")
+  conn.close()
+  return round(time.perf_counter() - started, 3)
+
+
+def api_queries(args, producer):
+  conn = producer.connect_db()
+  rng = random.Random(args.seed + 4)
+  shows = conn.execute(
+    f"SELECT imdb_id, season, title FROM {producer.table_name} "
+    f"WHERE mtype = ? AND imdb_id IS NOT NULL AND path IS NOT NULL LIMIT 2000",
+    (producer.MTYPE_SHOW,)).fetchall()
+  movies = conn.execute(
+    f"SELECT imdb_id, title FROM {producer.table_name} "
+    f"WHERE mtype = ? AND imdb_id IS NOT NULL AND path IS NOT NULL LIMIT 2000",
+    (producer.MTYPE_MOVIE,)).fetchall()
+  filenames = [row[0] for row in conn.execute(
+    f"SELECT filename FROM {producer.table_name} WHERE path IS NOT NULL LIMIT 2000")]
+  conn.close()
+
+  def pick(rows, count):
+    return [rng.choice(rows) for _ in range(count)] if rows else []
+
+  n = args.api_requests
+  return {
+    "tvsearch_imdb": [f"/api?t=tvsearch&imdbid={imdb}&season={season}" for imdb, season, _ in pick(shows, n)],
+    "tvsearch_q": [f"/api?t=tvsearch&q={quote_plus(title)}" for _, _, title in pick(shows, n)],
+    "movie_imdb": [f"/api?t=movie&imdbid={imdb}" for imdb, _ in pick(movies, n)],
+    "search_q": [f"/api?t=search&cat=2000&q={quote_plus(title)}" for _, title in pick(movies, n)],
+    "search_empty": ["/api?t=search&cat=5000" for _ in range(n)],
+    "download": [f"/download/{quote(filename)}" for filename in pick(filenames, n)],
+  }
+
+
+def run_load(base, paths, concurrency):
+  import requests
+  local = threading.local()
+  errors = []
+
+  def fetch(path):
+    session = getattr(local, "session", None)
+    if session is None:
+      session = local.session = requests.Session()
+    started = time.perf_counter()
+    response = session.get(base + path)
+    elapsed = time.perf_counter() - started
+    if response.status_code != 200:
+      errors.append(response.status_code)
+    return elapsed
+
+  started = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=concurrency) as pool:
+    latencies = list(pool.map(fetch, paths))
+  summary = latency_summary(latencies, time.perf_counter() - started)
+  summary["errors"] = len(errors)
+  return summary
+
+
+def bench_api(args, main, queries):
+  from werkzeug.serving import make_server
+  server = make_server("127.0.0.1", 0, main.app, threaded=True)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  base = f"http://127.0.0.1:{server.server_port}"
+  results = {"concurrency": args.concurrency}
+  cache_size = main.response_cache.max_size
+  try:
+    for name, paths in queries.items():
+      if not paths:
+        continue
+      # Uncached numbers first; cached ones replay the same requests
+      main.response_cache.max_size = 0
+      results[name] = {"uncached": run_load(base, paths, args.concurrency)}
+      if name != "download" and cache_size > 0:
+        main.response_cache.max_size = cache_size
+        run_load(base, paths, args.concurrency)
+        results[name]["cached"] = run_load(base, paths, args.concurrency)
+  finally:
+    main.response_cache.max_size = cache_size
+    server.shutdown()
+  return results
+
+
+def bench_blackhole(args, blackhole, producer, releases):
+  rng = random.Random(args.seed + 5)
+  samples = [rng.choice(releases) for _ in range(min(args.match_samples, len(releases)))]
+  lookups = []
+  for rel_dir, name in samples:
+    raw_size = nzbparse.parse_nzb_metadata(os.path.join(producer.nzbs_root_dir, rel_dir, name + ".nzb"))['raw_size']
+    lookups.append((nzbparse.nzb_password_regex.sub("", name), raw_size))
+
+  def time_lookups(find, pairs):
+    latencies = []
+    found = 0
+    started = time.perf_counter()
+    for name, raw_size in pairs:
+      t = time.perf_counter()
+      found += find(name, raw_size) is not None
+      latencies.append(time.perf_counter() - t)
+    summary = latency_summary(latencies, time.perf_counter() - started)
+    summary["found"] = found
+    return summary
+
+  results = {}
+  index = blackhole.MountIndex(blackhole.ud_mount_path, blackhole.mount_index_workers)
+  blackhole.mount_index = index
+  started = time.perf_counter()
+  index.refresh()
+  results["index_build_seconds"] = round(time.perf_counter() - started, 3)
+  results["index_names"] = len(index.by_name)
+  started = time.perf_counter()
+  index.refresh()
+  results["index_refresh_unchanged_seconds"] = round(time.perf_counter() - started, 3)
+
+  results["index_hit"] = time_lookups(blackhole.find_in_index, lookups)
+  results["index_miss"] = time_lookups(blackhole.find_in_index, [(f"missing.{i}", 1) for i in range(len(lookups))])
+  results["producer_db"] = time_lookups(blackhole.find_via_db, lookups)
+  if args.walk_samples > 0:
+    results["mount_walk"] = time_lookups(blackhole.shared_walker.find, lookups[:args.walk_samples])
+  return results
+
+
+def bench_parser(args, producer, releases, work_dir):
+  rng = random.Random(args.seed + 6)
+  files = [os.path.join(producer.nzbs_root_dir, rel_dir, name + ".nzb")
+           for rel_dir, name in rng.sample(releases, min(args.parser_samples, len(releases)))]
+  large_dir = os.path.join(work_dir, "large")
+  os.makedirs(large_dir, exist_ok=True)
+  large = os.path.join(large_dir, "Large.Release.2020.2160p.BluRay.x265-BENCH.nzb")
+  write_nzb(large, args.large_segments, rng)
+
+  lordnzb = nzbparse.parse_nzb_metadata_lordnzb
+  parsers = {"lordnzb": lordnzb, "streaming": nzbparse.parse_nzb_metadata_streaming}
+  mismatches = sum(lordnzb(path) != nzbparse.parse_nzb_metadata_streaming(path) for path in files + [large])
+  results = {"files": len(files), "large_nzb_segments": args.large_segments, "mismatches": mismatches}
+  for name, parse in parsers.items():
+    started = time.perf_counter()
+    for path in files:
+      parse(path)
+    corpus_seconds = time.perf_counter() - started
+    tracemalloc.start()
+    started = time.perf_counter()
+    parse(large)
+    large_seconds = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    results[name] = {
+      "corpus_files_per_sec": round(len(files) / corpus_seconds, 1) if files else None,
+      "large_seconds": round(large_seconds, 3),
+      "large_peak_kib": peak // 1024,
+    }
+  return results
+
+
+# The services log to stdout at DEBUG, set when they are imported
+def quiet_logs():
+  for name in ("producer", "werkzeug"):
+    logging.getLogger(name).setLevel(logging.WARNING)
+
+
+def parse_args():
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument("--nzbs", type=int, default=5000, help="nzb files to generate")
+  parser.add_argument("--max-segments", type=int, default=60, help="max segments per generated nzb")
+  parser.add_argument("--db-rows", type=int, default=0, help="pad the DB to this many rows for the API runs")
+  parser.add_argument("--mount-extra-files", type=int, default=5000, help="unrelated files on the mock mount")
+  parser.add_argument("--api-requests", type=int, default=1000, help="requests per API scenario")
+  parser.add_argument("--concurrency", type=int, default=8, help="concurrent API clients")
+  parser.add_argument("--match-samples", type=int, default=1000, help="blackhole lookups per scenario")
+  parser.add_argument("--walk-samples", type=int, default=5, help="blackhole lookups done with a full mount walk")
+  parser.add_argument("--parser-samples", type=int, default=500, help="nzbs parsed per parser")
+  parser.add_argument("--large-segments", type=int, default=50000, help="segments in the large parser test nzb")
+  parser.add_argument("--tmdb-latency-ms", type=float, default=0, help="simulated latency of each TMDB call")
+  parser.add_argument("--tmdb-offline", action="store_true",
+                      help="import a local TMDB dataset for the corpus before the cold scan")
+  parser.add_argument("--skip", default="", help="comma-separated sections to skip: parser,api,blackhole")
+  parser.add_argument("--seed", type=int, default=1)
+  parser.add_argument("--workdir", help="directory for the corpus and DB (default: a temp dir)")
+  parser.add_argument("--keep", action="store_true", help="keep the work dir afterwards")
+  parser.add_argument("--output", help="write the JSON results here instead of stdout")
+  return parser.parse_args()
+
+
+def main():
+  args = parse_args()
+  skip = set(s.strip() for s in args.skip.split(",") if s.strip())
+  work_dir = args.workdir or tempfile.mkdtemp(prefix="ud-bench-")
+  nzbs_dir = os.path.join(work_dir, "nzbs")
+  mount_dir = os.path.join(work_dir, "mount")
+  config_dir = os.path.join(work_dir, "config")
+  for path in (nzbs_dir, mount_dir, config_dir):
+    os.makedirs(path, exist_ok=True)
+
+  # The services read their settings at import time
+  os.environ["NZBS_DIR"] = nzbs_dir
+  os.environ["BLACKHOLE_UD_MOUNT_PATH"] = mount_dir
+  os.environ["BLACKHOLE_DB_PATH"] = os.path.join(config_dir, "nzbs.db")
+  os.environ.setdefault("INDEXER_BASE_URL", "http://127.0.0.1")
+  os.environ.setdefault("TMDB_RATE_LIMIT", "0")
+  themoviedb.TMDb = FakeTMDb
+  FakeTMDb.latency = args.tmdb_latency_ms / 1000.0
+
+  import producer
+  producer.config_dir = config_dir
+  producer.db_path = os.path.join(config_dir, "nzbs.db")
+  fake_tmdb = producer.tmdb
+  quiet_logs()
+
+  results = {
+    "meta": {
+      "started": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+      "python": platform.python_version(),
+      "platform": platform.platform(),
+      "cpus": os.cpu_count(),
+      "args": vars(args),
+    }
+  }
+  try:
+    releases, seconds = generate_corpus(args, nzbs_dir)
+    results["corpus"] = {"nzbs": len(releases), "generate_seconds": round(seconds, 3)}
+    if args.tmdb_offline:
+      results["tmdb_offline"] = import_tmdb_fixture(producer, fake_tmdb, releases, work_dir)
+    results["producer"] = bench_producer(args, producer, fake_tmdb, releases)
+
+    if "parser" not in skip:
+      results["parser"] = bench_parser(args, producer, releases, work_dir)
+
+    if "api" not in skip:
+      results["corpus"]["db_pad_seconds"] = pad_db(args, producer, releases)
+      import main as indexer
+      indexer.config_dir = config_dir
+      indexer.db_path = producer.db_path
+      indexer.app.logger.setLevel(logging.WARNING)
+      results["api"] = bench_api(args, indexer, api_queries(args, producer))
+
+    if "blackhole" not in skip:
+      results["corpus"]["mount_generate_seconds"] = round(generate_mount(args, producer, mount_dir, releases), 3)
+      import blackhole
+      quiet_logs()
+      results["blackhole"] = bench_blackhole(args, blackhole, producer, releases)
+  finally:
+    if not args.keep and not args.workdir:
+      shutil.rmtree(work_dir, ignore_errors=True)
+
+  output = json.dumps(results, indent=2, default=str)
+  if args.output:
+    with open(args.output, "w") as f:
+      f.write(output + "\n")
+  else:
+    print(output)
+
+
+if __name__ == '__main__':
+  sys.exit(main())
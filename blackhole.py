@@ -1,7 +1,15 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import heapq
+import itertools
+import json
 import logging
-import LordNzb
+import metrics
+import nzbparse
 import os
-import xml.etree.ElementTree as ET
+import queue
+import sqlite3
+import threading
+from urllib.parse import quote
 from sys import stdout
 import time
 from watchdog.observers import Observer
@@ -23,6 +31,41 @@ radarr_path = os.environ.get("BLACKHOLE_RADARR_PATH")
 sonarr_path = os.environ.get("BLACKHOLE_SONARR_PATH")
 ud_mount_path = os.environ.get("BLACKHOLE_UD_MOUNT_PATH")
 
+# Index of the files on the UD mount, so matching doesn't walk the mount per nzb
+mount_index_enabled = os.environ.get("BLACKHOLE_MOUNT_INDEX", "true").lower() in ("1", "true", "yes")
+mount_index_workers = int(os.environ.get("BLACKHOLE_MOUNT_INDEX_WORKERS", "8"))
+mount_index_refresh_interval = float(os.environ.get("BLACKHOLE_MOUNT_INDEX_REFRESH_INTERVAL", "300"))
+mount_index_miss_refresh_gap = float(os.environ.get("BLACKHOLE_MOUNT_INDEX_MISS_REFRESH_GAP", "30"))
+mount_index_file = os.environ.get("BLACKHOLE_MOUNT_INDEX_FILE")
+# Re-list a directory on background refreshes only when its mtime changed.
+# FUSE mounts don't always update it when files appear, so a miss always
+# re-lists everything.
+mount_index_trust_dir_mtime = os.environ.get("BLACKHOLE_MOUNT_INDEX_TRUST_DIR_MTIME", "true").lower() in ("1", "true", "yes")
+
+# Optional direct lookup of nzbs in the producer's DB
+producer_db_path = os.environ.get("BLACKHOLE_DB_PATH")
+# Comma-separated "nzb dir prefix:mount dir prefix" rewrites, e.g. "nzbs/movies:movies"
+path_map = [tuple(mapping.split(":", 1)) for mapping in os.environ.get("BLACKHOLE_PATH_MAP", "").split(",") if ":" in mapping]
+
+# NZB processing queue
+worker_count = int(os.environ.get("BLACKHOLE_WORKERS", "4"))
+queue_size = int(os.environ.get("BLACKHOLE_QUEUE_SIZE", "1000"))
+retry_attempts = int(os.environ.get("BLACKHOLE_RETRY_ATTEMPTS", "6"))
+retry_base_delay = float(os.environ.get("BLACKHOLE_RETRY_BASE_DELAY", "30"))
+retry_max_delay = float(os.environ.get("BLACKHOLE_RETRY_MAX_DELAY", "1800"))
+
+# Port of the /metrics listener, 0 to disable
+metrics_port = int(os.environ.get("BLACKHOLE_METRICS_PORT", "7992"))
+
+metrics_registry = metrics.Registry()
+match_seconds = metrics_registry.histogram(
+  "blackhole_match_seconds", "Time to find the mount file for an nzb", ("method", "result"))
+parse_seconds = metrics_registry.histogram("blackhole_parse_seconds", "Time to parse one nzb")
+nzbs_processed = metrics_registry.counter(
+  "blackhole_nzbs_total", "Processed nzbs by outcome", ("result",))
+mount_index_refresh_seconds = metrics_registry.histogram(
+  "blackhole_mount_index_refresh_seconds", "Time to refresh the mount index")
+
 
 def getPath(isRadarr, create=False):
   absoluteBaseWatchPath = base_watch_path if os.path.isabs(base_watch_path) else os.path.abspath(base_watch_path)
@@ -37,92 +80,493 @@ def getPath(isRadarr, create=False):
   return finalPath
 
 
+class MountIndex(object):
+  """
+  Maps file names on the UD mount to their (path, size) pairs.
+
+  The index keeps every directory's listing together with the directory's
+  mtime. A refresh crawls the tree in parallel and, unless it is a full
+  one, only re-lists directories whose mtime changed, so keeping it current
+  costs one stat per directory instead of a full listing. The listings can
+  be persisted to disk so a restart starts from a warm index.
+  """
+
+  def __init__(self, root, workers, index_file=None):
+    self.root = root
+    self.workers = workers
+    self.index_file = index_file
+    # dir path -> (mtime_ns, {file name: size}, [subdir paths])
+    self.dirs = {}
+    self.by_name = {}
+    self.last_refresh = 0
+    # When every directory was last re-listed, whatever its mtime
+    self.last_full_refresh = 0
+    self.lock = threading.Lock()
+    self.refresh_lock = threading.Lock()
+
+  def scan_dir(self, path, previous):
+    mtime_ns = os.stat(path).st_mtime_ns
+    if previous is not None and previous[0] == mtime_ns:
+      return previous
+    files = {}
+    subdirs = []
+    with os.scandir(path) as entries:
+      for entry in entries:
+        try:
+          if entry.is_dir():
+            # Like os.walk, don't descend into symlinked directories
+            if not entry.is_symlink():
+              subdirs.append(entry.path)
+          else:
+            files[entry.name] = entry.stat().st_size
+        except OSError as e:
+          logger.debug(f"Skipping {entry.path}: {e}")
+    return (mtime_ns, files, subdirs)
+
+  # With old_dirs empty every directory is listed again
+  def crawl(self, old_dirs):
+    dirs = {}
+    with ThreadPoolExecutor(max_workers=self.workers) as pool:
+      pending = {pool.submit(self.scan_dir, self.root, old_dirs.get(self.root)): self.root}
+      while pending:
+        future = next(iter(pending))
+        path = pending.pop(future)
+        try:
+          listing = future.result()
+        except OSError as e:
+          logger.error(f"Error listing {path}: {e}")
+          continue
+        dirs[path] = listing
+        for subdir in listing[2]:
+          pending[pool.submit(self.scan_dir, subdir, old_dirs.get(subdir))] = subdir
+    return dirs
+
+  def refresh(self, full=False):
+    with self.refresh_lock:
+      self.crawl_and_swap(full)
+
+  # Called with refresh_lock held
+  def crawl_and_swap(self, full):
+    started = time.monotonic()
+    full = full or not mount_index_trust_dir_mtime
+    dirs = self.crawl({} if full else self.dirs)
+    by_name = {}
+    for dir_path, (_, files, _) in dirs.items():
+      for name, size in files.items():
+        by_name.setdefault(name, []).append((os.path.join(dir_path, name), size))
+    with self.lock:
+      self.dirs = dirs
+      self.by_name = by_name
+      self.last_refresh = time.monotonic()
+      if full:
+        self.last_full_refresh = self.last_refresh
+    mount_index_refresh_seconds.observe(time.monotonic() - started)
+    logger.info(f"Mount index {'fully ' if full else ''}refreshed: {len(by_name)} names in "
+                f"{len(dirs)} directories in {time.monotonic() - started:.1f}s")
+    self.save()
+
+  def refresh_on_miss(self):
+    """
+    Fully refreshes unless that happened recently; returns whether the
+    index has been fully refreshed since the miss, which makes a second
+    lookup worthwhile. Every directory is re-listed, since the missing file
+    may be in one whose mtime did not change.
+    """
+    missed_at = time.monotonic()
+    if missed_at - self.last_full_refresh < mount_index_miss_refresh_gap:
+      return False
+    with self.refresh_lock:
+      # Checked again under the lock: misses that queued up behind a
+      # refresh look again in its result rather than each crawling the
+      # mount once more
+      if self.last_full_refresh >= missed_at:
+        return True
+      if time.monotonic() - self.last_full_refresh < mount_index_miss_refresh_gap:
+        return False
+      self.crawl_and_swap(full=True)
+      return True
+
+  def lookup(self, name):
+    with self.lock:
+      return list(self.by_name.get(name, ()))
+
+  def load(self):
+    if not self.index_file or not os.path.exists(self.index_file):
+      return
+    try:
+      with open(self.index_file) as f:
+        data = json.load(f)
+      if data.get("root") != self.root:
+        logger.info("Persisted mount index is for a different mount, ignoring it")
+        return
+      self.dirs = {path: (mtime_ns, files, subdirs) for path, (mtime_ns, files, subdirs) in data["dirs"].items()}
+      self.by_name = {}
+      for dir_path, (_, files, _) in self.dirs.items():
+        for name, size in files.items():
+          self.by_name.setdefault(name, []).append((os.path.join(dir_path, name), size))
+      logger.info(f"Loaded mount index with {len(self.by_name)} names from {self.index_file}")
+    except (OSError, ValueError, KeyError) as e:
+      logger.error(f"Error loading mount index: {e}")
+
+  def save(self):
+    if not self.index_file:
+      return
+    tmp_file = f"{self.index_file}.tmp"
+    # A refresh replaces self.dirs rather than changing it, so the dict can
+    # be written out without holding the lock lookups need
+    with self.lock:
+      data = {"root": self.root, "dirs": self.dirs}
+    try:
+      with open(tmp_file, "w") as f:
+        json.dump(data, f)
+      os.replace(tmp_file, self.index_file)
+    except OSError as e:
+      logger.error(f"Error saving mount index: {e}")
+
+  def run_refresher(self):
+    while True:
+      time.sleep(mount_index_refresh_interval)
+      try:
+        self.refresh()
+      except Exception:
+        logger.exception("Mount index refresh failed")
+
+
+mount_index = MountIndex(ud_mount_path, mount_index_workers, mount_index_file) if mount_index_enabled else None
+
+
+db_local = threading.local()
+
+
+def producer_db():
+  conn = getattr(db_local, 'conn', None)
+  if conn is None:
+    conn = db_local.conn = sqlite3.connect(f"file:{quote(producer_db_path)}?mode=ro", uri=True)
+  return conn
+
+
+# Maps a path relative to NZBS_DIR to where UD exposes the file for that nzb
+def mount_path_for(nzb_rel_path, file_name):
+  rel_dir = os.path.normpath(os.path.dirname(nzb_rel_path))
+  for nzb_prefix, mount_prefix in path_map:
+    nzb_prefix = os.path.normpath(nzb_prefix)
+    if rel_dir == nzb_prefix or rel_dir.startswith(nzb_prefix + os.sep):
+      rel_dir = os.path.normpath(mount_prefix + rel_dir[len(nzb_prefix):])
+      break
+  return os.path.normpath(os.path.join(ud_mount_path, rel_dir, file_name))
+
+
+# Resolves the file through the path the producer recorded, with one stat per candidate
+def find_via_db(file_to_search, file_raw_size):
+  try:
+    rows = producer_db().execute(
+      "SELECT path FROM nzbs WHERE name = ? AND raw_size = ? AND path IS NOT NULL",
+      (file_to_search, file_raw_size)).fetchall()
+  except sqlite3.Error as e:
+    logger.error(f"Error looking up {file_to_search} in producer DB: {e}")
+    return None
+  for (nzb_rel_path,) in rows:
+    full_path = mount_path_for(nzb_rel_path, file_to_search)
+    try:
+      file_size = os.stat(full_path).st_size
+    except OSError:
+      logger.debug(f"Expected file missing on mount: {full_path}")
+      continue
+    if size_matches(file_size, file_raw_size):
+      logger.debug("Matching file found via producer DB %s", full_path)
+      return full_path
+    logger.debug("File size mismatch %s", full_path)
+  return None
+
+
+def size_matches(file_size, raw_size):
+  # Check file size for up to 3% tolerance
+  tolerance = raw_size * 0.03
+  return abs(file_size - raw_size) <= tolerance
+
+
+def find_in_index(file_to_search, file_raw_size):
+  for full_path, file_size in mount_index.lookup(file_to_search):
+    if size_matches(file_size, file_raw_size) and os.path.exists(full_path):
+      logger.debug("Matching file found %s", full_path)
+      return full_path
+    logger.debug("File size mismatch or gone %s", full_path)
+  return None
+
+
+class SharedWalker(object):
+  """
+  Resolves many nzbs with a single walk of the mount when the index is
+  disabled. Lookups queue up while a walk is running and are all resolved
+  by the next one, so concurrent nzbs share a traversal.
+  """
+
+  def __init__(self):
+    # file name -> [(raw size, Future)]
+    self.waiting = {}
+    self.cond = threading.Condition()
+    self.thread = None
+
+  def find(self, file_to_search, file_raw_size):
+    result = Future()
+    with self.cond:
+      self.waiting.setdefault(file_to_search, []).append((file_raw_size, result))
+      if self.thread is None:
+        self.thread = threading.Thread(target=self.run, name="mount-walker", daemon=True)
+        self.thread.start()
+      self.cond.notify()
+    return result.result()
+
+  def run(self):
+    while True:
+      with self.cond:
+        while not self.waiting:
+          self.cond.wait()
+        batch = self.waiting
+        self.waiting = {}
+      try:
+        self.walk(batch)
+      except Exception as e:
+        logger.exception("Mount walk failed")
+        for requests in batch.values():
+          for _, result in requests:
+            if not result.done():
+              result.set_exception(e)
+
+  def walk(self, batch):
+    logger.debug(f"Walking mount for {len(batch)} names")
+    for root, _, files in os.walk(ud_mount_path):
+      for file in files:
+        requests = batch.get(file)
+        if not requests:
+          continue
+        full_path = os.path.join(root, file)
+        logger.debug("Checking file for size %s", full_path)
+        file_size = os.path.getsize(full_path)
+        for request in list(requests):
+          if size_matches(file_size, request[0]):
+            logger.debug("Matching file found %s", full_path)
+            request[1].set_result(full_path)
+            requests.remove(request)
+        if not requests:
+          del batch[file]
+      if not batch:
+        return
+    for requests in batch.values():
+      for _, result in requests:
+        result.set_result(None)
+
+
+shared_walker = SharedWalker()
+
+
+# Runs one lookup method and records how long it took
+def timed_match(method, find, file_to_search, file_raw_size):
+  started = time.perf_counter()
+  found_file = find(file_to_search, file_raw_size)
+  match_seconds.observe(time.perf_counter() - started, method=method,
+                        result="found" if found_file is not None else "missing")
+  return found_file
+
+
+def find_matching_file(file_to_search, file_raw_size):
+  if producer_db_path:
+    found_file = timed_match("db", find_via_db, file_to_search, file_raw_size)
+    if found_file is not None:
+      return found_file
+  if mount_index is None:
+    return timed_match("walk", shared_walker.find, file_to_search, file_raw_size)
+  found_file = timed_match("index", find_in_index, file_to_search, file_raw_size)
+  if found_file is None and mount_index.refresh_on_miss():
+    found_file = timed_match("index", find_in_index, file_to_search, file_raw_size)
+  return found_file
+
+
+class NzbJob(object):
+
+  def __init__(self, filepath, is_radarr):
+    # filepath is an absolute path
+    self.filepath = filepath
+    self.is_radarr = is_radarr
+    self.processing_file = None
+    self.name = None
+    self.raw_size = None
+    self.attempts = 0
+
+
+class NzbProcessor(object):
+  """
+  Processes nzbs on a pool of worker threads fed by a bounded queue, so a
+  slow match never holds up the watchdog observer. NZBs whose file is not
+  on the mount yet stay in `processing` and are retried with exponential
+  backoff.
+  """
+
+  def __init__(self, workers, max_queued):
+    self.workers = workers
+    self.queue = queue.Queue(maxsize=max_queued)
+    # Source paths that are queued but not yet moved to processing
+    self.pending_paths = set()
+    self.lock = threading.Lock()
+    self.retries = []
+    self.retry_seq = itertools.count()
+    self.retry_cond = threading.Condition()
+
+  def start(self):
+    for i in range(self.workers):
+      threading.Thread(target=self.run_worker, name=f"nzb-worker-{i}", daemon=True).start()
+    threading.Thread(target=self.run_retries, name="nzb-retries", daemon=True).start()
+
+  def submit(self, filepath, is_radarr):
+    with self.lock:
+      if filepath in self.pending_paths:
+        logger.debug(f"NZB already queued: {filepath}")
+        return
+      self.pending_paths.add(filepath)
+    self.queue.put(NzbJob(filepath, is_radarr))
+
+  # Picks up nzbs a previous run left in processing
+  def resume_processing(self, is_radarr):
+    processing_path = os.path.join(getPath(is_radarr), 'processing')
+    for file_name in sorted(os.listdir(processing_path)):
+      if file_name.endswith('.nzb'):
+        job = NzbJob(None, is_radarr)
+        job.processing_file = os.path.join(processing_path, file_name)
+        logger.info(f"Resuming NZB left in processing: {job.processing_file}")
+        self.queue.put(job)
+
+  def run_worker(self):
+    while True:
+      job = self.queue.get()
+      try:
+        self.process(job)
+      except Exception:
+        nzbs_processed.inc(result="error")
+        logger.exception(f"Error processing NZB {job.processing_file or job.filepath}")
+
+  def process(self, job):
+    if job.processing_file is None:
+      try:
+        if not start_processing(job):
+          return
+      finally:
+        with self.lock:
+          self.pending_paths.discard(job.filepath)
+    elif job.name is None:
+      nzb_metadata = parse_nzb_metadata(job.processing_file)
+      job.name = nzb_metadata['name']
+      job.raw_size = nzb_metadata['raw_size']
+
+    # Search for matching file in ud_mount_path
+    found_file = find_matching_file(job.name, job.raw_size)
+    if found_file:
+      link_completed(job, found_file)
+      nzbs_processed.inc(result="linked")
+    elif job.attempts < retry_attempts:
+      job.attempts += 1
+      delay = min(retry_base_delay * 2 ** (job.attempts - 1), retry_max_delay)
+      logger.info(f"File not found yet: {job.name}, retry {job.attempts}/{retry_attempts} in {delay:.0f}s")
+      nzbs_processed.inc(result="retry")
+      self.schedule_retry(job, delay)
+      return
+    else:
+      logger.info(f"File not found: {job.name}")
+      nzbs_processed.inc(result="not_found")
+
+    # Delete file from processing (assuming processing is done)
+    try:
+      os.remove(job.processing_file)
+      logger.debug(f"NZB deleted from processing: {job.processing_file}")
+    except OSError as e:
+      logger.debug(f"Error deleting NZB from processing: {e}")
+
+  def schedule_retry(self, job, delay):
+    with self.retry_cond:
+      heapq.heappush(self.retries, (time.monotonic() + delay, next(self.retry_seq), job))
+      self.retry_cond.notify()
+
+  def run_retries(self):
+    while True:
+      with self.retry_cond:
+        while not self.retries or self.retries[0][0] > time.monotonic():
+          timeout = self.retries[0][0] - time.monotonic() if self.retries else None
+          self.retry_cond.wait(timeout)
+        _, _, job = heapq.heappop(self.retries)
+      self.queue.put(job)
+
+
 class ArrEventHandler(FileSystemEventHandler):
 
-  def __init__(self, is_radarr):
+  def __init__(self, is_radarr, processor):
     super().__init__()
     self.is_radarr = is_radarr
+    self.processor = processor
     self.path_name = getPath(is_radarr, create=True)
 
   def on_created(self, event):
-    if not event.is_directory and not event.src_path.endswith('.nzb'):
+    if event.is_directory or not event.src_path.endswith('.nzb'):
       return
-    logger.info(f"File '{event.src_path}' created, processing...!")
-    process_single_nzb(event.src_path, self.is_radarr)
+    logger.info(f"File '{event.src_path}' created, queueing...!")
+    self.processor.submit(event.src_path, self.is_radarr)
 
 
-def process_single_nzb(filepath, is_radarr):
-  # filepath is an absolute path
-  arr_path = getPath(is_radarr)
-  processing_path = os.path.join(arr_path, 'processing')
-  completed_path = os.path.join(arr_path, 'completed')
+# Parses the nzb and moves it to processing; returns False if it can't be processed
+def start_processing(job):
+  processing_path = os.path.join(getPath(job.is_radarr), 'processing')
 
-  nzb_metadata = parse_nzb_metadata(filepath)
-  file_to_search = nzb_metadata['name']
-  file_raw_size = nzb_metadata['raw_size']
+  nzb_metadata = parse_nzb_metadata(job.filepath)
+  job.name = nzb_metadata['name']
+  job.raw_size = nzb_metadata['raw_size']
 
   # Move file to processing directory
-  processing_file = os.path.join(processing_path, os.path.basename(filepath))
+  processing_file = os.path.join(processing_path, os.path.basename(job.filepath))
   try:
-    os.rename(filepath, processing_file)
+    os.rename(job.filepath, processing_file)
     logger.debug(f"NZB moved to processing: {processing_file}")
   except OSError as e:
     logger.error(f"Error moving NZB: {e}")
-    return
+    return False
+  job.processing_file = processing_file
+  return True
 
-  # Search for matching file in ud_mount_path
-  found_file = None
-  for root, _, files in os.walk(ud_mount_path):
-    for file in files:
-      if file == file_to_search:
-        full_path = os.path.join(root, file)
-        logger.debug("Checking file for size %s", full_path)
-        # Check file size for up to 3% tolerance
-        file_size = os.path.getsize(full_path)
-        tolerance = file_raw_size * 0.03
-        if abs(file_size - file_raw_size) <= tolerance:
-          logger.debug("Matching file found %s", full_path)
-          found_file = full_path
-          break
-        else:
-          logger.debug("File size mismatch %s", full_path)
-    if found_file:
-      break
 
-  if found_file:
-    # Create symlink from `completed` to found file
-    # Delete nzb from processing
-    symlink_path = os.path.join(completed_path, file_to_search)
-    # Delete existing symlink if it exists
-    if os.path.exists(symlink_path):
-      os.remove(symlink_path)
-    logger.debug("Creating symlink [%s] -> [%s]", symlink_path, found_file)
-    os.symlink(found_file, symlink_path)
-    logger.info(f"Symlink created: {symlink_path}")
-  else:
-    logger.info(f"File not found: {file_to_search}")
-
-  # Delete file from processing (assuming processing is done)
-  try:
-    os.remove(processing_file)
-    logger.debug(f"NZB deleted from processing: {processing_file}")
-  except OSError as e:
-    logger.debug(f"Error deleting NZB from processing: {e}")
+def link_completed(job, found_file):
+  # Create symlink from `completed` to found file
+  completed_path = os.path.join(getPath(job.is_radarr), 'completed')
+  symlink_path = os.path.join(completed_path, job.name)
+  # Delete existing symlink if it exists
+  if os.path.lexists(symlink_path):
+    os.remove(symlink_path)
+  logger.debug("Creating symlink [%s] -> [%s]", symlink_path, found_file)
+  os.symlink(found_file, symlink_path)
+  logger.info(f"Symlink created: {symlink_path}")
 
 
-# Function to parse metadata from nzb (replace with your XML parsing logic)
 def parse_nzb_metadata(filepath):
-  m = LordNzb.parser(filepath)
-  return {
-    'filename': m.filename,
-    'name': m.name,
-    'raw_size': m.raw_size
-  }
+  with parse_seconds.time():
+    return nzbparse.parse_nzb_metadata(filepath)
 
 
 if __name__ == '__main__':
-  radarr_handler = ArrEventHandler(is_radarr=True)
-  sonarr_handler = ArrEventHandler(is_radarr=False)
+  if mount_index is not None:
+    mount_index.load()
+    mount_index.refresh()
+    threading.Thread(target=mount_index.run_refresher, name="mount-index", daemon=True).start()
+
+  processor = NzbProcessor(worker_count, queue_size)
+  metrics_registry.gauge("blackhole_queue_depth", "Nzbs waiting for a worker", collect=processor.queue.qsize)
+  metrics_registry.gauge("blackhole_retries_pending", "Nzbs waiting to be retried",
+                         collect=lambda: len(processor.retries))
+  if mount_index is not None:
+    metrics_registry.gauge("blackhole_mount_index_names", "File names in the mount index",
+                           collect=lambda: len(mount_index.by_name))
+  if metrics.serve(metrics_registry, metrics_port):
+    logger.info(f"Serving metrics on port {metrics_port}")
+  radarr_handler = ArrEventHandler(is_radarr=True, processor=processor)
+  sonarr_handler = ArrEventHandler(is_radarr=False, processor=processor)
+  processor.start()
+  processor.resume_processing(is_radarr=True)
+  processor.resume_processing(is_radarr=False)
 
   radarr_observer = Observer()
   sonarr_observer = Observer()
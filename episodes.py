@@ -0,0 +1,15 @@
+"""
+Episode numbers of a release, shared by the producer, which stores them in
+nzb_episodes, and the indexer, which matches the snapshot's rows against ep.
+"""
+import re
+
+
+episode_number_regex = re.compile(r"\d+")
+
+
+def episode_numbers(episode):
+  # Episodes are stored as "5", or "E01E02" for multi-episode releases
+  if episode is None:
+    return []
+  return [int(number) for number in episode_number_regex.findall(str(episode))]
@@ -0,0 +1,33 @@
+# Gunicorn settings for ud-indexer, tunable from the environment.
+#
+# gthread workers serve requests from a thread pool, so a slow /download
+# or a long search no longer holds up every other request. Each worker
+# process keeps its own SQLite connection pool (see ConnectionPool in
+# main.py), and pooled connections are only ever used by one thread at a
+# time, so they are safe with any worker/thread count.
+import os
+
+
+bind = os.environ.get('INDEXER_BIND', '0.0.0.0:7990')
+worker_class = os.environ.get('INDEXER_WORKER_CLASS', 'gthread')
+workers = int(os.environ.get('INDEXER_WORKERS', str(min(os.cpu_count() or 1, 4))))
+threads = int(os.environ.get('INDEXER_THREADS', '8'))
+timeout = int(os.environ.get('INDEXER_TIMEOUT', '60'))
+keepalive = int(os.environ.get('INDEXER_KEEPALIVE', '5'))
+# Load the app once in the master so workers fork with it already imported
+preload_app = os.environ.get('INDEXER_PRELOAD', 'true').lower() in ('1', 'true', 'yes')
+
+# Lets the kernel copy nzb files straight to the socket for send_file responses
+sendfile = True
+
+loglevel = os.environ.get('INDEXER_LOG_LEVEL', 'debug')
+accesslog = '-'
+errorlog = '-'
+capture_output = True
+
+
+def post_worker_init(worker):
+  # Threads do not survive the fork, so each worker starts its own
+  # catalog snapshot reloader (a no-op unless INDEXER_SNAPSHOT is set)
+  import main
+  main.start_snapshot_reloader()
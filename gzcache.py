@@ -0,0 +1,118 @@
+"""
+On-disk cache of gzip-compressed nzbs, shared by the producer and the indexer.
+
+Entries are keyed by the nzb's path relative to NZBS_DIR together with its
+size and mtime, so a rewritten nzb gets a new entry and a stale one is
+never served. Files are written to a temporary name and renamed into
+place, so a reader (possibly another process) only ever sees complete
+entries. The cache is bounded by total size: once it grows past the limit,
+the least recently used entries (by mtime, which hits refresh) are removed.
+"""
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+
+SUFFIX = ".nzb.gz"
+
+logger = logging.getLogger('gzcache')
+
+
+class GzipCache(object):
+
+  def __init__(self, root, max_bytes, level=6):
+    self.root = root
+    self.max_bytes = max_bytes
+    self.level = level
+    # Bytes this process believes the cache holds; None until first counted
+    self.size = None
+    self.lock = threading.Lock()
+
+  def entry_path(self, key, st):
+    digest = hashlib.sha1(f"{key}\0{st.st_size}\0{st.st_mtime_ns}".encode("utf-8")).hexdigest()
+    return os.path.join(self.root, digest[:2], digest + SUFFIX)
+
+  def get(self, key, st):
+    """Returns the path of the compressed copy of the file with stat st, or None."""
+    path = self.entry_path(key, st)
+    try:
+      os.utime(path)
+    except OSError:
+      return None
+    return path
+
+  def build(self, key, source_path, st):
+    """Compresses source_path into the cache and returns the entry's path."""
+    path = self.entry_path(key, st)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+      with os.fdopen(fd, "wb") as tmp, open(source_path, "rb") as source:
+        # mtime=0 keeps the output identical whichever process builds it
+        with gzip.GzipFile(fileobj=tmp, mode="wb", compresslevel=self.level, mtime=0) as compressed:
+          shutil.copyfileobj(source, compressed, 1024 * 1024)
+      os.replace(tmp_path, path)
+    except BaseException:
+      try:
+        os.unlink(tmp_path)
+      except OSError:
+        pass
+      raise
+    self.added(os.path.getsize(path))
+    return path
+
+  def get_or_build(self, key, source_path, st):
+    """Returns (path, built) for the compressed copy, building it on a miss."""
+    path = self.get(key, st)
+    if path is not None:
+      return path, False
+    return self.build(key, source_path, st), True
+
+  def added(self, size):
+    with self.lock:
+      if self.size is None:
+        self.size = self.scan_size()
+      else:
+        self.size += size
+      if self.size > self.max_bytes:
+        self.evict()
+
+  def entries(self):
+    found = []
+    for dir_entry in os.scandir(self.root):
+      if not dir_entry.is_dir():
+        continue
+      for entry in os.scandir(dir_entry.path):
+        if entry.name.endswith(SUFFIX):
+          try:
+            st = entry.stat()
+          except OSError:
+            continue
+          found.append((st.st_mtime, st.st_size, entry.path))
+    return found
+
+  def scan_size(self):
+    return sum(size for _, size, _ in self.entries())
+
+  def evict(self):
+    # Other processes add entries too, so the size is recounted from disk;
+    # dropping to 90% of the limit avoids evicting again on every build
+    found = sorted(self.entries())
+    total = sum(size for _, size, _ in found)
+    target = self.max_bytes * 0.9
+    removed = 0
+    for _, size, path in found:
+      if total <= target:
+        break
+      try:
+        os.unlink(path)
+      except OSError:
+        continue
+      total -= size
+      removed += 1
+    self.size = total
+    logger.info("Evicted %d compressed nzbs, cache now holds %d bytes", removed, total)
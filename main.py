@@ -1,8 +1,24 @@
-from datetime import datetime, timedelta
-from flask import Flask, send_file, abort, request, Response
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import formatdate
+from flask import Flask, send_file, abort, request, Response, stream_with_context, jsonify, g
+from urllib.parse import quote, urlencode
+from werkzeug.http import is_resource_modified
+from xml.sax.saxutils import escape
 import logging
+import metrics
 import os
+import episodes
+import gc
+import gzcache
+import heapq
+import itertools
+import re
 import sqlite3
+import sys
+import threading
+import time
 
 
 app = Flask(__name__)
@@ -19,11 +35,80 @@ nzbs_root_dir = os.environ.get('NZBS_DIR')
 config_dir = "/config"
 db_name = "nzbs.db"
 table_name = "nzbs"
+meta_table_name = "meta"
+fts_table_name = "nzbs_fts"
+episodes_table_name = "nzb_episodes"
 db_path = os.path.join(config_dir, db_name)
 
 MTYPE_MOVIE = "movie"
 MTYPE_SHOW = "show"
 
+# Full-text title search: matched FTS rows joined back to nzbs, ranked by
+# bm25 with the TMDB names weighted above the release name and parsed title
+FTS_SOURCE = f"{fts_table_name} JOIN {table_name} ON {table_name}.id = {fts_table_name}.rowid"
+FTS_RANK = f"bm25({fts_table_name}, 1.0, 2.0, 4.0, 2.0)"
+
+# The only columns the XML renderer needs, in the order construct_item_xml
+# unpacks them. For IMDB searches the producer's covering index holds all
+# of them, so those searches never read the table itself.
+XML_COLUMNS = ", ".join(f"{table_name}.{column}" for column in
+                        ("name", "filename", "raw_size", "season", "episode", "added_at", "id"))
+# Responses mixing both types also select the type, which gives each item
+# its own category
+MIXED_XML_COLUMNS = f"{XML_COLUMNS}, {table_name}.mtype"
+
+# Newznab categories of each type; a search's cat may name the parent or
+# any of its subcategories (e.g. 5040 for TV/HD)
+CATEGORIES = {MTYPE_MOVIE: 2000, MTYPE_SHOW: 5000}
+
+# Newznab id parameters per search type and the columns they match; when a
+# request carries several, the first one listed here is used
+TV_ID_PARAMS = (("imdbid", "imdb_id"), ("tvdbid", "tvdb_id"), ("tmdbid", "tmdb_id"))
+MOVIE_ID_PARAMS = (("imdbid", "imdb_id"), ("tmdbid", "tmdb_id"))
+
+# Searches without a query are a newest-first feed, paged by (added_at, id)
+FEED_ORDER = f"{table_name}.added_at DESC, {table_name}.id DESC"
+
+# Id searches, in the order of the covering index for IMDB ids, which the
+# snapshot sorts its rows in too; it keeps offset paging stable
+ID_SEARCH_ORDER = f"{table_name}.season, {table_name}.name, {table_name}.filename"
+
+# Newznab paging; MAX_RESULTS must match the limits advertised by caps
+MAX_RESULTS = 100
+XML_FETCH_SIZE = 50
+
+response_cache_size = int(os.environ.get('INDEXER_RESPONSE_CACHE_SIZE', '1024'))
+response_cache_ttl = float(os.environ.get('INDEXER_RESPONSE_CACHE_TTL', '300'))
+
+download_cache_size = int(os.environ.get('INDEXER_DOWNLOAD_CACHE_SIZE', '4096'))
+# Hand nzb transfers to a fronting proxy instead of streaming them from Python:
+# 'x-sendfile' (Apache, lighttpd) or 'x-accel-redirect' (nginx); empty to send directly
+download_offload = os.environ.get('INDEXER_DOWNLOAD_OFFLOAD', '').lower()
+# nginx internal location that maps to NZBS_DIR, used with x-accel-redirect
+accel_redirect_prefix = os.environ.get('INDEXER_ACCEL_REDIRECT_PREFIX', '/internal-nzbs/')
+# With this set, send_file only adds the X-Sendfile header and leaves the body to the proxy
+app.config['USE_X_SENDFILE'] = download_offload == 'x-sendfile'
+# Send nzbs gzip-compressed to clients that accept it, from a size-bounded
+# cache of compressed copies shared with the producer
+download_gzip = os.environ.get('INDEXER_DOWNLOAD_GZIP', 'false').lower() in ('1', 'true', 'yes')
+gzip_cache = gzcache.GzipCache(
+  os.environ.get('NZB_GZIP_CACHE_DIR', os.path.join(config_dir, 'gzcache')),
+  int(os.environ.get('NZB_GZIP_CACHE_MAX_MB', '1024')) * 1024 * 1024,
+  int(os.environ.get('NZB_GZIP_LEVEL', '6')))
+
+# Serve id searches and the feed from an in-memory copy of the nzbs table,
+# rebuilt in the background whenever the producer's data version changes
+snapshot_enabled = os.environ.get('INDEXER_SNAPSHOT', 'false').lower() in ('1', 'true', 'yes')
+snapshot_poll_interval = float(os.environ.get('INDEXER_SNAPSHOT_POLL_INTERVAL', '5'))
+# An ingest bumps the data version with every writer batch, so rebuilds are
+# spaced at least this many seconds apart however often it changes
+snapshot_min_rebuild_interval = float(os.environ.get('INDEXER_SNAPSHOT_MIN_REBUILD_INTERVAL', '60'))
+
+# Read-only connection pool tuning
+db_pool_size = int(os.environ.get('INDEXER_DB_POOL_SIZE', '4'))
+db_cache_size_kib = int(os.environ.get('INDEXER_DB_CACHE_SIZE_KIB', '16384'))
+db_mmap_size = int(os.environ.get('INDEXER_DB_MMAP_SIZE', str(256 * 1024 * 1024)))
+
 
 class NZB(object):
 
@@ -54,26 +139,471 @@ if __name__ != '__main__':
   app.logger.setLevel(gunicorn_logger.level)
 
 
+class ConnectionPool(object):
+  """
+  Per-process pool of read-only SQLite connections. Connections are reused
+  across requests so their page cache, mmap and prepared statements stay
+  warm; a forked worker starts with an empty pool of its own.
+  """
+
+  def __init__(self, max_idle):
+    self.max_idle = max_idle
+    self.idle = []
+    self.pid = os.getpid()
+    self.lock = threading.Lock()
+
+  def connect(self):
+    conn = sqlite3.connect(f"file:{quote(db_path)}?mode=ro", uri=True, check_same_thread=False)
+    conn.execute(f"PRAGMA mmap_size = {db_mmap_size}")
+    conn.execute(f"PRAGMA cache_size = -{db_cache_size_kib}")
+    return conn
+
+  def acquire(self):
+    with self.lock:
+      if self.pid != os.getpid():
+        # Connections inherited across fork belong to the parent
+        self.idle = []
+        self.pid = os.getpid()
+      if self.idle:
+        return self.idle.pop()
+    return self.connect()
+
+  def release(self, conn):
+    with self.lock:
+      if self.pid == os.getpid() and len(self.idle) < self.max_idle:
+        self.idle.append(conn)
+        return
+    conn.close()
+
+  @contextmanager
+  def connection(self):
+    conn = self.acquire()
+    done = False
+    try:
+      yield conn
+      done = True
+    finally:
+      # Any exception, GeneratorExit from an abandoned response included,
+      # can leave a statement open mid-read, so that connection is closed
+      # rather than handed to the next request
+      if done:
+        self.release(conn)
+      else:
+        conn.close()
+
+
+db_pool = ConnectionPool(db_pool_size)
+
+
+class ResponseCache(object):
+  """
+  Bounded LRU of rendered /api responses. Each entry remembers the producer's
+  data version it was rendered at and is only served while that version is
+  still current and its TTL has not run out.
+  """
+
+  def __init__(self, max_size, ttl):
+    self.max_size = max_size
+    self.ttl = ttl
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key, version):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is not None:
+        body, entry_version, expires = entry
+        if entry_version == version and expires > time.monotonic():
+          self.entries.move_to_end(key)
+          self.hits += 1
+          return body
+        del self.entries[key]
+      self.misses += 1
+      return None
+
+  def put(self, key, version, body):
+    if self.max_size <= 0:
+      return
+    with self.lock:
+      self.entries[key] = (body, version, time.monotonic() + self.ttl)
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.max_size:
+        self.entries.popitem(last=False)
+
+  def stats(self):
+    with self.lock:
+      lookups = self.hits + self.misses
+      return {
+        "size": len(self.entries),
+        "max_size": self.max_size,
+        "hits": self.hits,
+        "misses": self.misses,
+        "hit_ratio": self.hits / lookups if lookups else 0.0,
+      }
+
+
+response_cache = ResponseCache(response_cache_size, response_cache_ttl)
+
+
+# Exposed at /metrics; values are per gunicorn worker
+metrics_registry = metrics.Registry()
+request_seconds = metrics_registry.histogram(
+  "indexer_request_seconds", "Time to serve a request, including streaming the body",
+  ("route", "function", "status"))
+sql_seconds = metrics_registry.histogram(
+  "indexer_sql_seconds", "Time spent in SQLite per search, by step", ("step",))
+rows_returned = metrics_registry.histogram(
+  "indexer_rows_returned", "Rows rendered per search response", buckets=(0, 1, 5, 10, 25, 50, 100))
+xml_render_seconds = metrics_registry.histogram(
+  "indexer_xml_render_seconds", "Time spent rendering rows to XML per search response")
+download_lookup_seconds = metrics_registry.histogram(
+  "indexer_download_lookup_seconds", "Time to resolve a download to a file", ("result",))
+download_responses = metrics_registry.counter(
+  "indexer_downloads_total", "Download responses by content encoding and status", ("encoding", "status"))
+gzip_cache_lookups = metrics_registry.counter(
+  "indexer_gzip_cache_lookups_total", "Compressed nzb lookups by result", ("result",))
+API_FUNCTIONS = ("caps", "search", "tvsearch", "movie")
+
+
+class CatalogSnapshot(object):
+  """
+  Immutable in-memory copy of the nzbs table, serving the id searches and
+  the newest-first feed without SQLite. Rows are the tuples construct_item_xml
+  renders, with repeated strings shared between them. Nothing is changed
+  after build(), so requests read it without locking, and a reload only
+  replaces the module-level `catalog` reference.
+  """
+
+  __slots__ = ("data_version", "feeds", "by_id", "build_seconds", "size_bytes")
+
+  ID_COLUMNS = ("imdb_id", "tvdb_id", "tmdb_id")
+
+  def __init__(self, data_version, feeds, by_id, build_seconds, size_bytes):
+    self.data_version = data_version
+    self.feeds = feeds
+    self.by_id = by_id
+    self.build_seconds = build_seconds
+    self.size_bytes = size_bytes
+
+  @classmethod
+  def build(cls, conn):
+    started = time.perf_counter()
+    strings = {}
+    # {mtype: rows newest first}, {(mtype, id column, id): {season: rows}}
+    feeds = {}
+    by_id = {}
+    # One read transaction, so the rows are the ones of the version read
+    conn.execute("BEGIN")
+    try:
+      row = conn.execute(f"SELECT value FROM {meta_table_name} WHERE key = 'data_version'").fetchone()
+      data_version = row[0] if row else None
+      for mtype in (MTYPE_SHOW, MTYPE_MOVIE):
+        feed = []
+        for name, filename, raw_size, season, episode, added_at, row_id, *ids in conn.execute(f"""
+            SELECT name, filename, raw_size, season, episode, added_at, id, {", ".join(cls.ID_COLUMNS)}
+            FROM {table_name} WHERE mtype = ? ORDER BY {FEED_ORDER}""", (mtype,)):
+          if episode is not None:
+            episode = strings.setdefault(episode, episode)
+          record = (name, filename, raw_size, season, episode, added_at, row_id)
+          feed.append(record)
+          for column, value in zip(cls.ID_COLUMNS, ids):
+            if value is not None:
+              by_id.setdefault((mtype, column, value), {}).setdefault(season, []).append(record)
+        feeds[mtype] = tuple(feed)
+    finally:
+      conn.execute("COMMIT")
+    # Same order as ID_SEARCH_ORDER gives the SQL searches
+    for seasons in by_id.values():
+      for season, records in seasons.items():
+        records.sort(key=lambda record: (record[0], record[1]))
+        seasons[season] = tuple(records)
+    build_seconds = time.perf_counter() - started
+    return cls(data_version, feeds, by_id, build_seconds, cls.estimate_size(feeds, by_id, strings))
+
+  @staticmethod
+  def estimate_size(feeds, by_id, strings):
+    """Approximate bytes held by the snapshot, counting shared objects once."""
+    size = sum(sys.getsizeof(value) for value in strings)
+    for feed in feeds.values():
+      size += sys.getsizeof(feed)
+      for record in feed:
+        # season is a small, cached int and episode is counted with strings
+        size += sys.getsizeof(record) + sum(sys.getsizeof(record[i]) for i in (0, 1, 2, 5, 6))
+    size += sys.getsizeof(by_id)
+    for key, seasons in by_id.items():
+      size += sys.getsizeof(key) + sys.getsizeof(key[2]) + sys.getsizeof(seasons)
+      size += sum(sys.getsizeof(records) for records in seasons.values())
+    return size
+
+  def row_count(self):
+    return sum(len(feed) for feed in self.feeds.values())
+
+  def search(self, mtype, column, value, season=None, episode=None):
+    seasons = self.by_id.get((mtype, column, value))
+    if not seasons:
+      return ()
+    if season is not None:
+      records = seasons.get(season, ())
+    else:
+      records = [record for key in sorted(seasons, key=lambda s: (s is not None, s or 0))
+                 for record in seasons[key]]
+    if episode is not None:
+      records = [record for record in records if episode in episodes.episode_numbers(record[4])]
+    return records
+
+  def mixed_feed(self, position, count):
+    """
+    The first count rows of both feeds merged newest first, starting after
+    position (added_at, id) if one is given. Each row is followed by its mtype.
+    """
+    def tagged(mtype, feed):
+      start = self.feed_start(mtype, position) if position else 0
+      for i in range(start, len(feed)):
+        yield feed[i] + (mtype,)
+
+    merged = heapq.merge(*(tagged(mtype, feed) for mtype, feed in self.feeds.items()),
+                         key=lambda row: (row[5], row[6]), reverse=True)
+    return list(itertools.islice(merged, count))
+
+  def feed_start(self, mtype, position):
+    """Index of the first feed row that comes after position (added_at, id)."""
+    feed = self.feeds.get(mtype, ())
+    low, high = 0, len(feed)
+    while low < high:
+      middle = (low + high) // 2
+      if (feed[middle][5], feed[middle][6]) < position:
+        high = middle
+      else:
+        low = middle + 1
+    return low
+
+  def stats(self):
+    return {
+      "data_version": self.data_version,
+      "rows": self.row_count(),
+      "ids": len(self.by_id),
+      "build_seconds": round(self.build_seconds, 3),
+      "size_bytes": self.size_bytes,
+    }
+
+
+# The current snapshot, or None to serve everything from SQLite
+catalog = None
+# time.monotonic() when the current snapshot was swapped in
+catalog_loaded_at = None
+snapshot_reloader_pid = None
+
+
+def load_snapshot():
+  global catalog, catalog_loaded_at
+  with db_pool.connection() as conn:
+    snapshot = CatalogSnapshot.build(conn)
+  catalog = snapshot
+  catalog_loaded_at = time.monotonic()
+  app.logger.info("Loaded catalog snapshot of %d rows at data version %s in %.2fs (~%.1f MiB)",
+                  snapshot.row_count(), snapshot.data_version, snapshot.build_seconds,
+                  snapshot.size_bytes / (1024 * 1024))
+
+
+def snapshot_due(version, now):
+  """
+  Whether the snapshot should be rebuilt for data version `version`. A
+  stale one waits out snapshot_min_rebuild_interval, so an ingest costs a
+  rebuild per interval rather than one per writer batch and poll.
+  """
+  if catalog is None:
+    return True
+  if version == catalog.data_version:
+    return False
+  return now - catalog_loaded_at >= snapshot_min_rebuild_interval
+
+
+def reload_snapshot_forever():
+  while True:
+    time.sleep(snapshot_poll_interval)
+    try:
+      if snapshot_due(current_data_version(), time.monotonic()):
+        load_snapshot()
+    except Exception:
+      app.logger.exception("Failed to reload the catalog snapshot")
+
+
+def start_snapshot_reloader():
+  """
+  Starts this process's snapshot reload thread. Threads do not survive a
+  fork, so under gunicorn this runs in each worker (see gunicorn.conf.py).
+  """
+  global snapshot_reloader_pid
+  if not snapshot_enabled or snapshot_reloader_pid == os.getpid():
+    return
+  snapshot_reloader_pid = os.getpid()
+  threading.Thread(target=reload_snapshot_forever, name="catalog-snapshot", daemon=True).start()
+
+
+class PathCache(object):
+  """Small thread-safe LRU mapping nzb filenames to absolute paths."""
+
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+
+  def get(self, filename):
+    with self.lock:
+      path = self.entries.get(filename)
+      if path is not None:
+        self.entries.move_to_end(filename)
+      return path
+
+  def put(self, filename, path):
+    with self.lock:
+      self.entries[filename] = path
+      self.entries.move_to_end(filename)
+      while len(self.entries) > self.max_size:
+        self.entries.popitem(last=False)
+
+  def invalidate(self, filename):
+    with self.lock:
+      self.entries.pop(filename, None)
+
+
+download_path_cache = PathCache(download_cache_size)
+
+
+@app.before_request
+def start_request_timer():
+  g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_time(response):
+  started = g.get('request_started')
+  if started is None:
+    return response
+  route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+  function = ""
+  if route == "/api":
+    function = request.args.get('t')
+    function = function if function in API_FUNCTIONS else "other"
+  status = response.status_code
+
+  # Streamed bodies are still being written here, so the time is taken on close
+  def observe():
+    request_seconds.observe(time.perf_counter() - started, route=route, function=function, status=status)
+
+  response.call_on_close(observe)
+  return response
+
+
+# Returns the path (relative to NZBS_DIR) the producer recorded for filename
+def lookup_nzb_path(filename):
+  with db_pool.connection() as conn:
+    cursor = conn.cursor()
+    query = f"SELECT path FROM {table_name} WHERE filename = ? AND path IS NOT NULL LIMIT 1"
+    cursor.execute(query, (filename,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def walk_for_nzb(filename):
+  for root, _, files in os.walk(nzbs_root_dir):
+    if filename in files:
+      return os.path.join(root, filename)
+  return None
+
+
+def resolve_nzb_path(filename):
+  cached_path = download_path_cache.get(filename)
+  if cached_path is not None:
+    if os.path.isfile(cached_path):
+      return cached_path
+    app.logger.debug("Cached path %s for %s is gone, invalidating", cached_path, filename)
+    download_path_cache.invalidate(filename)
+
+  rel_path = lookup_nzb_path(filename)
+  if rel_path is not None:
+    full_path = os.path.join(nzbs_root_dir, rel_path)
+    if os.path.isfile(full_path):
+      download_path_cache.put(filename, full_path)
+      return full_path
+    app.logger.debug("Indexed path %s for %s is missing on disk", full_path, filename)
+
+  # Fall back to walking the tree, e.g. for rows the producer has not backfilled yet
+  full_path = walk_for_nzb(filename)
+  if full_path is not None:
+    download_path_cache.put(filename, full_path)
+  return full_path
+
+
 @app.route('/download/<filename>')
 def download_nzb(filename):
   app.logger.info('New download request for %s', filename)
-  # Check if file exists on disk
-  for root, _, files in os.walk(nzbs_root_dir):
-    if filename in files:
-      full_path = os.path.join(root, filename)
-      app.logger.debug("Found %s at path %s", filename, full_path)
-      return send_file(full_path, as_attachment=True)
-  abort(404)
+  started = time.perf_counter()
+  full_path = resolve_nzb_path(filename)
+  download_lookup_seconds.observe(time.perf_counter() - started,
+                                  result="found" if full_path is not None else "missing")
+  if full_path is None:
+    abort(404)
+  app.logger.debug("Found %s at path %s", filename, full_path)
+  if download_offload == 'x-accel-redirect':
+    return accel_redirect_response(full_path)
+  try:
+    st = os.stat(full_path)
+  except OSError:
+    abort(404)
+  # Validators come from the nzb itself, so they agree across workers and
+  # survive the compressed copy being evicted and rebuilt
+  encoding = "gzip" if download_gzip and request.accept_encodings["gzip"] else "identity"
+  etag = f"{st.st_mtime_ns:x}-{st.st_size:x}" + ("-gz" if encoding == "gzip" else "")
+  last_modified = datetime.fromtimestamp(int(st.st_mtime), timezone.utc)
+  if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+  elif encoding == "gzip":
+    response = gzip_download_response(full_path, st, etag, last_modified)
+  else:
+    # Under gunicorn the file goes out through wsgi.file_wrapper, i.e. sendfile(2)
+    response = send_file(full_path, as_attachment=True, etag=etag, last_modified=last_modified)
+  if download_gzip:
+    response.vary.add("Accept-Encoding")
+  download_responses.inc(encoding=encoding, status=response.status_code)
+  return response
+
+
+def gzip_download_response(full_path, st, etag, last_modified):
+  rel_path = os.path.relpath(full_path, nzbs_root_dir)
+  try:
+    gz_path, built = gzip_cache.get_or_build(rel_path, full_path, st)
+  except OSError:
+    app.logger.exception("Failed to compress %s, sending it uncompressed", full_path)
+    gzip_cache_lookups.inc(result="error")
+    return send_file(full_path, as_attachment=True, etag=etag[:-len("-gz")], last_modified=last_modified)
+  gzip_cache_lookups.inc(result="build" if built else "hit")
+  response = send_file(gz_path, mimetype="application/x-nzb", as_attachment=True,
+                       download_name=os.path.basename(full_path), etag=etag, last_modified=last_modified)
+  response.content_encoding = "gzip"
+  return response
+
+
+def accel_redirect_response(full_path):
+  rel_path = os.path.relpath(full_path, nzbs_root_dir)
+  response = Response(mimetype='application/x-nzb')
+  response.headers['X-Accel-Redirect'] = accel_redirect_prefix.rstrip('/') + '/' + quote(rel_path)
+  response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(os.path.basename(full_path))}"
+  return response
 
 
 @app.route("/search/shows/<imdbid>/<seasonnum>")
 def search_shows_with_imdb(imdbid, seasonnum):
   app.logger.info('New show search request for %s, Season %s', imdbid, seasonnum)
-  with sqlite3.connect(db_path) as conn:
+  with db_pool.connection() as conn:
     cursor = conn.cursor()
-    query = f"SELECT * FROM {table_name} WHERE mtype='{MTYPE_SHOW}' AND imdb_id='{imdbid}' AND season={seasonnum}"
+    query = f"SELECT * FROM {table_name} WHERE mtype = ? AND imdb_id = ? AND season = ?"
     app.logger.debug("Executing query %s", query)
-    cursor.execute(query)
+    cursor.execute(query, (MTYPE_SHOW, imdbid, seasonnum))
     rows = cursor.fetchall()
     return {"results": rows_to_dicts(cursor, rows)}
 
@@ -81,11 +611,11 @@ def search_shows_with_imdb(imdbid, seasonnum):
 @app.route("/search/movies/<imdbid>")
 def search_movies_with_imdb(imdbid):
   app.logger.info('New movie search request for %s', imdbid)
-  with sqlite3.connect(db_path) as conn:
+  with db_pool.connection() as conn:
     cursor = conn.cursor()
-    query = f"SELECT * FROM {table_name} WHERE mtype='{MTYPE_MOVIE}' AND imdb_id='{imdbid}'"
+    query = f"SELECT * FROM {table_name} WHERE mtype = ? AND imdb_id = ?"
     app.logger.debug("Executing query %s", query)
-    cursor.execute(query)
+    cursor.execute(query, (MTYPE_MOVIE, imdbid))
     rows = cursor.fetchall()
     return {"results": rows_to_dicts(cursor, rows)}
 
@@ -94,11 +624,11 @@ def search_movies_with_imdb(imdbid):
 @app.route("/search/shows/title/")
 def search_shows_with_title_test():
   app.logger.info('New show search request for testing')
-  with sqlite3.connect(db_path) as conn:
+  with db_pool.connection() as conn:
     cursor = conn.cursor()
-    query = f"SELECT * FROM {table_name} WHERE mtype='{MTYPE_SHOW}' ORDER BY RANDOM() LIMIT 1;"
+    query = f"SELECT * FROM {table_name} WHERE mtype = ? ORDER BY added_at DESC, id DESC LIMIT 1"
     app.logger.debug("Executing query %s", query)
-    cursor.execute(query)
+    cursor.execute(query, (MTYPE_SHOW,))
     rows = cursor.fetchall()
     return {"results": rows_to_dicts(cursor, rows)}
 
@@ -107,11 +637,11 @@ def search_shows_with_title_test():
 @app.route("/search/movies/title/")
 def search_movies_with_title_test():
   app.logger.info('New movie search request for testing')
-  with sqlite3.connect(db_path) as conn:
+  with db_pool.connection() as conn:
     cursor = conn.cursor()
-    query = f"SELECT * FROM {table_name} WHERE mtype='{MTYPE_MOVIE}' ORDER BY RANDOM() LIMIT 1;"
+    query = f"SELECT * FROM {table_name} WHERE mtype = ? ORDER BY added_at DESC, id DESC LIMIT 1"
     app.logger.debug("Executing query %s", query)
-    cursor.execute(query)
+    cursor.execute(query, (MTYPE_MOVIE,))
     rows = cursor.fetchall()
     return {"results": rows_to_dicts(cursor, rows)}
 
@@ -119,11 +649,13 @@ def search_movies_with_title_test():
 @app.route("/search/shows/title/<title>")
 def search_shows_with_title(title):
   app.logger.info('New show search request for %s', title)
-  with sqlite3.connect(db_path) as conn:
+  if not fts_query(title):
+    return {"results": []}
+  with db_pool.connection() as conn:
     cursor = conn.cursor()
-    query = f"SELECT * FROM {table_name} WHERE mtype='{MTYPE_SHOW}' AND lower(tmdb_name)=lower('{title}')"
+    query = f"SELECT {table_name}.* FROM {FTS_SOURCE} WHERE {fts_table_name} MATCH ? AND +{table_name}.mtype = ? ORDER BY {FTS_RANK}"
     app.logger.debug("Executing query %s", query)
-    cursor.execute(query)
+    cursor.execute(query, (fts_query(title), MTYPE_SHOW))
     rows = cursor.fetchall()
     return {"results": rows_to_dicts(cursor, rows)}
 
@@ -131,11 +663,13 @@ def search_shows_with_title(title):
 @app.route("/search/movies/title/<title>")
 def search_movies_with_title(title):
   app.logger.info('New movie search request for %s', title)
-  with sqlite3.connect(db_path) as conn:
+  if not fts_query(title):
+    return {"results": []}
+  with db_pool.connection() as conn:
     cursor = conn.cursor()
-    query = f"SELECT * FROM {table_name} WHERE mtype='{MTYPE_MOVIE}' AND lower(tmdb_name)=lower('{title}')"
+    query = f"SELECT {table_name}.* FROM {FTS_SOURCE} WHERE {fts_table_name} MATCH ? AND +{table_name}.mtype = ? ORDER BY {FTS_RANK}"
     app.logger.debug("Executing query %s", query)
-    cursor.execute(query)
+    cursor.execute(query, (fts_query(title), MTYPE_MOVIE))
     rows = cursor.fetchall()
     return {"results": rows_to_dicts(cursor, rows)}
 
@@ -145,14 +679,14 @@ def newznab_api():
   function = request.args.get('t')
 
   if function == "caps":
-    return Response("""<caps>
+    return Response(f"""<caps>
       <server appversion="1.0.0" version="0.1" title="UDIndexer" strapline="" />
-      <limits max="100" default="100"/>
+      <limits max="{MAX_RESULTS}" default="{MAX_RESULTS}"/>
       <registration available="no" open="no"/>
       <searching>
         <search available="yes" supportedParams="q"/>
-        <tv-search available="yes" supportedParams="q,imdbid,season,ep"/>
-        <movie-search available="yes" supportedParams="q,imdbid"/>
+        <tv-search available="yes" supportedParams="q,imdbid,tvdbid,tmdbid,season,ep"/>
+        <movie-search available="yes" supportedParams="q,imdbid,tmdbid"/>
       </searching>
       <categories>
         <category id="2000" name="Movies"></category>
@@ -164,34 +698,207 @@ def newznab_api():
       </genres>
     </caps>""", mimetype='application/xml')
 
+  if function in ("tvsearch", "movie", "search"):
+    cache_tag = None
+    # Responses from the snapshot are only as new as the snapshot itself
+    snapshot = catalog
+    version = snapshot.data_version if snapshot is not None else current_data_version()
+    if version is not None and response_cache.max_size > 0:
+      cache_tag = (response_cache_key(request.args), version)
+      body = response_cache.get(*cache_tag)
+      if body is not None:
+        app.logger.debug("Response cache hit for %s", request.query_string)
+        return Response(body, mimetype='application/xml')
+    return newznab_search(function, cache_tag)
+
+
+def newznab_search(function, cache_tag):
+
+  snapshot = catalog
+
   if function == "tvsearch":
-    imdb_id = request.args.get('imdbid')
-    if not imdb_id.startswith("tt"):
-      imdb_id = "tt" + imdb_id
+    id_value = id_param(TV_ID_PARAMS)
     season = request.args.get('season')
-    results = search_shows_with_imdb(imdb_id, season)
-    return Response(construct_xml(results['results'], 5000), mimetype='application/xml')
+    if id_value is None:
+      q = request.args.get('q')
+      if q:
+        return xml_title_search_response(MTYPE_SHOW, q, 5000, cache_tag, season)
+      return xml_feed_response(MTYPE_SHOW, 5000, cache_tag)
+    column, value = id_value
+    if snapshot is not None:
+      try:
+        season_number = int(season) if season else None
+      except ValueError:
+        return empty_xml_response()
+      rows = snapshot.search(MTYPE_SHOW, column, value, season_number, episode_param())
+      return xml_rows_response(rows, 5000, cache_tag)
+    where = f"mtype = ? AND {column} = ?"
+    params = (MTYPE_SHOW, value)
+    if season:
+      where += " AND season = ?"
+      params += (season,)
+    where, params = episode_filter(where, params)
+    return xml_search_response(where, params, 5000, cache_tag, order_by=ID_SEARCH_ORDER)
 
   if function == "movie":
-    imdb_id = request.args.get('imdbid')
-    if not imdb_id.startswith("tt"):
-      imdb_id = "tt" + imdb_id
-    results = search_movies_with_imdb(imdb_id)
-    return Response(construct_xml(results['results'], 2000), mimetype='application/xml')
+    id_value = id_param(MOVIE_ID_PARAMS)
+    if id_value is None:
+      q = request.args.get('q')
+      if q:
+        return xml_title_search_response(MTYPE_MOVIE, q, 2000, cache_tag)
+      return xml_feed_response(MTYPE_MOVIE, 2000, cache_tag)
+    column, value = id_value
+    if snapshot is not None:
+      return xml_rows_response(snapshot.search(MTYPE_MOVIE, column, value), 2000, cache_tag)
+    return xml_search_response(f"mtype = ? AND {column} = ?", (MTYPE_MOVIE, value), 2000, cache_tag,
+                               order_by=ID_SEARCH_ORDER)
 
   if function == "search":
     q = request.args.get('q')
-    cats = request.args.get('cat')
-    if cats and '2000' in cats:
+    mtypes = requested_mtypes()
+    if not mtypes:
+      return empty_xml_response()
+    if len(mtypes) > 1:
+      # Both types, each item carrying its own category
       if q:
-        results = search_movies_with_title(q)
-        return Response(construct_xml(results['results'], 2000), mimetype='application/xml')
-      return Response(construct_xml(search_movies_with_title_test()['results'], 2000), mimetype='application/xml')
-    if cats and '5000' in cats:
-      if q:
-        results = search_shows_with_title(q)
-        return Response(construct_xml(results['results'], 5000), mimetype='application/xml')
-      return Response(construct_xml(search_shows_with_title_test()['results'], 5000), mimetype='application/xml')
+        return xml_title_search_response(None, q, None, cache_tag)
+      return xml_feed_response(None, None, cache_tag)
+    mtype, = mtypes
+    if q:
+      return xml_title_search_response(mtype, q, CATEGORIES[mtype], cache_tag)
+    return xml_feed_response(mtype, CATEGORIES[mtype], cache_tag)
+
+
+# The types a search's cat asks for: both without one, none if it names no
+# category this indexer has
+def requested_mtypes():
+  cats = request.args.get('cat')
+  if not cats:
+    return set(CATEGORIES)
+  mtypes = set()
+  for cat in cats.split(","):
+    try:
+      parent = int(cat) // 1000 * 1000
+    except ValueError:
+      continue
+    mtypes.update(mtype for mtype, category in CATEGORIES.items() if category == parent)
+  return mtypes
+
+
+def normalize_imdb_id(imdb_id):
+  if imdb_id and not imdb_id.startswith("tt"):
+    imdb_id = "tt" + imdb_id
+  return imdb_id
+
+
+# Returns (column, value) for the first id parameter of the request that is
+# in id_params, or None when there is none
+def id_param(id_params):
+  for arg, column in id_params:
+    value = request.args.get(arg)
+    if not value:
+      continue
+    if column == "imdb_id":
+      return column, normalize_imdb_id(value)
+    try:
+      return column, int(value)
+    except ValueError:
+      abort(400)
+  return None
+
+
+# The requested episode number. Daily shows send ep as "MM/DD", which is
+# not an episode number, so it filters nothing.
+def episode_param():
+  ep = request.args.get('ep')
+  return int(ep) if ep and ep.isdigit() else None
+
+
+# Narrows a search to releases containing the requested episode, through the
+# (nzb_id, episode) key of the episodes table
+def episode_filter(where, params):
+  episode = episode_param()
+  if episode is None:
+    return where, params
+  where += (f" AND EXISTS (SELECT 1 FROM {episodes_table_name} "
+            f"WHERE nzb_id = {table_name}.id AND episode = ?)")
+  return where, params + (episode,)
+
+
+# Returns the producer's data version, or None if the DB does not track one
+def current_data_version():
+  try:
+    with db_pool.connection() as conn:
+      row = conn.execute(f"SELECT value FROM {meta_table_name} WHERE key = 'data_version'").fetchone()
+  except sqlite3.OperationalError:
+    return None
+  return row[0] if row else None
+
+
+# Only the parameters that change the result are part of the key
+def response_cache_key(args):
+  imdb_id = normalize_imdb_id(args.get('imdbid') or None)
+  q = " ".join((args.get('q') or "").lower().split()) or None
+  cats = tuple(sorted(set(c.strip() for c in (args.get('cat') or "").split(",") if c.strip())))
+  return (args.get('t'), imdb_id, args.get('tvdbid'), args.get('tmdbid'), args.get('season'),
+          args.get('ep'), q, cats, args.get('limit'), args.get('offset'), args.get('cursor'))
+
+
+@app.route("/stats")
+def stats():
+  snapshot = catalog
+  return jsonify({"response_cache": response_cache.stats(),
+                  "snapshot": snapshot.stats() if snapshot is not None else None})
+
+
+@app.route("/metrics")
+def prometheus_metrics():
+  return Response(metrics_registry.render(), content_type=metrics.CONTENT_TYPE)
+
+
+def db_size_bytes():
+  return sum(os.path.getsize(path) for path in (db_path, db_path + "-wal") if os.path.exists(path))
+
+
+# Row counts only change with the data version, so they are recounted only then
+db_row_counts = (None, {})
+
+
+def count_rows_by_mtype():
+  global db_row_counts
+  version = current_data_version()
+  if version is None or version != db_row_counts[0]:
+    with db_pool.connection() as conn:
+      counts = {(mtype,): count for mtype, count in
+                conn.execute(f"SELECT mtype, COUNT(*) FROM {table_name} GROUP BY mtype")}
+    db_row_counts = (version, counts)
+  return db_row_counts[1]
+
+
+def response_cache_stat(name):
+  return lambda: response_cache.stats()[name]
+
+
+metrics_registry.gauge("indexer_db_size_bytes", "Size of the DB and its WAL", collect=db_size_bytes)
+metrics_registry.gauge("indexer_db_rows", "Indexed nzbs by type", ("mtype",), collect=count_rows_by_mtype)
+metrics_registry.gauge("indexer_response_cache_entries", "Cached /api responses", collect=response_cache_stat("size"))
+metrics_registry.counter("indexer_response_cache_hits_total", "Response cache hits",
+                         collect=response_cache_stat("hits"))
+metrics_registry.counter("indexer_response_cache_misses_total", "Response cache misses",
+                         collect=response_cache_stat("misses"))
+
+
+def snapshot_stat(name):
+  return lambda: catalog.stats()[name] if catalog is not None else None
+
+
+metrics_registry.gauge("indexer_snapshot_rows", "Rows in the catalog snapshot", collect=snapshot_stat("rows"))
+metrics_registry.gauge("indexer_snapshot_size_bytes", "Approximate memory held by the catalog snapshot",
+                       collect=snapshot_stat("size_bytes"))
+metrics_registry.gauge("indexer_snapshot_build_seconds", "Time the current catalog snapshot took to build",
+                       collect=snapshot_stat("build_seconds"))
+metrics_registry.gauge("indexer_snapshot_data_version", "Producer data version of the catalog snapshot",
+                       collect=snapshot_stat("data_version"))
 
 
 def rows_to_dicts(cursor, rows):
@@ -203,36 +910,235 @@ def rows_to_dicts(cursor, rows):
   return data
 
 
-def fake_dt():
-  now = datetime.now()
-  one_hour_ago = now - timedelta(hours=1)
-  return one_hour_ago.strftime('%a, %d %b %Y %H:%M:%S %z')
+# Returns (offset, limit) from the request, capped to what caps advertises
+def page_params(max_limit=MAX_RESULTS):
+  try:
+    offset = max(int(request.args.get('offset', 0)), 0)
+    limit = int(request.args.get('limit', max_limit))
+  except ValueError:
+    abort(400)
+  return offset, min(max(limit, 0), max_limit)
+
+
+def xml_search_response(where, params, cat, cache_tag=None, order_by=None, max_limit=MAX_RESULTS,
+                        source=table_name, total=None, next_url=None, columns=XML_COLUMNS):
+  """
+  Streams the Newznab XML for rows of the nzbs table matching `where`; a
+  cat of None takes each item's category from its type, which needs
+  MIXED_XML_COLUMNS. The pooled connection is held for as long as the
+  response is being written.
+  With a cache_tag of (key, data version), the rendered document is also
+  stored in the response cache once it has been fully written. A known
+  `total` skips the COUNT query; with `next_url`, a full page links to the
+  next one through a cursor built from its last row.
+  """
+  offset, limit = page_params(max_limit)
+  order_clause = f" ORDER BY {order_by}" if order_by else ""
+  count_query = f"SELECT COUNT(*) FROM {source} WHERE {where}"
+  query = f"SELECT {columns} FROM {source} WHERE {where}{order_clause} LIMIT ? OFFSET ?"
+
+  def generate():
+    with db_pool.connection() as conn:
+      cursor = conn.cursor()
+      app.logger.debug("Executing query %s", query)
+      page_total = total
+      if page_total is None:
+        with sql_seconds.time(step="count"):
+          page_total = cursor.execute(count_query, params).fetchone()[0]
+      if max_limit < MAX_RESULTS:
+        page_total = min(page_total, max_limit)
+      with sql_seconds.time(step="select"):
+        cursor.execute(query, params + (limit, offset))
+      batches = iter(lambda: cursor.fetchmany(XML_FETCH_SIZE), [])
+      yield from construct_xml(batches, cat, page_total, offset, limit if next_url else None, next_url)
+
+  def generate_and_cache():
+    chunks = []
+    for chunk in generate():
+      chunks.append(chunk)
+      yield chunk
+    response_cache.put(*cache_tag, "".join(chunks).encode('utf-8'))
+
+  body = generate() if cache_tag is None else generate_and_cache()
+  return Response(stream_with_context(body), mimetype='application/xml')
+
+
+def xml_rows_response(rows, cat, cache_tag=None, max_limit=MAX_RESULTS, total=None, next_url=None, start=0):
+  """
+  Newznab XML for snapshot rows, paged from `start` like xml_search_response
+  pages the query results. The page is rendered in one go since there is
+  no connection to hold, and cached under cache_tag if one is given.
+  """
+  offset, limit = page_params(max_limit)
+  page_total = len(rows) if total is None else total
+  if max_limit < MAX_RESULTS:
+    page_total = min(page_total, max_limit)
+  page = rows[start + offset:start + offset + limit]
+  batches = (page[i:i + XML_FETCH_SIZE] for i in range(0, len(page), XML_FETCH_SIZE))
+  body = "".join(construct_xml(batches, cat, page_total, offset, limit if next_url else None, next_url,
+                               fetch_step=None))
+  if cache_tag is not None:
+    response_cache.put(*cache_tag, body.encode('utf-8'))
+  return Response(body, mimetype='application/xml')
+
 
-def construct_xml(rows_dicts, cat):
-  pre = """<?xml version="1.0" encoding="UTF-8"?>
+# Turns free text into an FTS5 query that matches every word as a prefix
+def fts_query(text):
+  return " ".join(f'"{word}"*' for word in re.findall(r"\w+", text.lower()))
+
+
+# Title search of one type, or of both with an mtype (and cat) of None
+def xml_title_search_response(mtype, q, cat, cache_tag, season=None):
+  match = fts_query(q)
+  if not match:
+    return empty_xml_response()
+  where = f"{fts_table_name} MATCH ?"
+  params = (match,)
+  if mtype is not None:
+    # The unary + keeps SQLite from driving the join off the mtype index,
+    # which would run the MATCH once per row of that type
+    where += f" AND +{table_name}.mtype = ?"
+    params += (mtype,)
+  if season:
+    # The + also drops the column's integer affinity, so the text parameter
+    # has to be converted explicitly
+    where += f" AND +{table_name}.season = CAST(? AS INTEGER)"
+    params += (season,)
+  if mtype == MTYPE_SHOW:
+    where, params = episode_filter(where, params)
+  return xml_search_response(where, params, cat, cache_tag, order_by=FTS_RANK, source=FTS_SOURCE,
+                             columns=XML_COLUMNS if mtype is not None else MIXED_XML_COLUMNS)
+
+
+def xml_feed_response(mtype, cat, cache_tag):
+  """
+  Newest-first feed of one type, or of both with an mtype (and cat) of
+  None, for searches without a query. Pages are read straight off the
+  (mtype, added_at) index, so a poll costs one page however large the
+  library is; the feed of both types merges a page of each. Besides offset, a page can be requested
+  with the cursor ("added_at:id" of the previous page's last row) from the
+  atom:link rel="next" of the previous page, which stays O(page) at any depth.
+  """
+  position = None
+  cursor_arg = request.args.get('cursor')
+  if cursor_arg:
+    try:
+      added_at, row_id = (int(value) for value in cursor_arg.split(":", 1))
+    except ValueError:
+      abort(400)
+    position = (added_at, row_id)
+  args = request.args.to_dict()
+  args.pop('offset', None)
+
+  def next_url(last_row):
+    args['cursor'] = f"{last_row[5]}:{last_row[6]}"
+    return f"{base_url}/api?{urlencode(args)}"
+
+  snapshot = catalog
+  if snapshot is not None:
+    if mtype is None:
+      offset, limit = page_params()
+      return xml_rows_response(snapshot.mixed_feed(position, offset + limit), None, cache_tag,
+                               total=snapshot.row_count(), next_url=next_url)
+    feed = snapshot.feeds.get(mtype, ())
+    start = snapshot.feed_start(mtype, position) if position else 0
+    return xml_rows_response(feed, cat, cache_tag, total=len(feed), next_url=next_url, start=start)
+
+  where = "mtype = ?"
+  if position:
+    where += " AND (added_at, id) < (?, ?)"
+  # The size of the whole feed, counted once per data version
+  counts = count_rows_by_mtype()
+  if mtype is not None:
+    return xml_search_response(where, (mtype,) + (position or ()), cat, cache_tag, order_by=FEED_ORDER,
+                               total=counts.get((mtype,), 0), next_url=next_url)
+
+  # Each type's index gives its newest rows, so the page is among the first
+  # offset + limit rows of either type
+  offset, limit = page_params()
+  newest = f"SELECT * FROM (SELECT {MIXED_XML_COLUMNS} FROM {table_name} WHERE {where} ORDER BY {FEED_ORDER} LIMIT ?)"
+  source = f"({' UNION ALL '.join([newest] * len(CATEGORIES))}) AS {table_name}"
+  params = ()
+  for feed_mtype in CATEGORIES:
+    params += (feed_mtype,) + (position or ()) + (offset + limit,)
+  return xml_search_response("1", params, None, cache_tag, order_by=FEED_ORDER, source=source,
+                             total=sum(counts.values()), next_url=next_url, columns=MIXED_XML_COLUMNS)
+
+
+def empty_xml_response():
+  return Response(construct_xml(None, None, 0, 0), mimetype='application/xml')
+
+
+def xml_attr(value):
+  return escape(str(value), {'"': '&quot;'})
+
+
+# Renders rows arriving in batches (lists of XML_COLUMNS tuples); the time
+# spent waiting for each batch is recorded as SQL time under fetch_step
+def construct_xml(batches, cat, total, offset, page_size=None, next_url=None, fetch_step="fetch"):
+  pre = f"""<?xml version="1.0" encoding="UTF-8"?>
   <rss version="2.0" xmlns:atom="http://www.w3.org/2005/Atom" xmlns:newznab="http://www.newznab.com/DTD/2010/feeds/attributes/" encoding="utf-8">
-  <channel><newznab:response offset="0" total="100"/><newznab:apilimits apiCurrent="0" grabCurrent="0"/>"""
+  <channel><newznab:response offset="{offset}" total="{total}"/><newznab:apilimits apiCurrent="0" grabCurrent="0"/>"""
   post = """</channel></rss>"""
-  items = ""
-  for row in rows_dicts:
-    item_xml = "<item>"
-    item_xml += f"<title>{row['name']}</title>"
-    # TODO: replace with an env var
-    item_xml += f"<link>{base_url}/download/{row['filename']}</link>"
-    item_xml += f'<enclosure url=\"{base_url}/download/{row["filename"]}\" length=\"{row["raw_size"]}\" type=\"application/x-nzb\"/>'
-    item_xml += f"<pubDate>{fake_dt()}</pubDate>"
-    item_xml += f'<newznab:attr name=\"category\" value=\"{cat}\"/>'
-    item_xml += f'<newznab:attr name=\"size\" value=\"{row["raw_size"]}\"/>'
-    item_xml += f'<newznab:attr name=\"files\" value=\"1\"/>'
-    item_xml += f'<newznab:attr name=\"title\" value=\"\"/>'
-    if cat == 5000:
-      item_xml += f'<newznab:attr name=\"season\" value=\"{row["season"]}\"/>'
-      item_xml += f'<newznab:attr name=\"episode\" value=\"{row["episode"]}\"/>'
-    item_xml += "</item>"
-    items += item_xml
-
-  return f"{pre}{items}{post}"
+  yield pre
+  if batches is not None:
+    row_count = 0
+    last_row = None
+    fetch_time = 0.0
+    render_time = 0.0
+    while True:
+      started = time.perf_counter()
+      rows = next(batches, None)
+      fetched = time.perf_counter()
+      fetch_time += fetched - started
+      if not rows:
+        break
+      row_count += len(rows)
+      last_row = rows[-1]
+      chunk = "".join(construct_item_xml(row, cat) for row in rows)
+      render_time += time.perf_counter() - fetched
+      yield chunk
+    if fetch_step is not None:
+      sql_seconds.observe(fetch_time, step=fetch_step)
+    rows_returned.observe(row_count)
+    xml_render_seconds.observe(render_time)
+    if next_url is not None and page_size and row_count == page_size:
+      yield f'<atom:link rel="next" href="{xml_attr(next_url(last_row))}"/>'
+  yield post
+
+
+# Rows of mixed types (cat None) end with their mtype
+def construct_item_xml(row, cat):
+  name, filename, raw_size, season, episode, added_at = row[:6]
+  if cat is None:
+    cat = CATEGORIES[row[7]]
+  pub_date = formatdate(added_at, usegmt=True)
+  download_url = xml_attr(f"{base_url}/download/{quote(filename)}")
+  tv_attrs = ""
+  if cat == 5000:
+    tv_attrs = (f'<newznab:attr name="season" value="{xml_attr(season)}"/>'
+                f'<newznab:attr name="episode" value="{xml_attr(episode)}"/>')
+  return (f"<item><title>{escape(name)}</title><link>{download_url}</link>"
+          f'<enclosure url="{download_url}" length="{raw_size}" type="application/x-nzb"/>'
+          f"<pubDate>{pub_date}</pubDate>"
+          f'<newznab:attr name="category" value="{cat}"/>'
+          f'<newznab:attr name="size" value="{raw_size}"/>'
+          '<newznab:attr name="files" value="1"/>'
+          '<newznab:attr name="title" value=""/>'
+          f"{tv_attrs}</item>")
+
+
+if snapshot_enabled:
+  # Under gunicorn with preload this runs once in the master, so the
+  # workers start out sharing the snapshot's pages. Freezing keeps the
+  # garbage collector from touching (and so copying) them in every worker.
+  try:
+    load_snapshot()
+  except sqlite3.Error:
+    app.logger.exception("Failed to load the catalog snapshot, serving from SQLite until it loads")
+  gc.freeze()
 
 
 if __name__ == '__main__':
+  start_snapshot_reloader()
   app.run(host='0.0.0.0', port=7990)
@@ -0,0 +1,202 @@
+"""
+Minimal in-process metrics shared by the producer, indexer and blackhole.
+
+Counters, gauges and histograms are rendered in the Prometheus text format.
+Recording a value is a lock and an add (plus a bisect for histograms), so
+the hooks are cheap enough to leave on in production. Values are kept per
+process; under gunicorn each worker reports its own.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import math
+import threading
+import time
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; spans sub-millisecond SQL up to slow TMDB calls and mount walks
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+logger = logging.getLogger('metrics')
+
+
+def format_value(value):
+  if value == math.inf:
+    return "+Inf"
+  if isinstance(value, float) and value.is_integer():
+    return str(int(value))
+  return repr(value) if isinstance(value, float) else str(value)
+
+
+def format_labels(names, values, extra=()):
+  pairs = list(zip(names, values)) + list(extra)
+  if not pairs:
+    return ""
+  escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+  return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class Metric(object):
+
+  kind = None
+
+  def __init__(self, name, documentation, labelnames=(), collect=None):
+    self.name = name
+    self.documentation = documentation
+    self.labelnames = tuple(labelnames)
+    self.collect = collect
+    self.lock = threading.Lock()
+    self.values = {}
+
+  def key(self, labels):
+    return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+  def render(self):
+    lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+    lines.extend(self.samples())
+    return lines
+
+  def samples(self):
+    if self.collect is None:
+      with self.lock:
+        values = list(self.values.items())
+      return [f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}" for key, value in values]
+    try:
+      collected = self.collect()
+    except Exception:
+      logger.exception("Failed to collect %s", self.name)
+      return []
+    if not isinstance(collected, dict):
+      collected = {(): collected}
+    return [f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}"
+            for key, value in collected.items() if value is not None]
+
+
+class Counter(Metric):
+  """
+  A value that only goes up. With `collect`, it is read at scrape time from
+  a running total kept elsewhere (see Gauge for what collect returns).
+  """
+
+  kind = "counter"
+
+  def inc(self, amount=1, **labels):
+    key = self.key(labels)
+    with self.lock:
+      self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+  """
+  A value that goes up and down. With `collect`, the values are read at
+  scrape time instead: it returns a number, or {label values tuple: number}.
+  """
+
+  kind = "gauge"
+
+  def set(self, value, **labels):
+    key = self.key(labels)
+    with self.lock:
+      self.values[key] = value
+
+
+class Histogram(Metric):
+
+  kind = "histogram"
+
+  def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    super().__init__(name, documentation, labelnames)
+    self.buckets = tuple(sorted(buckets))
+
+  def observe(self, value, **labels):
+    key = self.key(labels)
+    index = bisect_left(self.buckets, value)
+    with self.lock:
+      state = self.values.get(key)
+      if state is None:
+        # [per-bucket counts (last one is +Inf), sum]
+        state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+      state[0][index] += 1
+      state[1] += value
+
+  @contextmanager
+  def time(self, **labels):
+    started = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(time.perf_counter() - started, **labels)
+
+  def samples(self):
+    with self.lock:
+      values = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+    lines = []
+    for key, counts, total in values:
+      cumulative = 0
+      for bound, count in zip(self.buckets + (math.inf,), counts):
+        cumulative += count
+        labels = format_labels(self.labelnames, key, [("le", format_value(bound))])
+        lines.append(f"{self.name}_bucket{labels} {cumulative}")
+      labels = format_labels(self.labelnames, key)
+      lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+      lines.append(f"{self.name}_count{labels} {cumulative}")
+    return lines
+
+
+class Registry(object):
+
+  def __init__(self):
+    self.metrics = []
+    self.lock = threading.Lock()
+
+  def register(self, metric):
+    with self.lock:
+      self.metrics.append(metric)
+    return metric
+
+  def counter(self, name, documentation, labelnames=(), collect=None):
+    return self.register(Counter(name, documentation, labelnames, collect))
+
+  def gauge(self, name, documentation, labelnames=(), collect=None):
+    return self.register(Gauge(name, documentation, labelnames, collect))
+
+  def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    return self.register(Histogram(name, documentation, labelnames, buckets))
+
+  def render(self):
+    with self.lock:
+      metrics = list(self.metrics)
+    lines = []
+    for metric in metrics:
+      lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def serve(registry, port, host="0.0.0.0"):
+  """Serves the registry at /metrics from a daemon thread; port 0 disables it."""
+  if not port:
+    return None
+
+  class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+      if self.path.split("?", 1)[0] != "/metrics":
+        self.send_error(404)
+        return
+      body = registry.render().encode("utf-8")
+      self.send_response(200)
+      self.send_header("Content-Type", CONTENT_TYPE)
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, format, *args):
+      pass
+
+  server = ThreadingHTTPServer((host, port), Handler)
+  server.daemon_threads = True
+  threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+  return server
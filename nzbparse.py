@@ -0,0 +1,61 @@
+"""
+Reads the fields the producer and the blackhole need from an nzb: its
+filename, its name (the filename without the extension and any
+{{password}}) and its raw size, the sum of its segment sizes.
+"""
+import LordNzb
+import os
+import re
+import xml.etree.ElementTree as ET
+
+
+# 'fast' streams the nzb; 'lordnzb' uses LordNzb.parser, which loads the whole document
+nzb_parser = os.environ.get('NZB_PARSER', 'fast').lower()
+
+nzb_password_regex = re.compile("{{(.+)?}}")
+
+
+def parse_nzb_metadata(filepath):
+  if nzb_parser == "lordnzb":
+    return parse_nzb_metadata_lordnzb(filepath)
+  return parse_nzb_metadata_streaming(filepath)
+
+
+def parse_nzb_metadata_lordnzb(filepath):
+  m = LordNzb.parser(filepath)
+  return {
+    'filename': m.filename,
+    'name': m.name,
+    'raw_size': m.raw_size
+  }
+
+
+# Same result as LordNzb.parser for the fields used here, but streams the
+# XML in one pass and drops every element once it has been counted, so
+# memory stays flat no matter how large the nzb is.
+def parse_nzb_metadata_streaming(filepath):
+  filename = os.path.basename(filepath)
+  raw_size = 0
+  root = None
+  segments = None
+  for event, elem in ET.iterparse(filepath, events=('start', 'end')):
+    if root is None:
+      root = elem
+      namespace = elem.tag[:elem.tag.index('}') + 1] if elem.tag.startswith('{') else ''
+      file_tag = namespace + 'file'
+      segments_tag = namespace + 'segments'
+      segment_tag = namespace + 'segment'
+    elif event == 'start':
+      if elem.tag == segments_tag:
+        segments = elem
+    elif elem.tag == segment_tag:
+      raw_size += int(elem.attrib['bytes'])
+      if segments is not None:
+        del segments[:]
+    elif elem.tag == file_tag:
+      root.clear()
+  return {
+    'filename': filename,
+    'name': nzb_password_regex.sub("", filename.replace(".nzb", "")),
+    'raw_size': raw_size
+  }
@@ -1,11 +1,24 @@
+from collections import Counter, deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import argparse
+import episodes
+import gzcache
+import gzip
+import itertools
+import json
 import logging
-import LordNzb
+import metrics
+import multiprocessing
+import nzbparse
 import PTN
 import os
+import queue
+import re
 import requests
 import sqlite3
-import xml.etree.ElementTree as ET
+import threading
 import themoviedb
+import sys
 from sys import stdout
 import time
 from watchdog.observers import Observer
@@ -25,14 +38,95 @@ logger.addHandler(consoleHandler)
 nzbs_root_dir = os.environ.get('NZBS_DIR')
 config_dir = "/config"
 db_name = "nzbs.db"
+# Compress new nzbs into the indexer's gzip download cache at ingest, so the
+# first grab does not pay for it
+gzip_eager = os.environ.get('PRODUCER_GZIP_EAGER', 'false').lower() in ('1', 'true', 'yes')
+gzip_cache = gzcache.GzipCache(
+  os.environ.get('NZB_GZIP_CACHE_DIR', os.path.join(config_dir, 'gzcache')),
+  int(os.environ.get('NZB_GZIP_CACHE_MAX_MB', '1024')) * 1024 * 1024,
+  int(os.environ.get('NZB_GZIP_LEVEL', '6')))
 table_name = "nzbs"
 db_path = os.path.join(config_dir, db_name)
 
 MTYPE_MOVIE = "movie"
 MTYPE_SHOW = "show"
 
+# Initial scan pipeline tuning
+parse_workers = int(os.environ.get('PRODUCER_PARSE_WORKERS', os.cpu_count() or 1))
+parse_chunk_size = int(os.environ.get('PRODUCER_PARSE_CHUNK_SIZE', '32'))
+tmdb_concurrency = int(os.environ.get('TMDB_CONCURRENCY', '4'))
+tmdb_rate_limit = float(os.environ.get('TMDB_RATE_LIMIT', '30'))
+write_batch_size = int(os.environ.get('PRODUCER_WRITE_BATCH_SIZE', '500'))
+write_flush_interval = int(os.environ.get('PRODUCER_WRITE_FLUSH_MS', '500')) / 1000.0
+progress_interval = float(os.environ.get('PRODUCER_PROGRESS_INTERVAL', '10'))
+# Port of the /metrics listener, 0 to disable
+metrics_port = int(os.environ.get('PRODUCER_METRICS_PORT', '7991'))
+
+# FS event coalescing: a file is only ingested once its size and mtime have
+# not changed for watch_quiet_period seconds
+watch_quiet_period = int(os.environ.get('PRODUCER_WATCH_QUIET_MS', '2000')) / 1000.0
+watch_poll_interval = int(os.environ.get('PRODUCER_WATCH_POLL_MS', '500')) / 1000.0
+watch_batch_size = int(os.environ.get('PRODUCER_WATCH_BATCH_SIZE', '500'))
+
+# Stat data of every indexed file, used to skip unchanged files on restart
+manifest_table_name = "manifest"
+
+# Small key/value table; data_version is bumped on every commit that changes
+# the nzbs table so readers can tell when their cached results are stale
+meta_table_name = "meta"
+
+# FTS5 index over the searchable names, kept in sync with nzbs by triggers
+fts_table_name = "nzbs_fts"
+
+# One row per (nzb, episode) so multi-episode releases match each of their episodes
+episodes_table_name = "nzb_episodes"
+
+# TMDB lookup cache
+tmdb_cache_table_name = "tmdb_cache"
+tmdb_cache_size = int(os.environ.get('TMDB_CACHE_SIZE', '10000'))
+tmdb_cache_ttl = int(os.environ.get('TMDB_CACHE_TTL', str(30 * 24 * 3600)))
+tmdb_negative_cache_ttl = int(os.environ.get('TMDB_NEGATIVE_CACHE_TTL', str(24 * 3600)))
+
+# Local copy of TMDB loaded by `producer.py import-tmdb`, and the normalized
+# titles it is matched on
+tmdb_titles_table_name = "tmdb_titles"
+tmdb_names_table_name = "tmdb_title_names"
+tmdb_import_batch_size = 10000
+
+# Background retry of rows indexed without their external ids (see
+# EnrichWorker); creating the pause file pauses it, removing it resumes
+enrich_retry_table_name = "enrich_retry"
+# The rows it retries: no IMDB id, or a show without its TVDB id. Queries
+# must use this exact expression to be served by the partial index on it.
+unresolved_condition = f"(imdb_id IS NULL OR (mtype = '{MTYPE_SHOW}' AND tvdb_id IS NULL))"
+enrich_enabled = os.environ.get('PRODUCER_ENRICH_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+enrich_interval = float(os.environ.get('PRODUCER_ENRICH_INTERVAL', '600'))
+enrich_batch_size = int(os.environ.get('PRODUCER_ENRICH_BATCH_SIZE', '200'))
+enrich_rate = float(os.environ.get('PRODUCER_ENRICH_RATE', '2'))
+enrich_backoff = int(os.environ.get('PRODUCER_ENRICH_BACKOFF', str(3600)))
+enrich_backoff_max = int(os.environ.get('PRODUCER_ENRICH_BACKOFF_MAX', str(7 * 24 * 3600)))
+enrich_pause_file = os.environ.get('PRODUCER_ENRICH_PAUSE_FILE', os.path.join(config_dir, 'enrich.pause'))
+
 tmdb = themoviedb.TMDb(key=os.environ.get('TMDB_KEY'), language="en-US", region="US")
 
+metrics_registry = metrics.Registry()
+ingest_files = metrics_registry.counter(
+  "producer_ingest_files_total", "Files through each ingest stage", ("stage",))
+parse_seconds = metrics_registry.histogram("producer_parse_seconds", "Time to parse one nzb")
+scan_seconds = metrics_registry.histogram("producer_scan_seconds", "Time to walk NZBS_DIR")
+files_on_disk = metrics_registry.gauge("producer_files_on_disk", "Nzbs found by the last scan")
+tmdb_request_seconds = metrics_registry.histogram(
+  "producer_tmdb_request_seconds", "TMDB API call latency", ("call",))
+tmdb_errors = metrics_registry.counter("producer_tmdb_errors_total", "Failed TMDB API calls", ("call",))
+tmdb_offline_lookups = metrics_registry.counter(
+  "producer_tmdb_offline_lookups_total", "Title lookups against the imported TMDB dataset", ("result",))
+write_batch_seconds = metrics_registry.histogram("producer_write_batch_seconds", "Time to commit a writer batch")
+write_ops = metrics_registry.counter("producer_write_ops_total", "Changes applied by the writer", ("op",))
+enrich_titles = metrics_registry.counter(
+  "producer_enrich_titles_total", "Titles retried by the re-enrichment worker", ("result",))
+unresolved_nzbs = metrics_registry.gauge(
+  "producer_unresolved_nzbs", "Indexed nzbs without an IMDB id, or shows without a TVDB id")
+
 
 class NZB(object):
 
@@ -41,8 +135,9 @@ class NZB(object):
 
   def new_from(
     self, filename, name, mtype, raw_size, title, year, tmdb_year, season, episode,
-      tmdb_id, tmdb_original_name, tmdb_name, tmdb_release_date, imdb_id):
+      tmdb_id, tmdb_original_name, tmdb_name, tmdb_release_date, imdb_id, path=None, tvdb_id=None):
     self.filename = filename
+    self.path = path
     self.name = name
     self.mtype = mtype
     self.raw_size = raw_size
@@ -56,30 +151,59 @@ class NZB(object):
     self.tmdb_name = tmdb_name
     self.tmdb_release_date = tmdb_release_date
     self.imdb_id = imdb_id
+    self.tvdb_id = tvdb_id
 
 
 class NzbEventHandler(FileSystemEventHandler):
+  """Forwards FS events to the coalescer; nothing is parsed on the observer thread."""
 
-    def on_created(self, event):
-        logger.info(f"File '{event.src_path}' created!")
-        if event.is_directory:
-          logger.debug("Path is a directory. Skipping...")
-          return
-        if not event.src_path.endswith('.nzb'):
-          logger.debug("Not a .nzb file. Skipping.")
-          return
-        process_single_nzb(event.src_path)
+  def __init__(self, coalescer):
+    super().__init__()
+    self.coalescer = coalescer
 
+  def on_created(self, event):
+    logger.debug("'%s' created", event.src_path)
+    self.coalescer.touch(event.src_path, event.is_directory)
 
-def create_db_and_table():
-  # Connect to the database (creates it if it doesn't exist)
-  conn = sqlite3.connect(db_path)
-  logger.info("Creating database..")
-  cursor = conn.cursor()
+  def on_modified(self, event):
+    if not event.is_directory:
+      self.coalescer.touch(event.src_path, False)
+
+  def on_moved(self, event):
+    logger.debug("'%s' moved to '%s'", event.src_path, event.dest_path)
+    self.coalescer.forget(event.src_path, event.is_directory)
+    self.coalescer.touch(event.dest_path, event.is_directory)
+
+  def on_deleted(self, event):
+    logger.debug("'%s' deleted", event.src_path)
+    self.coalescer.forget(event.src_path, event.is_directory)
+
+
+def connect_db():
+  conn = sqlite3.connect(db_path, timeout=30)
+  # WAL (enabled once in create_db_and_table) only needs a full fsync at checkpoints
+  conn.execute("PRAGMA synchronous = NORMAL")
+  return conn
 
+
+db_local = threading.local()
+
+
+# Long-lived per-thread connection for the producer's own reads. All writes
+# go through the NzbWriter thread instead.
+def read_db():
+  conn = getattr(db_local, 'conn', None)
+  if conn is None:
+    conn = db_local.conn = connect_db()
+  return conn
+
+
+# Each migration upgrades the schema by one version; PRAGMA user_version
+# records how many have been applied. Migrations are written to be safe on
+# databases that predate the versioning and already have some of the tables.
+def migration_create_nzbs(cursor):
   logger.info("Creating table nzbs..")
-  # Create the nzbs table (if it doesn't exist)
-  create_table_query = f"""
+  cursor.execute(f"""
   CREATE TABLE IF NOT EXISTS {table_name} (
       id INTEGER PRIMARY KEY AUTOINCREMENT,
       filename TEXT NOT NULL,
@@ -97,163 +221,1530 @@ def create_db_and_table():
       tmdb_release_date TEXT,
       imdb_id TEXT
   );
-  """
-  cursor.execute(create_table_query)
-  conn.commit()
+  """)
+
+
+def migration_add_path(cursor):
+  columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table_name})")]
+  if 'path' not in columns:
+    logger.info("Adding path column to table nzbs..")
+    cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN path TEXT")
+  cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{table_name}_path ON {table_name} (path)")
+  cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_filename ON {table_name} (filename)")
+
+
+def migration_create_tmdb_cache(cursor):
+  logger.info("Creating table tmdb_cache..")
+  # Resolved TMDB metadata per (mtype, normalized title, year); a NULL
+  # tmdb_id records that the search found no match.
+  cursor.execute(f"""
+  CREATE TABLE IF NOT EXISTS {tmdb_cache_table_name} (
+      mtype TEXT NOT NULL,
+      title TEXT NOT NULL,
+      year INTEGER NOT NULL,
+      tmdb_id INTEGER,
+      tmdb_original_name TEXT,
+      tmdb_name TEXT,
+      tmdb_release_date TEXT,
+      tmdb_year INTEGER,
+      imdb_id TEXT,
+      fetched_at INTEGER NOT NULL,
+      PRIMARY KEY (mtype, title, year)
+  );
+  """)
+
+
+def migration_create_manifest(cursor):
+  logger.info("Creating table manifest..")
+  cursor.execute(f"""
+  CREATE TABLE IF NOT EXISTS {manifest_table_name} (
+      path TEXT PRIMARY KEY,
+      size INTEGER NOT NULL,
+      mtime_ns INTEGER NOT NULL,
+      inode INTEGER NOT NULL
+  );
+  """)
+
+
+def migration_add_search_indexes(cursor):
+  logger.info("Creating search indexes..")
+  # Older versions could insert the same nzb twice; keep the first copy so
+  # the unique index can be built.
+  cursor.execute(f"""
+  DELETE FROM {table_name} WHERE id NOT IN (
+      SELECT MIN(id) FROM {table_name} GROUP BY filename, raw_size)
+  """)
+  logger.info("Removed %d duplicate rows", cursor.rowcount)
+  # The (filename, raw_size) index also serves filename-only lookups
+  cursor.execute(f"DROP INDEX IF EXISTS idx_{table_name}_filename")
+  cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{table_name}_filename_raw_size ON {table_name} (filename, raw_size)")
+  cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_mtype_imdb_season ON {table_name} (mtype, imdb_id, season)")
+  cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_mtype_tmdb_name ON {table_name} (mtype, lower(tmdb_name))")
+
+
+def migration_create_meta(cursor):
+  logger.info("Creating table meta..")
+  cursor.execute(f"""
+  CREATE TABLE IF NOT EXISTS {meta_table_name} (
+      key TEXT PRIMARY KEY,
+      value INTEGER NOT NULL
+  );
+  """)
+  cursor.execute(f"INSERT OR IGNORE INTO {meta_table_name} (key, value) VALUES ('data_version', 0)")
+
+
+def migration_create_fts(cursor):
+  logger.info("Creating full-text index nzbs_fts..")
+  fts_columns = "name, title, tmdb_name, tmdb_original_name"
+  new_values = "new.name, new.title, new.tmdb_name, new.tmdb_original_name"
+  old_values = "old.name, old.title, old.tmdb_name, old.tmdb_original_name"
+  cursor.execute(f"""
+  CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table_name} USING fts5(
+      {fts_columns}, content='{table_name}', content_rowid='id',
+      tokenize='unicode61 remove_diacritics 2'
+  );
+  """)
+  cursor.execute(f"""
+  CREATE TRIGGER IF NOT EXISTS {fts_table_name}_insert AFTER INSERT ON {table_name} BEGIN
+      INSERT INTO {fts_table_name} (rowid, {fts_columns}) VALUES (new.id, {new_values});
+  END;
+  """)
+  cursor.execute(f"""
+  CREATE TRIGGER IF NOT EXISTS {fts_table_name}_delete AFTER DELETE ON {table_name} BEGIN
+      INSERT INTO {fts_table_name} ({fts_table_name}, rowid, {fts_columns}) VALUES ('delete', old.id, {old_values});
+  END;
+  """)
+  cursor.execute(f"""
+  CREATE TRIGGER IF NOT EXISTS {fts_table_name}_update AFTER UPDATE OF {fts_columns} ON {table_name} BEGIN
+      INSERT INTO {fts_table_name} ({fts_table_name}, rowid, {fts_columns}) VALUES ('delete', old.id, {old_values});
+      INSERT INTO {fts_table_name} (rowid, {fts_columns}) VALUES (new.id, {new_values});
+  END;
+  """)
+  # Index the rows that existed before the triggers
+  cursor.execute(f"INSERT INTO {fts_table_name} ({fts_table_name}) VALUES ('rebuild')")
+
+
+def migration_add_name_index(cursor):
+  # Used by the blackhole to resolve a dropped nzb without crawling the mount
+  cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_name_raw_size ON {table_name} (name, raw_size)")
+
+
+def migration_add_search_covering_index(cursor):
+  # Holds every column the indexer renders for an IMDB search, so those
+  # searches are answered from the index alone and never touch the table.
+  # It replaces the (mtype, imdb_id, season) index, which is its prefix.
+  logger.info("Creating covering search index..")
+  cursor.execute(f"""
+  CREATE INDEX IF NOT EXISTS idx_{table_name}_search_cover
+  ON {table_name} (mtype, imdb_id, season, name, filename, raw_size, episode)
+  """)
+  cursor.execute(f"DROP INDEX IF EXISTS idx_{table_name}_mtype_imdb_season")
+
+
+def migration_add_added_at(cursor):
+  columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table_name})")]
+  if 'added_at' not in columns:
+    logger.info("Adding added_at column to table nzbs..")
+    cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN added_at INTEGER NOT NULL DEFAULT 0")
+  # Existing rows get their file's mtime, or now if the manifest has no entry
+  cursor.execute(f"""
+  UPDATE {table_name} SET added_at = COALESCE(
+    (SELECT {manifest_table_name}.mtime_ns / 1000000000 FROM {manifest_table_name}
+     WHERE {manifest_table_name}.path = {table_name}.path),
+    CAST(strftime('%s', 'now') AS INTEGER))
+  WHERE added_at = 0
+  """)
+  logger.info("Backfilled added_at for %d rows", cursor.rowcount)
+  # Serves the feed newest-first by (added_at, id), a page at a time
+  cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_mtype_added_at ON {table_name} (mtype, added_at)")
+  # The covering search index also has to hold added_at, which is rendered as pubDate
+  cursor.execute(f"DROP INDEX IF EXISTS idx_{table_name}_search_cover")
+  cursor.execute(f"""
+  CREATE INDEX idx_{table_name}_search_cover
+  ON {table_name} (mtype, imdb_id, season, name, filename, raw_size, episode, added_at)
+  """)
+
+
+def migration_add_external_ids_and_episodes(cursor):
+  for table in (table_name, tmdb_cache_table_name):
+    columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]
+    if 'tvdb_id' not in columns:
+      logger.info("Adding tvdb_id column to table %s..", table)
+      cursor.execute(f"ALTER TABLE {table} ADD COLUMN tvdb_id INTEGER")
+  # Cached shows were resolved without their TVDB id; let them be looked up again
+  cursor.execute(f"""
+  UPDATE {tmdb_cache_table_name} SET fetched_at = 0 WHERE mtype = 'show' AND tmdb_id IS NOT NULL
+  """)
+  cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_mtype_tmdb_season ON {table_name} (mtype, tmdb_id, season)")
+  cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_mtype_tvdb_season ON {table_name} (mtype, tvdb_id, season)")
+
+  logger.info("Creating table %s..", episodes_table_name)
+  cursor.execute(f"""
+  CREATE TABLE IF NOT EXISTS {episodes_table_name} (
+      nzb_id INTEGER NOT NULL,
+      episode INTEGER NOT NULL,
+      PRIMARY KEY (nzb_id, episode)
+  ) WITHOUT ROWID;
+  """)
+  cursor.execute(f"""
+  CREATE TRIGGER IF NOT EXISTS {episodes_table_name}_delete AFTER DELETE ON {table_name} BEGIN
+      DELETE FROM {episodes_table_name} WHERE nzb_id = old.id;
+  END;
+  """)
+  rows = cursor.execute(f"SELECT id, episode FROM {table_name} WHERE episode IS NOT NULL").fetchall()
+  cursor.executemany(f"INSERT OR IGNORE INTO {episodes_table_name} (nzb_id, episode) VALUES (?, ?)",
+                     [(nzb_id, number) for nzb_id, episode in rows for number in episodes.episode_numbers(episode)])
+  logger.info("Mapped episodes of %d rows", len(rows))
+
+
+def migration_create_tmdb_titles(cursor):
+  logger.info("Creating tables %s and %s..", tmdb_titles_table_name, tmdb_names_table_name)
+  # `detailed` marks rows with the details file's fields; rows only seen in
+  # the id exports have just their original title and popularity
+  cursor.execute(f"""
+  CREATE TABLE IF NOT EXISTS {tmdb_titles_table_name} (
+      mtype TEXT NOT NULL,
+      tmdb_id INTEGER NOT NULL,
+      title TEXT,
+      original_title TEXT,
+      release_date TEXT,
+      year INTEGER,
+      imdb_id TEXT,
+      tvdb_id INTEGER,
+      popularity REAL,
+      detailed INTEGER NOT NULL DEFAULT 0,
+      PRIMARY KEY (mtype, tmdb_id)
+  ) WITHOUT ROWID;
+  """)
+  cursor.execute(f"""
+  CREATE TABLE IF NOT EXISTS {tmdb_names_table_name} (
+      mtype TEXT NOT NULL,
+      title TEXT NOT NULL,
+      tmdb_id INTEGER NOT NULL,
+      PRIMARY KEY (mtype, title, tmdb_id)
+  ) WITHOUT ROWID;
+  """)
+
+
+def migration_create_enrich_retry(cursor):
+  logger.info("Creating table %s..", enrich_retry_table_name)
+  # Only rows without an IMDB id are in the index, so finding the titles to
+  # retry costs as much as there are unresolved rows, not the whole table
+  cursor.execute(f"""
+  CREATE INDEX IF NOT EXISTS idx_{table_name}_unresolved
+  ON {table_name} (mtype, title, year) WHERE imdb_id IS NULL
+  """)
+  # Retry state per (mtype, title, year) group of nzbs; year is 0 when the
+  # release name has none
+  cursor.execute(f"""
+  CREATE TABLE IF NOT EXISTS {enrich_retry_table_name} (
+      mtype TEXT NOT NULL,
+      title TEXT NOT NULL,
+      year INTEGER NOT NULL,
+      attempts INTEGER NOT NULL,
+      next_attempt_at INTEGER NOT NULL,
+      last_error TEXT,
+      PRIMARY KEY (mtype, title, year)
+  ) WITHOUT ROWID;
+  """)
+
+
+def migration_add_unresolved_shows_index(cursor):
+  # Shows indexed before tvdb_id existed have none; widening the index to
+  # them has the enrich worker look them up again and fill it in
+  logger.info("Recreating index idx_%s_unresolved..", table_name)
+  cursor.execute(f"DROP INDEX IF EXISTS idx_{table_name}_unresolved")
+  cursor.execute(f"""
+  CREATE INDEX idx_{table_name}_unresolved
+  ON {table_name} (mtype, title, year) WHERE {unresolved_condition}
+  """)
+
+
+def migration_drop_tmdb_name_index(cursor):
+  # Title searches go through nzbs_fts; nothing looks nzbs up by tmdb_name,
+  # so the index only cost space and a write per insert
+  logger.info("Dropping index idx_%s_mtype_tmdb_name..", table_name)
+  cursor.execute(f"DROP INDEX IF EXISTS idx_{table_name}_mtype_tmdb_name")
+
+
+MIGRATIONS = [
+  migration_create_nzbs,
+  migration_add_path,
+  migration_create_tmdb_cache,
+  migration_create_manifest,
+  migration_add_search_indexes,
+  migration_create_meta,
+  migration_create_fts,
+  migration_add_name_index,
+  migration_add_search_covering_index,
+  migration_add_added_at,
+  migration_add_external_ids_and_episodes,
+  migration_create_tmdb_titles,
+  migration_create_enrich_retry,
+  migration_add_unresolved_shows_index,
+  migration_drop_tmdb_name_index,
+]
+
+
+def migrate_db(conn):
+  cursor = conn.cursor()
+  version = cursor.execute("PRAGMA user_version").fetchone()[0]
+  if version > len(MIGRATIONS):
+    raise RuntimeError(f"Database schema version {version} is newer than this producer ({len(MIGRATIONS)})")
+  for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+    logger.info("Applying schema migration %d (%s)..", number, migration.__name__)
+    cursor.execute("BEGIN")
+    try:
+      migration(cursor)
+      cursor.execute(f"PRAGMA user_version = {number}")
+      cursor.execute("COMMIT")
+    except Exception:
+      cursor.execute("ROLLBACK")
+      raise
+
+
+# The access paths the indexer and the producer rely on. Each must be served
+# by an index; check_query_plans() complains if one falls back to a scan.
+# It plans against an empty in-memory copy of the schema, so the result does
+# not depend on the size or statistics of the live database.
+INDEXED_QUERIES = [
+  (f"SELECT * FROM {table_name} WHERE mtype = ? AND imdb_id = ? AND season = ?", ("show", "tt0000000", 1)),
+  (f"SELECT * FROM {table_name} WHERE mtype = ? AND imdb_id = ?", ("movie", "tt0000000")),
+  (f"SELECT * FROM {table_name} WHERE mtype = ? AND tmdb_id = ? AND season = ?", ("show", 0, 1)),
+  (f"SELECT * FROM {table_name} WHERE mtype = ? AND tvdb_id = ? AND season = ?", ("show", 0, 1)),
+  (f"SELECT * FROM {table_name} WHERE mtype = ? AND tmdb_id = ?", ("movie", 0)),
+  (f"SELECT COUNT(*) FROM {table_name} WHERE filename = ? AND raw_size = ?", ("file.nzb", 0)),
+  (f"SELECT path FROM {table_name} WHERE filename = ? AND path IS NOT NULL LIMIT 1", ("file.nzb",)),
+  (f"SELECT path FROM {table_name} WHERE name = ? AND raw_size = ? AND path IS NOT NULL", ("name", 0)),
+  (f"SELECT {table_name}.* FROM {fts_table_name} JOIN {table_name} ON {table_name}.id = {fts_table_name}.rowid "
+   f"WHERE {fts_table_name} MATCH ? AND +{table_name}.mtype = ?", ('"title"*', "show")),
+  (f"SELECT * FROM {table_name} WHERE mtype = ? AND (added_at, id) < (?, ?) ORDER BY added_at DESC, id DESC LIMIT 100",
+   ("show", 0, 0)),
+  (f"SELECT id FROM {table_name} WHERE mtype = ? AND title = ? AND COALESCE(year, 0) = ? AND {unresolved_condition}",
+   ("show", "title", 0)),
+]
+
+# The indexer's IMDB searches, which must not need the table at all, nor a
+# sort for their order; an episode filter only adds a primary key probe of
+# the episodes table
+COVERED_QUERIES = [
+  (f"SELECT name, filename, raw_size, season, episode, added_at, id FROM {table_name} "
+   f"WHERE mtype = ? AND imdb_id = ? AND season = ? ORDER BY season, name, filename", ("show", "tt0000000", 1)),
+  (f"SELECT name, filename, raw_size, season, episode, added_at, id FROM {table_name} "
+   f"WHERE mtype = ? AND imdb_id = ? ORDER BY season, name, filename", ("movie", "tt0000000")),
+  (f"SELECT name, filename, raw_size, season, episode, added_at, id FROM {table_name} "
+   f"WHERE mtype = ? AND imdb_id = ? AND season = ? AND EXISTS (SELECT 1 FROM {episodes_table_name} "
+   f"WHERE nzb_id = {table_name}.id AND episode = ?) ORDER BY season, name, filename", ("show", "tt0000000", 1, 1)),
+]
+
+
+def check_query_plans(live_conn):
+  conn = sqlite3.connect(":memory:")
+  # FTS shadow tables are created by their virtual table, so they are skipped
+  schema = live_conn.execute(f"""
+    SELECT sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'
+    AND NOT (type = 'table' AND name LIKE '{fts_table_name}_%')""").fetchall()
+  for (sql,) in schema:
+    conn.execute(sql)
+  cursor = conn.cursor()
+  ok = True
+  for query, params in INDEXED_QUERIES:
+    plan = [row[3] for row in cursor.execute(f"EXPLAIN QUERY PLAN {query}", params)]
+    if any(step.split(" ")[:2] == ["SCAN", table_name] for step in plan):
+      logger.warning("Query does a full table scan: %s (plan: %s)", query, "; ".join(plan))
+      ok = False
+  for query, params in COVERED_QUERIES:
+    plan = [row[3] for row in cursor.execute(f"EXPLAIN QUERY PLAN {query}", params)]
+    if not any("COVERING INDEX" in step for step in plan) or any("TEMP B-TREE" in step for step in plan):
+      logger.warning("Query is not served by a covering index in its order: %s (plan: %s)", query, "; ".join(plan))
+      ok = False
+  conn.close()
+  return ok
+
+
+def create_db_and_table():
+  # Connect to the database (creates it if it doesn't exist)
+  conn = connect_db()
+  logger.info("Creating database..")
+  # Lets the indexer keep reading while the producer commits; the setting is
+  # persistent, so readers pick it up without doing anything themselves.
+  conn.execute("PRAGMA journal_mode = WAL")
+  migrate_db(conn)
+  check_query_plans(conn)
+  conn.execute("PRAGMA optimize")
   logger.info("Done..")
   conn.close()
 
 
 # Function to check if NZB exists by filename and raw_size
 def nzb_exists(filename, raw_size):
-  with sqlite3.connect(db_path) as conn:
-    cursor = conn.cursor()
-    check_query = f"""
-    SELECT COUNT(*) FROM {table_name} WHERE filename = ? AND raw_size = ?
+  cursor = read_db().cursor()
+  check_query = f"""
+  SELECT COUNT(*) FROM {table_name} WHERE filename = ? AND raw_size = ?
+  """
+  cursor.execute(check_query, (filename, raw_size))
+  count = cursor.fetchone()[0]
+  return count > 0
+
+
+insert_nzb_query = f"""
+INSERT OR IGNORE INTO {table_name} (filename, name, mtype, raw_size, title, year, tmdb_year, season, episode, tmdb_id, tmdb_original_name, tmdb_name, tmdb_release_date, imdb_id, path, added_at, tvdb_id)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+insert_episodes_query = f"""
+INSERT OR IGNORE INTO {episodes_table_name} (nzb_id, episode)
+SELECT id, ? FROM {table_name} WHERE filename = ? AND raw_size = ?
+"""
+
+backfill_path_query = f"""
+UPDATE {table_name} SET path = ? WHERE filename = ? AND raw_size = ? AND path IS NULL
+"""
+
+
+upsert_manifest_query = f"""
+INSERT OR REPLACE INTO {manifest_table_name} (path, size, mtime_ns, inode) VALUES (?, ?, ?, ?)
+"""
+
+
+def manifest_row(nzbo):
+  return (nzbo.path,) + nzbo.file_stat
+
+
+# Returns {relative path: (size, mtime_ns, inode)} for every indexed file
+def load_manifest():
+  cursor = read_db().cursor()
+  cursor.execute(f"SELECT path, size, mtime_ns, inode FROM {manifest_table_name}")
+  return {row[0]: row[1:] for row in cursor}
+
+
+bump_data_version_query = f"""
+UPDATE {meta_table_name} SET value = value + 1 WHERE key = 'data_version'
+"""
+
+
+upsert_tmdb_cache_query = f"""
+INSERT OR REPLACE INTO {tmdb_cache_table_name}
+(mtype, title, year, tmdb_id, tmdb_original_name, tmdb_name, tmdb_release_date, tmdb_year, imdb_id, tvdb_id, fetched_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+# Rows that already have an IMDB id only take a missing TVDB id, and only
+# from the same TMDB entry. Rows the result would not change are left
+# alone, so a retry that finds nothing new does not invalidate readers.
+enrich_nzbs_query = f"""
+UPDATE {table_name}
+SET tmdb_id = ?, tmdb_original_name = ?, tmdb_name = ?, tmdb_release_date = ?, tmdb_year = ?,
+    imdb_id = COALESCE(?, imdb_id), tvdb_id = COALESCE(?, tvdb_id)
+WHERE mtype = ? AND title = ? AND COALESCE(year, 0) = ? AND {unresolved_condition}
+AND (imdb_id IS NULL OR tmdb_id = ?)
+AND (tmdb_id IS NOT ? OR (? IS NOT NULL AND imdb_id IS NULL) OR (? IS NOT NULL AND tvdb_id IS NULL))
+"""
+
+
+def enrich_row(key, metadata):
+  tmdb_id, imdb_id, tvdb_id = metadata[0], metadata[5], metadata[6]
+  return tuple(metadata) + key + (tmdb_id, tmdb_id, imdb_id, tvdb_id)
+
+
+# Whether metadata has every external id the indexer searches rows of mtype by
+def enrich_complete(mtype, metadata):
+  return metadata is not None and metadata[5] is not None and (mtype != MTYPE_SHOW or metadata[6] is not None)
+
+upsert_enrich_retry_query = f"""
+INSERT OR REPLACE INTO {enrich_retry_table_name} (mtype, title, year, attempts, next_attempt_at, last_error)
+VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+delete_enrich_retry_query = f"""
+DELETE FROM {enrich_retry_table_name} WHERE mtype = ? AND title = ? AND year = ?
+"""
+
+
+def nzb_row(nzbo):
+  return (nzbo.filename, nzbo.name, nzbo.mtype, nzbo.raw_size,
+          nzbo.title, nzbo.year, nzbo.tmdb_year, nzbo.season,
+          nzbo.episode, nzbo.tmdb_id, nzbo.tmdb_original_name,
+          nzbo.tmdb_name, nzbo.tmdb_release_date, nzbo.imdb_id,
+          nzbo.path, nzbo.added_at, nzbo.tvdb_id)
+
+
+class RateLimiter(object):
+  """Spaces out calls so that at most `rate` of them start per second."""
+
+  def __init__(self, rate):
+    self.interval = 1.0 / rate if rate > 0 else 0
+    self.next_slot = 0
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    if not self.interval:
+      return
+    with self.lock:
+      now = time.monotonic()
+      wait = self.next_slot - now
+      self.next_slot = max(now, self.next_slot) + self.interval
+    if wait > 0:
+      time.sleep(wait)
+
+
+tmdb_rate_limiter = RateLimiter(tmdb_rate_limit)
+
+
+def normalize_title(title):
+  return " ".join(re.sub(r"[\W_]+", " ", title.lower()).split())
+
+
+class TmdbCache(object):
+  """
+  Two-tier cache of TMDB lookups: an in-memory LRU in front of the
+  tmdb_cache table. Values are the resolved metadata tuple, or None when
+  TMDB had no match; misses expire after their own (shorter) TTL.
+  """
+
+  def __init__(self, max_size, ttl, negative_ttl):
+    self.max_size = max_size
+    self.ttl = ttl
+    self.negative_ttl = negative_ttl
+    self.entries = OrderedDict()
+    self.in_flight = {}
+    self.lock = threading.Lock()
+    self.memory_hits = 0
+    self.db_hits = 0
+    self.misses = 0
+
+  def is_fresh(self, metadata, fetched_at):
+    ttl = self.ttl if metadata is not None else self.negative_ttl
+    return time.time() - fetched_at < ttl
+
+  def remember(self, key, metadata, fetched_at):
+    with self.lock:
+      self.entries[key] = (metadata, fetched_at)
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.max_size:
+        self.entries.popitem(last=False)
+
+  def get_from_memory(self, key):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        return False, None
+      if not self.is_fresh(*entry):
+        del self.entries[key]
+        return False, None
+      self.entries.move_to_end(key)
+      self.memory_hits += 1
+      return True, entry[0]
+
+  def get_from_db(self, key):
+    cursor = read_db().cursor()
+    cursor.execute(f"""
+    SELECT tmdb_id, tmdb_original_name, tmdb_name, tmdb_release_date, tmdb_year, imdb_id, tvdb_id, fetched_at
+    FROM {tmdb_cache_table_name} WHERE mtype = ? AND title = ? AND year = ?
+    """, key)
+    row = cursor.fetchone()
+    if row is None:
+      return False, None
+    metadata = row[:7] if row[0] is not None else None
+    if not self.is_fresh(metadata, row[7]):
+      return False, None
+    self.remember(key, metadata, row[7])
+    with self.lock:
+      self.db_hits += 1
+    return True, metadata
+
+  def put(self, key, metadata):
+    fetched_at = int(time.time())
+    self.remember(key, metadata, fetched_at)
+    values = metadata if metadata is not None else (None,) * 7
+    get_writer().cache_tmdb(key + tuple(values) + (fetched_at,))
+
+  def get_or_load(self, key, loader, retry_misses=False):
     """
-    cursor.execute(check_query, (filename, raw_size))
-    count = cursor.fetchone()[0]
-    return count > 0
-
-
-# Function to add a new entry
-def add_nzb(nzbo):
-  if not nzb_exists(nzbo.filename, nzbo.raw_size):
-    with sqlite3.connect(db_path) as conn:
-      cursor = conn.cursor()
-      insert_query = f"""
-      INSERT INTO {table_name} (filename, name, mtype, raw_size, title, year, tmdb_year, season, episode, tmdb_id, tmdb_original_name, tmdb_name, tmdb_release_date, imdb_id)
-      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-      """
-      cursor.execute(insert_query,
-                     (nzbo.filename, nzbo.name, nzbo.mtype, nzbo.raw_size,
-                      nzbo.title, nzbo.year, nzbo.tmdb_year, nzbo.season,
-                      nzbo.episode, nzbo.tmdb_id, nzbo.tmdb_original_name,
-                      nzbo.tmdb_name, nzbo.tmdb_release_date, nzbo.imdb_id))
-      conn.commit()
-      logger.info(f"NZB '{nzbo.filename}' added successfully!")
-  else:
-    logger.info(f"NZB with filename '{nzbo.filename}' and raw_size {nzbo.raw_size} already exists.")
+    Returns the cached metadata for key, calling loader() on a miss. Threads
+    asking for the same key while it is being loaded wait for that result
+    instead of issuing their own request. With retry_misses, a cached "no
+    match" is looked up again as well.
+    """
+    while True:
+      hit, metadata = self.get_from_memory(key)
+      if hit and (metadata is not None or not retry_misses):
+        return metadata
+      with self.lock:
+        pending = self.in_flight.get(key)
+        if pending is None:
+          pending = self.in_flight[key] = threading.Event()
+          break
+      pending.wait()
+
+    try:
+      hit, metadata = self.get_from_db(key)
+      if hit and (metadata is not None or not retry_misses):
+        return metadata
+      with self.lock:
+        self.misses += 1
+      metadata = loader()
+      self.put(key, metadata)
+      return metadata
+    finally:
+      with self.lock:
+        del self.in_flight[key]
+      pending.set()
+
+  def summary(self):
+    with self.lock:
+      hits = self.memory_hits + self.db_hits
+      total = hits + self.misses
+      return "tmdb cache hits=%d (memory=%d, db=%d) misses=%d hit_ratio=%.2f" % (
+        hits, self.memory_hits, self.db_hits, self.misses, hits / total if total else 0)
+
 
+tmdb_cache = TmdbCache(tmdb_cache_size, tmdb_cache_ttl, tmdb_negative_cache_ttl)
+metrics_registry.counter(
+  "producer_tmdb_cache_lookups_total", "TMDB cache lookups by result", ("result",),
+  collect=lambda: {("memory_hit",): tmdb_cache.memory_hits, ("db_hit",): tmdb_cache.db_hits,
+                   ("miss",): tmdb_cache.misses})
+
+
+class OfflineTmdb(object):
+  """
+  Resolves titles against the TMDB dataset loaded by `producer.py
+  import-tmdb` before the API is asked. The normalized-title index is kept
+  in memory, one dict per type, and is reloaded when a new import has been
+  committed. The details of the matching ids are read from tmdb_titles by
+  primary key.
+  """
 
-# Returns relative paths (to NZBS_DIR)
+  def __init__(self):
+    self.titles = {}
+    self.import_version = None
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.partial = 0
+    self.misses = 0
+
+  def refresh(self):
+    row = read_db().execute(f"SELECT value FROM {meta_table_name} WHERE key = 'tmdb_import'").fetchone()
+    version = row[0] if row else None
+    if version == self.import_version:
+      return
+    started = time.perf_counter()
+    titles = {}
+    count = 0
+    for mtype, title, tmdb_id in read_db().execute(
+        f"SELECT mtype, title, tmdb_id FROM {tmdb_names_table_name}"):
+      by_title = titles.setdefault(mtype, {})
+      # A single id is stored bare, which most titles have
+      ids = by_title.get(title)
+      if ids is None:
+        by_title[title] = tmdb_id
+      elif isinstance(ids, tuple):
+        by_title[title] = ids + (tmdb_id,)
+      else:
+        by_title[title] = (ids, tmdb_id)
+      count += 1
+    with self.lock:
+      self.titles = titles
+      self.import_version = version
+    logger.info("Loaded offline TMDB index of %d titles (%d names) in %.2fs",
+                sum(len(by_title) for by_title in titles.values()), count, time.perf_counter() - started)
+
+  def match(self, mtype, title, year):
+    """
+    Returns (tmdb_id, metadata tuple) for the best offline match, with None
+    as the metadata when only the id is known, or None without a match.
+    Among several ids, one from the release's year (or a year either side)
+    wins, then the most popular one, which is what the API search puts first.
+    """
+    ids = self.titles.get(mtype, {}).get(normalize_title(title))
+    if ids is None:
+      self.count('misses')
+      return None
+    if not isinstance(ids, tuple):
+      ids = (ids,)
+    rows = read_db().execute(f"""
+    SELECT tmdb_id, original_title, title, release_date, year, imdb_id, tvdb_id, popularity, detailed
+    FROM {tmdb_titles_table_name} WHERE mtype = ? AND tmdb_id IN ({", ".join("?" * len(ids))})
+    """, (mtype,) + ids).fetchall()
+    if not rows:
+      self.count('misses')
+      return None
+
+    def rank(row):
+      distance = abs(row[4] - year) if year and row[4] else None
+      closeness = 0 if distance == 0 else 1 if distance == 1 else 2
+      return closeness, -(row[7] or 0)
+
+    best = min(rows, key=rank)
+    if not best[8]:
+      self.count('partial')
+      return best[0], None
+    self.count('hits')
+    return best[0], best[:7]
+
+  def count(self, result):
+    with self.lock:
+      setattr(self, result, getattr(self, result) + 1)
+    tmdb_offline_lookups.inc(result=result)
+
+  def summary(self):
+    with self.lock:
+      return "offline tmdb hits=%d partial=%d misses=%d" % (self.hits, self.partial, self.misses)
+
+
+offline_tmdb = OfflineTmdb()
+
+
+class IngestStats(object):
+  """Progress counters shared by the stages of an ingest run."""
+
+  def __init__(self, total):
+    self.total = total
+    self.parsed = 0
+    self.skipped = 0
+    self.looked_up = 0
+    self.written = 0
+    self.failed = 0
+    self.started = time.monotonic()
+    self.last_report = self.started
+    self.lock = threading.Lock()
+
+  def incr(self, counter, amount=1):
+    with self.lock:
+      setattr(self, counter, getattr(self, counter) + amount)
+    ingest_files.inc(amount, stage=counter)
+
+  def report(self, force=False):
+    now = time.monotonic()
+    with self.lock:
+      if not force and now - self.last_report < progress_interval:
+        return
+      self.last_report = now
+      done = self.skipped + self.written + self.failed
+      elapsed = max(now - self.started, 1e-6)
+      logger.info(
+        "Progress: %d/%d files done (parsed=%d, skipped=%d, tmdb=%d, written=%d, failed=%d), %.1f files/sec, %s, %s",
+        done, self.total, self.parsed, self.skipped, self.looked_up, self.written,
+        self.failed, done / elapsed, tmdb_cache.summary(), offline_tmdb.summary())
+
+
+class NzbWriter(threading.Thread):
+  """
+  The producer's single writer. It owns one long-lived connection and
+  applies queued changes in one transaction per batch, flushing every
+  batch_size changes or flush_interval seconds, whichever comes first.
+  """
+
+  ADD = 'add'
+  REMOVE = 'remove'
+  TMDB_CACHE = 'tmdb_cache'
+  ENRICH = 'enrich'
+  DEFER_ENRICH = 'defer_enrich'
+  SYNC = 'sync'
+
+  def __init__(self, batch_size, flush_interval):
+    super().__init__(name="nzb-writer", daemon=True)
+    self.batch_size = batch_size
+    self.flush_interval = flush_interval
+    self.queue = queue.Queue(maxsize=batch_size * 4)
+
+  def add(self, nzbo, stats=None):
+    self.queue.put((self.ADD, nzbo, stats))
+
+  def remove(self, path):
+    self.queue.put((self.REMOVE, path, None))
+
+  def cache_tmdb(self, row):
+    self.queue.put((self.TMDB_CACHE, row, None))
+
+  def enrich(self, key, metadata):
+    """Sets metadata on the unresolved rows of the (mtype, title, year) group key."""
+    self.queue.put((self.ENRICH, (key, metadata), None))
+
+  def defer_enrich(self, key, attempts, next_attempt_at, last_error):
+    self.queue.put((self.DEFER_ENRICH, key + (attempts, next_attempt_at, last_error), None))
+
+  def sync(self):
+    """Blocks until everything queued so far has been committed."""
+    done = threading.Event()
+    self.queue.put((self.SYNC, done, None))
+    done.wait()
+
+  def run(self):
+    conn = connect_db()
+    while True:
+      batch = [self.queue.get()]
+      deadline = time.monotonic() + self.flush_interval
+      while len(batch) < self.batch_size and batch[-1][0] != self.SYNC:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+          break
+        try:
+          batch.append(self.queue.get(timeout=remaining))
+        except queue.Empty:
+          break
+      self.flush(conn, batch)
+
+  def flush(self, conn, batch):
+    failed = False
+    started = time.perf_counter()
+    try:
+      with conn:
+        cursor = conn.cursor()
+        changed_rows = 0
+        # Apply runs of the same kind together, keeping removals and
+        # re-adds of the same path in order
+        for kind, ops in itertools.groupby(batch, key=lambda op: op[0]):
+          items = [op[1] for op in ops]
+          if kind == self.ADD:
+            cursor.executemany(insert_nzb_query, [nzb_row(nzbo) for nzbo in items])
+            changed_rows += cursor.rowcount
+            cursor.executemany(insert_episodes_query, [(number, nzbo.filename, nzbo.raw_size)
+                                                       for nzbo in items for number in nzbo.episodes])
+            # Rows indexed before the path column existed pick up their path here
+            cursor.executemany(backfill_path_query,
+                               [(nzbo.path, nzbo.filename, nzbo.raw_size) for nzbo in items])
+            cursor.executemany(upsert_manifest_query, [manifest_row(nzbo) for nzbo in items])
+          elif kind == self.REMOVE:
+            params = [(path,) for path in items]
+            cursor.executemany(f"DELETE FROM {table_name} WHERE path = ?", params)
+            changed_rows += cursor.rowcount
+            cursor.executemany(f"DELETE FROM {manifest_table_name} WHERE path = ?", params)
+          elif kind == self.TMDB_CACHE:
+            cursor.executemany(upsert_tmdb_cache_query, items)
+          elif kind == self.ENRICH:
+            cursor.executemany(enrich_nzbs_query, [enrich_row(key, metadata) for key, metadata in items])
+            changed_rows += cursor.rowcount
+            # A group that got all its ids is done; one without keeps backing off
+            cursor.executemany(delete_enrich_retry_query,
+                               [key for key, metadata in items if enrich_complete(key[0], metadata)])
+          elif kind == self.DEFER_ENRICH:
+            cursor.executemany(upsert_enrich_retry_query, items)
+        if changed_rows:
+          cursor.execute(bump_data_version_query)
+      logger.debug("Committed batch of %d changes", len(batch))
+    except Exception:
+      logger.exception("Failed to commit batch of %d changes", len(batch))
+      failed = True
+    write_batch_seconds.observe(time.perf_counter() - started)
+    if not failed:
+      for kind, ops in itertools.groupby(batch, key=lambda op: op[0]):
+        if kind != self.SYNC:
+          write_ops.inc(sum(1 for _ in ops), op=kind)
+
+    for kind, item, stats in batch:
+      if kind == self.SYNC:
+        item.set()
+      elif kind == self.ADD and stats is not None:
+        stats.incr('failed' if failed else 'skipped' if item.existing else 'written')
+
+
+nzb_writer = None
+nzb_writer_lock = threading.Lock()
+
+
+def get_writer():
+  global nzb_writer
+  with nzb_writer_lock:
+    if nzb_writer is None:
+      nzb_writer = NzbWriter(write_batch_size, write_flush_interval)
+      nzb_writer.start()
+    return nzb_writer
+
+
+metrics_registry.gauge("producer_write_queue_depth", "Changes waiting for the writer",
+                       collect=lambda: nzb_writer.queue.qsize() if nzb_writer is not None else 0)
+
+
+# Returns {relative path (to NZBS_DIR): (size, mtime_ns, inode)}
 def load_all_nzbs():
-  logger.info("Walking root dir for nzb files")
-  file_set = set()
-  for dir_, _, files in os.walk(nzbs_root_dir):
-    for file_name in files:
-      if file_name.endswith('.nzb'):
-        rel_dir = os.path.relpath(dir_, nzbs_root_dir)
-        rel_file = os.path.join(rel_dir, file_name)
-        file_set.add(rel_file)
-  logger.info("Found %d nzb files", len(file_set))
-  return file_set
-
-
-def process_single_nzb(file):
+  logger.info("Scanning root dir for nzb files")
+  files = {}
+  pending_dirs = [nzbs_root_dir]
+  while pending_dirs:
+    dir_ = pending_dirs.pop()
+    try:
+      with os.scandir(dir_) as entries:
+        for entry in entries:
+          if entry.is_dir(follow_symlinks=False):
+            pending_dirs.append(entry.path)
+          elif entry.name.endswith('.nzb') and entry.is_file():
+            st = entry.stat()
+            rel_file = os.path.relpath(entry.path, nzbs_root_dir)
+            files[rel_file] = (st.st_size, st.st_mtime_ns, st.st_ino)
+    except OSError as e:
+      logger.error("Failed to scan %s: %s", dir_, e)
+  logger.info("Found %d nzb files", len(files))
+  return files
+
+
+# Parses the nzb and its release name; everything except the TMDB lookup
+def build_nzb(file):
   filepath = file
   # Watchdog tracks absolute paths, so this is needed to handle that case.
   if not os.path.isabs(file):
     filepath = os.path.join(nzbs_root_dir, file)
 
   logger.debug("Processing file %s", filepath)
-  with open(filepath, 'rb') as f:
-    nzbo = NZB()
+  nzbo = NZB()
+  # Stat before parsing so a write that lands mid-parse shows up as a change
+  st = os.stat(filepath)
+  nzbo.file_stat = (st.st_size, st.st_mtime_ns, st.st_ino)
 
-    nzb_metadata = parse_nzb_metadata(filepath)
-    parsed_info = PTN.parse(nzb_metadata['name'])
+  nzb_metadata = nzbparse.parse_nzb_metadata(filepath)
+  parsed_info = PTN.parse(nzb_metadata['name'])
 
-    # Set basic metadata
-    nzbo.filename = nzb_metadata['filename']
-    nzbo.name = nzb_metadata['name']
-    nzbo.raw_size = nzb_metadata['raw_size']
-    nzbo.title = parsed_info['title']
+  # Set basic metadata
+  nzbo.filename = nzb_metadata['filename']
+  nzbo.name = nzb_metadata['name']
+  nzbo.raw_size = nzb_metadata['raw_size']
+  nzbo.title = parsed_info['title']
+  nzbo.path = os.path.relpath(filepath, nzbs_root_dir)
+  nzbo.existing = False
+  if gzip_eager:
+    try:
+      gzip_cache.get_or_build(nzbo.path, filepath, st)
+    except OSError as e:
+      logger.warning("Failed to compress %s: %s", filepath, e)
 
-    if nzb_exists(nzbo.filename, nzbo.raw_size):
-      logger.debug("Already exists in the table.. Skipping")
-      return
+  nzbo.mtype = MTYPE_MOVIE
+  is_tv = False
+  if 'season' in parsed_info or 'month' in parsed_info or 'episode' in parsed_info:
+    is_tv = True
+    nzbo.mtype = MTYPE_SHOW
+
+  # Set the year based on the file name
+  nzbo.year = parsed_info.get('year', None)
 
-    nzbo.mtype = MTYPE_MOVIE
-    is_tv = False
-    if 'season' in parsed_info or 'month' in parsed_info or 'episode' in parsed_info:
-      is_tv = True
-      nzbo.mtype = MTYPE_SHOW
+  # Set season
+  nzbo.season = parsed_info.get('season', None)
+  if is_tv and not parsed_info.get('season', None):
+    nzbo.season = 1
 
-    # Set the year based on the file name
-    nzbo.year = parsed_info.get('year', None)
+  # Set episode number
+  if isinstance(parsed_info.get('episode', None), list):
+    nzbo.episode = "".join(["E{:02d}".format(e) for e in parsed_info['episode']])
+  else:
+    nzbo.episode = parsed_info.get('episode', None)
+  nzbo.episodes = episodes.episode_numbers(nzbo.episode)
 
-    # Set season
-    nzbo.season = parsed_info.get('season', None)
-    if is_tv and not parsed_info.get('season', None):
-      nzbo.season = 1
+  nzbo.tmdb_id = None
+  nzbo.tmdb_original_name = None
+  nzbo.tmdb_name = None
+  nzbo.tmdb_release_date = None
+  nzbo.tmdb_year = None
+  nzbo.imdb_id = None
+  nzbo.tvdb_id = None
+  # Ingest time, which orders the indexer's newest-first feed
+  nzbo.added_at = int(time.time())
+  return nzbo
 
-    # Set episode number
-    if isinstance(parsed_info.get('episode', None), list):
-      nzbo.episode = "".join(["E{:02d}".format(e) for e in parsed_info['episode']])
-    else:
-      nzbo.episode = parsed_info.get('episode', None)
-
-    # Set TMDB values by calling the API
-    nzbo.tmdb_id = None
-    nzbo.tmdb_original_name = None
-    nzbo.tmdb_name = None
-    nzbo.tmdb_release_date = None
-    nzbo.tmdb_year = None
-    nzbo.imdb_id = None
-
-    if is_tv:
-      # It's a TV show
-      matching_shows = tmdb.search().tv(parsed_info['title'])
-      if len(matching_shows) > 0:
-        show = tmdb.tv(matching_shows[0].id).details(append_to_response="external_ids")
-        nzbo.tmdb_id = show.id
-        nzbo.tmdb_original_name = show.original_name
-        nzbo.tmdb_name = show.name
-        nzbo.tmdb_release_date = show.first_air_date.strftime('%Y-%m-%d')
-        nzbo.tmdb_year = show.first_air_date.year
-        nzbo.imdb_id = show.external_ids.imdb_id
-    else:
-      # It's a movie
-      matching_movies = tmdb.search().movies(parsed_info['title'])
-      if len(matching_movies) > 0:
-        movie = tmdb.movie(matching_movies[0].id).details(append_to_response="external_ids")
-        nzbo.tmdb_id = movie.id
-        nzbo.tmdb_original_name = movie.original_title
-        nzbo.tmdb_name = movie.title
-        nzbo.tmdb_release_date = movie.release_date.strftime('%Y-%m-%d')
-        nzbo.tmdb_year = movie.release_date.year
-        nzbo.imdb_id = movie.external_ids.imdb_id
 
-    add_nzb(nzbo)
+# Runs in the parse process pool; failures are returned rather than raised,
+# together with the time each file took
+def build_nzb_batch(files):
+  results = []
+  for file in files:
+    started = time.perf_counter()
+    try:
+      nzbo, error = build_nzb(file), None
+    except Exception as e:
+      nzbo, error = None, repr(e)
+    results.append((file, nzbo, error, time.perf_counter() - started))
+  return results
+
+
+# Times a TMDB API call and counts it as an error if it raises
+def tmdb_call(call, fn, *args, **kwargs):
+  tmdb_rate_limiter.acquire()
+  started = time.perf_counter()
+  try:
+    return fn(*args, **kwargs)
+  except Exception:
+    tmdb_errors.inc(call=call)
+    raise
+  finally:
+    tmdb_request_seconds.observe(time.perf_counter() - started, call=call)
+
+
+# Queries the TMDB API; returns the metadata tuple or None when nothing matches
+def fetch_tmdb(mtype, title):
+  if mtype == MTYPE_SHOW:
+    # It's a TV show
+    matches = tmdb_call("search_tv", tmdb.search().tv, title)
+  else:
+    # It's a movie
+    matches = tmdb_call("search_movie", tmdb.search().movies, title)
+  if len(matches) > 0:
+    return fetch_tmdb_details(mtype, matches[0].id)
+  return None
+
+
+def fetch_tmdb_details(mtype, tmdb_id):
+  if mtype == MTYPE_SHOW:
+    show = tmdb_call("tv_details", tmdb.tv(tmdb_id).details, append_to_response="external_ids")
+    return (show.id, show.original_name, show.name,
+            show.first_air_date.strftime('%Y-%m-%d'), show.first_air_date.year,
+            show.external_ids.imdb_id, show.external_ids.tvdb_id)
+  movie = tmdb_call("movie_details", tmdb.movie(tmdb_id).details, append_to_response="external_ids")
+  return (movie.id, movie.original_title, movie.title,
+          movie.release_date.strftime('%Y-%m-%d'), movie.release_date.year,
+          movie.external_ids.imdb_id, None)
+
+
+# Resolves a title from the imported dataset, going to the API only when it
+# and the cache have no answer. An offline match without details only
+# needs the details call.
+def resolve_tmdb(mtype, title, year, retry_misses=False):
+  match = offline_tmdb.match(mtype, title, year)
+  if match is not None and match[1] is not None:
+    return match[1]
+  key = (mtype, normalize_title(title), year or 0)
+  if match is not None:
+    tmdb_id = match[0]
+    loader = lambda: fetch_tmdb_details(mtype, tmdb_id)
+  else:
+    loader = lambda: fetch_tmdb(mtype, title)
+  return tmdb_cache.get_or_load(key, loader, retry_misses)
+
+
+# Set TMDB values on nzbo
+def lookup_tmdb(nzbo):
+  metadata = resolve_tmdb(nzbo.mtype, nzbo.title, nzbo.year)
+  if metadata is not None:
+    (nzbo.tmdb_id, nzbo.tmdb_original_name, nzbo.tmdb_name,
+     nzbo.tmdb_release_date, nzbo.tmdb_year, nzbo.imdb_id, nzbo.tvdb_id) = metadata
+
+
+# Set while an ingest runs; the re-enrichment worker waits for it to clear
+ingest_active = threading.Event()
+
+parse_pool = None
+parse_pool_lock = threading.Lock()
+
+
+def init_parse_worker(root_dir):
+  global nzbs_root_dir
+  nzbs_root_dir = root_dir
+
+
+def get_parse_pool():
+  """
+  The process pool nzbs are parsed in, shared by every ingest. Its workers
+  are started by a forkserver instead of being forked from the producer,
+  whose observer, writer and metrics threads may be holding locks (logging,
+  sqlite) at that moment.
+  """
+  global parse_pool
+  with parse_pool_lock:
+    if parse_pool is None:
+      parse_pool = ProcessPoolExecutor(max_workers=max(1, parse_workers),
+                                       mp_context=multiprocessing.get_context("forkserver"),
+                                       initializer=init_parse_worker, initargs=(nzbs_root_dir,))
+    return parse_pool
+
+
+# Yields the build_nzb_batch results of each chunk, in order
+def parse_chunks(chunks):
+  if len(chunks) == 1:
+    # Not worth a round trip through the pool, e.g. a few files from a watch batch
+    yield build_nzb_batch(chunks[0])
+    return
+  pool = get_parse_pool()
+  # Keep a bounded window of parse batches in flight so memory stays flat
+  in_flight = deque()
+  next_chunk = 0
+  while next_chunk < len(chunks) or in_flight:
+    while next_chunk < len(chunks) and len(in_flight) < parse_workers * 2:
+      in_flight.append(pool.submit(build_nzb_batch, chunks[next_chunk]))
+      next_chunk += 1
+    yield in_flight.popleft().result()
+
+
+def run_ingest_pipeline(files):
+  """
+  Ingests files through three stages: a process pool parses the nzbs and
+  release names (a batch of one chunk is parsed on the calling thread), a
+  bounded thread pool does the TMDB lookups, and a single writer thread
+  inserts the results in batches.
+  """
+  ingest_active.set()
+  try:
+    ingest_files_pipeline(list(files))
+  finally:
+    ingest_active.clear()
+
+
+def ingest_files_pipeline(files):
+  stats = IngestStats(len(files))
+  writer = get_writer()
+  offline_tmdb.refresh()
+  # Caps how many parsed nzbs can wait on a TMDB worker at once
+  tmdb_slots = threading.BoundedSemaphore(tmdb_concurrency * 4)
+
+  def enrich(nzbo):
+    try:
+      try:
+        lookup_tmdb(nzbo)
+      except Exception:
+        # Indexed without metadata; the re-enrichment worker retries it later
+        logger.exception("TMDB lookup failed for %s", nzbo.path)
+      stats.incr('looked_up')
+      writer.add(nzbo, stats)
+    finally:
+      tmdb_slots.release()
+      stats.report()
+
+  chunks = [files[i:i + parse_chunk_size] for i in range(0, len(files), parse_chunk_size)]
+  with ThreadPoolExecutor(max_workers=tmdb_concurrency, thread_name_prefix="tmdb") as tmdb_pool:
+    for results in parse_chunks(chunks):
+      for file, nzbo, error, elapsed in results:
+        parse_seconds.observe(elapsed)
+        stats.incr('parsed')
+        if nzbo is None:
+          logger.error("Failed to parse %s: %s", file, error)
+          stats.incr('failed')
+          continue
+        if nzb_exists(nzbo.filename, nzbo.raw_size):
+          # Still goes through the writer so a missing path gets backfilled
+          nzbo.existing = True
+          writer.add(nzbo, stats)
+          continue
+        tmdb_slots.acquire()
+        tmdb_pool.submit(enrich, nzbo)
+      stats.report()
+
+  writer.sync()
+  stats.report(force=True)
 
 
 def load_nzb_data():
   logger.info("Loading nzb data")
-  all_nzb_files = load_all_nzbs()
-  for file in all_nzb_files:
-    process_single_nzb(file)
+  with scan_seconds.time():
+    all_nzb_files = load_all_nzbs()
+  files_on_disk.set(len(all_nzb_files))
+  manifest = load_manifest()
+
+  # Only files whose stat data differs from the manifest need to be opened
+  changed_files = [path for path, stat in all_nzb_files.items() if manifest.get(path) != stat]
+  removed_files = [path for path in manifest if path not in all_nzb_files]
+  stale_files = [path for path in changed_files if path in manifest]
+  logger.info("%d files unchanged, %d new, %d changed, %d removed",
+              len(all_nzb_files) - len(changed_files), len(changed_files) - len(stale_files),
+              len(stale_files), len(removed_files))
+
+  writer = get_writer()
+  for path in removed_files + stale_files:
+    writer.remove(path)
+  # The old rows of changed files must be gone before ingest checks for
+  # them, or they would be re-added without a TMDB lookup
+  writer.sync()
+  if changed_files:
+    run_ingest_pipeline(sorted(changed_files))
+  writer.sync()
   logger.info("Done loading nzb data")
 
 
-# Function to parse metadata from nzb (replace with your XML parsing logic)
-def parse_nzb_metadata(filepath):
-  m = LordNzb.parser(filepath)
-  return {
-    'filename': m.filename,
-    'name': m.name,
-    'raw_size': m.raw_size
-  }
+def stat_nzb(path):
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+# Returns the manifest stat data of path, or None when it is not indexed
+def manifest_stat(path):
+  cursor = read_db().cursor()
+  cursor.execute(f"SELECT size, mtime_ns, inode FROM {manifest_table_name} WHERE path = ?", (path,))
+  return cursor.fetchone()
+
+
+# Returns the indexed paths below a directory
+def manifest_paths_under(rel_dir):
+  cursor = read_db().cursor()
+  # '0' sorts right after '/', so this is a range scan over "rel_dir/..."
+  cursor.execute(f"SELECT path FROM {manifest_table_name} WHERE path >= ? AND path < ?",
+                 (rel_dir + '/', rel_dir + '0'))
+  return [row[0] for row in cursor]
+
+
+class IngestCoalescer(threading.Thread):
+  """
+  Collects FS events and ingests files once they have settled. Every path
+  has at most one pending entry however many events it gets, and a file is
+  only handed to the ingest pipeline after its stat data has been unchanged
+  for quiet_period seconds, so half-written nzbs are never parsed. Files
+  whose stat data matches the manifest are skipped, so a file is never
+  ingested twice. Removals are applied on this thread as well, keeping them
+  ordered with the batches.
+  """
+
+  def __init__(self, quiet_period, poll_interval, batch_size):
+    super().__init__(name="ingest-coalescer", daemon=True)
+    self.quiet_period = quiet_period
+    self.poll_interval = poll_interval
+    self.batch_size = batch_size
+    self.lock = threading.Lock()
+    # relative path -> [last stat data, monotonic time it was last seen changing]
+    self.pending = {}
+    self.removed = set()
+    self.removed_dirs = set()
+    self.added_dirs = set()
+
+  def relpath(self, path):
+    rel = os.path.relpath(path, nzbs_root_dir)
+    return None if rel.startswith('..') else rel
+
+  def touch(self, path, is_directory):
+    rel = self.relpath(path)
+    if rel is None:
+      return
+    with self.lock:
+      if is_directory:
+        # Nzbs moved in together with their directory get no events of their own
+        self.added_dirs.add(rel)
+      elif rel.endswith('.nzb'):
+        self.removed.discard(rel)
+        if rel not in self.pending:
+          self.pending[rel] = [None, time.monotonic()]
+
+  def forget(self, path, is_directory):
+    rel = self.relpath(path)
+    if rel is None:
+      return
+    with self.lock:
+      if is_directory:
+        self.removed_dirs.add(rel)
+        self.added_dirs.discard(rel)
+        prefix = rel + '/'
+        for pending in [p for p in self.pending if p.startswith(prefix)]:
+          del self.pending[pending]
+      elif rel.endswith('.nzb'):
+        self.pending.pop(rel, None)
+        self.removed.add(rel)
+
+  def run(self):
+    while True:
+      time.sleep(self.poll_interval)
+      try:
+        self.apply_removals()
+        self.scan_added_dirs()
+        ready = self.collect_ready()
+        for i in range(0, len(ready), self.batch_size):
+          self.ingest(ready[i:i + self.batch_size])
+      except Exception:
+        logger.exception("Failed to process FS events")
+
+  def apply_removals(self):
+    with self.lock:
+      removed, self.removed = self.removed, set()
+      removed_dirs, self.removed_dirs = self.removed_dirs, set()
+    for rel_dir in removed_dirs:
+      removed.update(manifest_paths_under(rel_dir))
+    if not removed:
+      return
+    writer = get_writer()
+    for path in removed:
+      writer.remove(path)
+    writer.sync()
+    logger.info("Removed %d deleted nzbs", len(removed))
+
+  def scan_added_dirs(self):
+    with self.lock:
+      added_dirs, self.added_dirs = self.added_dirs, set()
+    for rel_dir in added_dirs:
+      for root, _, files in os.walk(os.path.join(nzbs_root_dir, rel_dir)):
+        for name in files:
+          if name.endswith('.nzb'):
+            self.touch(os.path.join(root, name), False)
+
+  # Stats every pending file and returns the ones that have settled
+  def collect_ready(self):
+    with self.lock:
+      paths = list(self.pending)
+    now = time.monotonic()
+    ready = []
+    for path in paths:
+      stat = stat_nzb(os.path.join(nzbs_root_dir, path))
+      with self.lock:
+        entry = self.pending.get(path)
+        if entry is None:
+          continue
+        if stat is None:
+          # Gone before it settled; a delete event takes care of any old row
+          del self.pending[path]
+        elif stat != entry[0]:
+          entry[0] = stat
+          entry[1] = now
+        elif now - entry[1] >= self.quiet_period:
+          del self.pending[path]
+          ready.append((path, stat))
+    return ready
+
+  def ingest(self, ready):
+    writer = get_writer()
+    files = []
+    for path, stat in ready:
+      indexed = manifest_stat(path)
+      if indexed == stat:
+        continue
+      if indexed is not None:
+        writer.remove(path)
+      files.append(path)
+    if not files:
+      return
+    # Old rows of changed files must be gone before ingest looks for them
+    writer.sync()
+    logger.info("Ingesting %d new or changed nzbs", len(files))
+    # Waits for the writer, so the manifest covers this batch before the next one
+    run_ingest_pipeline(files)
+
+
+# Groups of unresolved rows that are due for a retry: groups never retried
+# come first, then the ones covering the most nzbs
+due_enrich_query = f"""
+SELECT u.mtype, u.title, COALESCE(u.year, 0), COALESCE(r.attempts, 0) AS attempts
+FROM (
+    SELECT mtype, title, year, COUNT(*) AS row_count FROM {table_name}
+    WHERE {unresolved_condition} GROUP BY mtype, title, year
+) AS u
+LEFT JOIN {enrich_retry_table_name} AS r
+ON r.mtype = u.mtype AND r.title = u.title AND r.year = COALESCE(u.year, 0)
+WHERE u.title != '' AND (r.next_attempt_at IS NULL OR r.next_attempt_at <= ?)
+ORDER BY attempts, u.row_count DESC
+LIMIT ?
+"""
+
+
+class EnrichWorker(threading.Thread):
+  """
+  Retries the TMDB lookup of nzbs that were indexed without an IMDB id,
+  and of shows without a TVDB id. Every interval it takes up to batch_size
+  due (mtype, title, year) groups and resolves each with one lookup, at
+  most `rate` per second on top of the global TMDB rate limit. Results are applied through the writer, so
+  they are committed in its batches. A group that is still unresolved is
+  retried after a delay that doubles with every attempt, up to backoff_max.
+  The worker yields to ingest: it waits while one is running, and while
+  pause_file exists.
+  """
+
+  def __init__(self, interval, batch_size, rate, backoff, backoff_max, pause_file):
+    super().__init__(name="enrich-worker", daemon=True)
+    self.interval = interval
+    self.batch_size = batch_size
+    self.rate_limiter = RateLimiter(rate)
+    self.backoff = backoff
+    self.backoff_max = backoff_max
+    self.pause_file = pause_file
+
+  def run(self):
+    while True:
+      time.sleep(self.interval)
+      try:
+        self.run_pass()
+      except Exception:
+        logger.exception("Re-enrichment pass failed")
+
+  def wait_until_idle(self):
+    paused = False
+    while ingest_active.is_set() or os.path.exists(self.pause_file):
+      if not paused and os.path.exists(self.pause_file):
+        logger.info("Re-enrichment paused until %s is removed", self.pause_file)
+        paused = True
+      time.sleep(1)
+
+  def run_pass(self):
+    self.wait_until_idle()
+    cursor = read_db().cursor()
+    unresolved = cursor.execute(f"SELECT COUNT(*) FROM {table_name} WHERE {unresolved_condition}").fetchone()[0]
+    unresolved_nzbs.set(unresolved)
+    if not unresolved:
+      return
+    groups = cursor.execute(due_enrich_query, (int(time.time()), self.batch_size)).fetchall()
+    if not groups:
+      return
+    offline_tmdb.refresh()
+    started = time.perf_counter()
+    writer = get_writer()
+    results = Counter()
+    for mtype, title, year, attempts in groups:
+      self.wait_until_idle()
+      self.rate_limiter.acquire()
+      results[self.retry(writer, mtype, title, year, attempts)] += 1
+    writer.sync()
+    logger.info("Re-enrichment of %d unresolved nzbs: retried %d titles in %.1fs (%s)",
+                unresolved, len(groups), time.perf_counter() - started,
+                ", ".join(f"{result}={count}" for result, count in sorted(results.items())))
+
+  def retry(self, writer, mtype, title, year, attempts):
+    key = (mtype, title, year)
+    error = None
+    try:
+      metadata = resolve_tmdb(mtype, title, year or None, retry_misses=True)
+    except Exception as e:
+      logger.debug("TMDB lookup of %s %r (%s) failed: %r", mtype, title, year, e)
+      metadata, error = None, repr(e)
+    if metadata is not None:
+      writer.enrich(key, metadata)
+    if enrich_complete(mtype, metadata):
+      result = 'resolved'
+    else:
+      result = 'error' if error else 'unmatched' if metadata is None else 'incomplete'
+      delay = min(self.backoff * 2 ** attempts, self.backoff_max)
+      writer.defer_enrich(key, attempts + 1, int(time.time() + delay), error or result)
+    enrich_titles.inc(result=result)
+    return result
+
+
+def read_json_lines(path):
+  opener = gzip.open if path.endswith(".gz") else open
+  with opener(path, "rt", encoding="utf-8") as f:
+    for line in f:
+      line = line.strip()
+      if line:
+        yield json.loads(line)
+
+
+upsert_tmdb_id_query = f"""
+INSERT INTO {tmdb_titles_table_name} (mtype, tmdb_id, original_title, popularity) VALUES (?, ?, ?, ?)
+ON CONFLICT (mtype, tmdb_id) DO UPDATE SET
+  original_title = excluded.original_title, popularity = excluded.popularity
+"""
+
+upsert_tmdb_details_query = f"""
+INSERT INTO {tmdb_titles_table_name}
+(mtype, tmdb_id, title, original_title, release_date, year, imdb_id, tvdb_id, popularity, detailed)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1)
+ON CONFLICT (mtype, tmdb_id) DO UPDATE SET
+  title = excluded.title,
+  original_title = COALESCE(excluded.original_title, original_title),
+  release_date = excluded.release_date,
+  year = excluded.year,
+  imdb_id = excluded.imdb_id,
+  tvdb_id = excluded.tvdb_id,
+  popularity = COALESCE(excluded.popularity, popularity),
+  detailed = 1
+"""
+
+
+# Rows of TMDB's daily id exports (movie_ids_*.json.gz, tv_series_ids_*.json.gz)
+def tmdb_id_rows(mtype, path):
+  for record in read_json_lines(path):
+    # The API search leaves adult titles out as well
+    if record.get("adult"):
+      continue
+    yield (mtype, record["id"], record.get("original_title") or record.get("original_name"),
+           record.get("popularity"))
+
+
+# Rows of the details file: one JSON object per line with "type" ("movie"
+# or "tv"), "id", "title", "original_title", "release_date", "imdb_id" and
+# "tvdb_id". TMDB's own names for the TV fields (name, original_name,
+# first_air_date) and a nested "external_ids" are accepted too.
+def tmdb_details_rows(path):
+  for record in read_json_lines(path):
+    mtype = MTYPE_SHOW if record.get("type") in ("tv", MTYPE_SHOW) else MTYPE_MOVIE
+    external_ids = record.get("external_ids") or {}
+    release_date = record.get("release_date") or record.get("first_air_date") or None
+    yield (mtype, record["id"], record.get("title") or record.get("name"),
+           record.get("original_title") or record.get("original_name"),
+           release_date, int(release_date[:4]) if release_date else None,
+           record.get("imdb_id") or external_ids.get("imdb_id") or None,
+           record.get("tvdb_id") or external_ids.get("tvdb_id") or None,
+           record.get("popularity"))
+
+
+def import_tmdb(movie_id_files=(), tv_id_files=(), details_files=()):
+  """
+  Loads TMDB's id exports and a details file into tmdb_titles, rebuilds
+  the normalized-title table and bumps the import version so a running
+  producer reloads its index before its next ingest.
+  """
+  create_db_and_table()
+  conn = connect_db()
+  conn.create_function("normalize_title", 1, normalize_title, deterministic=True)
+  started = time.perf_counter()
+  sources = [(upsert_tmdb_id_query, path, tmdb_id_rows(MTYPE_MOVIE, path)) for path in movie_id_files]
+  sources += [(upsert_tmdb_id_query, path, tmdb_id_rows(MTYPE_SHOW, path)) for path in tv_id_files]
+  sources += [(upsert_tmdb_details_query, path, tmdb_details_rows(path)) for path in details_files]
+  for query, path, rows in sources:
+    count = 0
+    while True:
+      batch = list(itertools.islice(rows, tmdb_import_batch_size))
+      if not batch:
+        break
+      with conn:
+        conn.executemany(query, batch)
+      count += len(batch)
+    logger.info("Imported %d TMDB entries from %s", count, path)
+
+  with conn:
+    conn.execute(f"DELETE FROM {tmdb_names_table_name}")
+    conn.execute(f"""
+    INSERT OR IGNORE INTO {tmdb_names_table_name} (mtype, title, tmdb_id)
+    SELECT mtype, name, tmdb_id FROM (
+        SELECT mtype, normalize_title(title) AS name, tmdb_id FROM {tmdb_titles_table_name} WHERE title IS NOT NULL
+        UNION ALL
+        SELECT mtype, normalize_title(original_title), tmdb_id FROM {tmdb_titles_table_name}
+        WHERE original_title IS NOT NULL)
+    WHERE name != ''
+    """)
+    conn.execute(f"""
+    INSERT INTO {meta_table_name} (key, value) VALUES ('tmdb_import', 1)
+    ON CONFLICT (key) DO UPDATE SET value = value + 1
+    """)
+  titles, detailed = conn.execute(f"SELECT COUNT(*), SUM(detailed) FROM {tmdb_titles_table_name}").fetchone()
+  names = conn.execute(f"SELECT COUNT(*) FROM {tmdb_names_table_name}").fetchone()[0]
+  conn.execute("PRAGMA optimize")
+  conn.close()
+  logger.info("TMDB import done in %.1fs: %d titles (%d with details), %d names",
+              time.perf_counter() - started, titles, detailed or 0, names)
+
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser(description="Indexes nzbs into the ud-indexer DB.")
+  commands = parser.add_subparsers(dest="command")
+  import_parser = commands.add_parser(
+    "import-tmdb", help="load a local TMDB dataset so titles resolve without API calls")
+  import_parser.add_argument("--movie-ids", action="append", default=[], metavar="FILE",
+                             help="TMDB daily movie id export (movie_ids_MM_DD_YYYY.json.gz)")
+  import_parser.add_argument("--tv-ids", action="append", default=[], metavar="FILE",
+                             help="TMDB daily TV id export (tv_series_ids_MM_DD_YYYY.json.gz)")
+  import_parser.add_argument("--details", action="append", default=[], metavar="FILE",
+                             help="JSON lines with title, release date and external ids per TMDB id")
+  return parser.parse_args(argv)
 
 
 if __name__ == '__main__':
+  args = parse_args(sys.argv[1:])
+  if args.command == "import-tmdb":
+    import_tmdb(args.movie_ids, args.tv_ids, args.details)
+    sys.exit(0)
+
   create_db_and_table()
-  load_nzb_data()
+  # Created up front and shared by the initial scan and every watch batch
+  get_parse_pool()
+  coalescer = IngestCoalescer(watch_quiet_period, watch_poll_interval, watch_batch_size)
+  metrics_registry.gauge("producer_watch_pending_files", "Files waiting to settle before ingest",
+                         collect=lambda: len(coalescer.pending))
+  if metrics.serve(metrics_registry, metrics_port):
+    logger.info("Serving metrics on port %d", metrics_port)
+  # Watch before the initial scan so nothing created during it is missed;
+  # events are only acted on once the scan is done
   observer = Observer()
-  observer.schedule(NzbEventHandler(), nzbs_root_dir, recursive=True)
+  observer.schedule(NzbEventHandler(coalescer), nzbs_root_dir, recursive=True)
   observer.start()
+  load_nzb_data()
+  coalescer.start()
+  if enrich_enabled:
+    EnrichWorker(enrich_interval, enrich_batch_size, enrich_rate,
+                 enrich_backoff, enrich_backoff_max, enrich_pause_file).start()
   try:
       while True:
           time.sleep(1)
   except KeyboardInterrupt:
       observer.stop()
-  observer.join()
\ No newline at end of file
+  observer.join()
+  get_writer().sync()
\ No newline at end of file
@@ -0,0 +1,82 @@
+import os
+import sys
+import threading
+
+import pytest
+
+# The services are plain modules in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import episodes
+import producer
+
+
+def new_nzb(name, mtype, added_at, season=None, episode=None, imdb_id=None, tvdb_id=None, tmdb_id=None,
+            raw_size=1000, title=None, path=None):
+  nzbo = producer.NZB()
+  nzbo.new_from(name + ".nzb", name, mtype, raw_size, title or name, None, None, season, episode,
+                tmdb_id, None, None, None, imdb_id, path=path or name + ".nzb", tvdb_id=tvdb_id)
+  nzbo.episodes = episodes.episode_numbers(episode)
+  nzbo.added_at = added_at
+  nzbo.file_stat = (raw_size, added_at * 1000000000, 0)
+  nzbo.existing = False
+  return nzbo
+
+
+@pytest.fixture
+def make_nzb():
+  """Builds a parsed nzb as build_nzb would, without a file behind it."""
+  return new_nzb
+
+
+@pytest.fixture
+def nzb_db(tmp_path, monkeypatch):
+  """A migrated, empty producer DB, which producer.db_path points to."""
+  monkeypatch.setattr(producer, "db_path", str(tmp_path / "nzbs.db"))
+  monkeypatch.setattr(producer, "db_local", threading.local())
+  producer.create_db_and_table()
+  return producer.db_path
+
+
+@pytest.fixture
+def add_nzbs(nzb_db):
+  """Writes nzbs (see make_nzb) to nzb_db through the writer's flush."""
+  writer = producer.NzbWriter(100, 0)
+  conn = producer.connect_db()
+
+  def add(nzbos):
+    writer.flush(conn, [(writer.ADD, nzbo, None) for nzbo in nzbos])
+
+  yield add
+  conn.close()
+
+
+@pytest.fixture
+def writer(nzb_db, monkeypatch):
+  """The producer's writer thread, started afresh on nzb_db."""
+  monkeypatch.setattr(producer, "nzb_writer", None)
+  monkeypatch.setattr(producer, "write_flush_interval", 0.05)
+  return producer.get_writer()
+
+
+@pytest.fixture
+def fake_tmdb(nzb_db, monkeypatch):
+  """
+  Stands in for the TMDB API: maps titles to metadata tuples, and records
+  the (mtype, title) of every search. Unknown titles find nothing.
+  """
+  class FakeTmdb(object):
+
+    def __init__(self):
+      self.titles = {}
+      self.searches = []
+
+    def fetch(self, mtype, title):
+      self.searches.append((mtype, title))
+      return self.titles.get(title)
+
+  fake = FakeTmdb()
+  monkeypatch.setattr(producer, "fetch_tmdb", fake.fetch)
+  monkeypatch.setattr(producer, "tmdb_cache", producer.TmdbCache(100, 3600, 3600))
+  monkeypatch.setattr(producer, "offline_tmdb", producer.OfflineTmdb())
+  return fake
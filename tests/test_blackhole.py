@@ -0,0 +1,93 @@
+import os
+
+import pytest
+
+import blackhole
+
+
+def write_file(path, size):
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(path, "wb") as f:
+    f.write(b"\0" * size)
+
+
+def add_keeping_dir_mtime(path, size):
+  """Adds a file the way a FUSE mount may show it: without touching its directory's mtime."""
+  directory = os.path.dirname(path)
+  st = os.stat(directory)
+  write_file(path, size)
+  os.utime(directory, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+@pytest.fixture
+def mount(tmp_path):
+  root = tmp_path / "mount"
+  write_file(str(root / "movies" / "Movie.2019.1080p" / "Movie.2019.1080p.mkv"), 1000)
+  write_file(str(root / "shows" / "Show.S01E01.720p.mkv"), 2000)
+  return str(root)
+
+
+@pytest.fixture
+def mount_index(mount, monkeypatch):
+  monkeypatch.setattr(blackhole, "mount_index_miss_refresh_gap", 0)
+  index = blackhole.MountIndex(mount, 2)
+  index.refresh()
+  return index
+
+
+def test_refresh_trusts_dir_mtime_but_miss_relists(mount, mount_index):
+  new_file = os.path.join(mount, "shows", "Show.S01E02.720p.mkv")
+  add_keeping_dir_mtime(new_file, 2000)
+  mount_index.refresh()
+  assert mount_index.lookup("Show.S01E02.720p.mkv") == []
+  assert mount_index.refresh_on_miss()
+  assert mount_index.lookup("Show.S01E02.720p.mkv") == [(new_file, 2000)]
+
+
+def test_refresh_relists_everything_without_trusting_dir_mtime(mount, mount_index, monkeypatch):
+  monkeypatch.setattr(blackhole, "mount_index_trust_dir_mtime", False)
+  new_file = os.path.join(mount, "shows", "Show.S01E02.720p.mkv")
+  add_keeping_dir_mtime(new_file, 2000)
+  mount_index.refresh()
+  assert mount_index.lookup("Show.S01E02.720p.mkv") == [(new_file, 2000)]
+
+
+def test_miss_refresh_waits_out_the_gap(mount, mount_index, monkeypatch):
+  monkeypatch.setattr(blackhole, "mount_index_miss_refresh_gap", 3600)
+  assert mount_index.refresh_on_miss()
+  new_file = os.path.join(mount, "shows", "Show.S01E02.720p.mkv")
+  add_keeping_dir_mtime(new_file, 2000)
+  assert not mount_index.refresh_on_miss()
+  assert mount_index.lookup("Show.S01E02.720p.mkv") == []
+
+
+def test_index_persists_across_restarts(mount, tmp_path):
+  index_file = str(tmp_path / "mount-index.json")
+  index = blackhole.MountIndex(mount, 2, index_file)
+  index.refresh()
+  assert os.path.exists(index_file)
+
+  restarted = blackhole.MountIndex(mount, 2, index_file)
+  restarted.load()
+  assert restarted.by_name == index.by_name
+  assert restarted.dirs == index.dirs
+  # A warm index re-lists nothing that did not change
+  restarted.refresh()
+  assert restarted.by_name == index.by_name
+
+  other_mount = blackhole.MountIndex(str(tmp_path / "other"), 2, index_file)
+  other_mount.load()
+  assert other_mount.by_name == {}
+
+
+def test_lookup_after_a_miss(mount, mount_index, monkeypatch):
+  monkeypatch.setattr(blackhole, "mount_index", mount_index)
+  monkeypatch.setattr(blackhole, "producer_db_path", None)
+  assert blackhole.find_matching_file("Movie.2019.1080p.mkv", 1010) == os.path.join(
+    mount, "movies", "Movie.2019.1080p", "Movie.2019.1080p.mkv")
+  # Arrived after the last refresh, in a directory whose mtime stayed put
+  new_file = os.path.join(mount, "movies", "Movie.2019.1080p", "Movie.2019.1080p.srt")
+  add_keeping_dir_mtime(new_file, 500)
+  assert blackhole.find_matching_file("Movie.2019.1080p.srt", 500) == new_file
+  # Outside the 3% size tolerance
+  assert blackhole.find_matching_file("Show.S01E01.720p.mkv", 2100) is None
@@ -0,0 +1,14 @@
+import pytest
+
+import episodes
+
+
+@pytest.mark.parametrize("episode, numbers", [
+  (None, []),
+  (5, [5]),
+  ("5", [5]),
+  ("E01E02", [1, 2]),
+  ("E09E10E11", [9, 10, 11]),
+])
+def test_episode_numbers(episode, numbers):
+  assert episodes.episode_numbers(episode) == numbers
@@ -0,0 +1,53 @@
+import gzip
+import os
+
+import gzcache
+
+
+def write_source(tmp_path, name, size):
+  path = tmp_path / "nzbs" / name
+  path.parent.mkdir(parents=True, exist_ok=True)
+  # Random bytes barely compress, so each entry is about size bytes
+  path.write_bytes(os.urandom(size))
+  return str(path), os.stat(str(path))
+
+
+def age(path, seconds_ago):
+  st = os.stat(path)
+  os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns - seconds_ago * 10 ** 9))
+
+
+def test_entries_are_keyed_by_path_size_and_mtime(tmp_path):
+  cache = gzcache.GzipCache(str(tmp_path / "gz"), 1 << 20)
+  source, st = write_source(tmp_path, "a.nzb", 1000)
+  assert cache.get("a.nzb", st) is None
+  path, built = cache.get_or_build("a.nzb", source, st)
+  assert built and path.endswith(gzcache.SUFFIX)
+  with open(path, "rb") as f, open(source, "rb") as original:
+    assert gzip.decompress(f.read()) == original.read()
+  assert cache.get_or_build("a.nzb", source, st) == (path, False)
+
+  os.utime(source, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+  assert cache.get("a.nzb", os.stat(source)) is None
+  assert cache.get("b.nzb", st) is None
+
+
+def test_eviction_drops_least_recently_used_entries(tmp_path):
+  cache = gzcache.GzipCache(str(tmp_path / "gz"), 5000)
+  sources = {}
+  for seconds_ago, name in enumerate(["d.nzb", "c.nzb", "b.nzb", "a.nzb"], 1):
+    source, st = write_source(tmp_path, name, 1000)
+    sources[name] = (source, st)
+    age(cache.build(name, source, st), seconds_ago * 10)
+  # A hit refreshes the entry, making it the most recently used
+  assert cache.get("a.nzb", sources["a.nzb"][1]) is not None
+
+  source, st = write_source(tmp_path, "e.nzb", 1500)
+  cache.build("e.nzb", source, st)
+  # Past the 5000 byte limit, so entries go oldest first until 90% of it is left
+  assert cache.get("b.nzb", sources["b.nzb"][1]) is None
+  assert cache.get("c.nzb", sources["c.nzb"][1]) is None
+  assert cache.get("a.nzb", sources["a.nzb"][1]) is not None
+  assert cache.get("d.nzb", sources["d.nzb"][1]) is not None
+  assert cache.get("e.nzb", st) is not None
+  assert cache.size == cache.scan_size() <= 4500
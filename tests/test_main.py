@@ -0,0 +1,270 @@
+from xml.etree import ElementTree
+import gzip
+import os
+import sqlite3
+
+import pytest
+
+import main
+import metrics
+from producer import MTYPE_MOVIE, MTYPE_SHOW
+
+
+@pytest.fixture
+def indexer(nzb_db, monkeypatch):
+  """A test client of the indexer reading nzb_db, with the response cache off."""
+  monkeypatch.setattr(main, "db_path", nzb_db)
+  monkeypatch.setattr(main, "db_pool", main.ConnectionPool(4))
+  monkeypatch.setattr(main, "response_cache", main.ResponseCache(0, 0))
+  monkeypatch.setattr(main, "catalog", None)
+  monkeypatch.setattr(main, "catalog_loaded_at", None)
+  monkeypatch.setattr(main, "db_row_counts", (None, {}))
+  monkeypatch.setattr(main, "base_url", "http://indexer")
+  return main.app.test_client()
+
+
+@pytest.fixture
+def catalog(add_nzbs, make_nzb):
+  """
+  Shows in three seasons with single and multi-episode releases, and
+  movies, with added_at values that tie so the feed order needs the id.
+  """
+  nzbos = []
+  for show in range(6):
+    for season in (1, 2, 3):
+      for episode in range(1, 5):
+        for quality in ("720p", "1080p"):
+          nzbos.append(make_nzb(
+            f"Show.{show}.S{season:02d}E{episode:02d}.{quality}", MTYPE_SHOW,
+            added_at=1000 + (show * 7 + season * 3 + episode) % 20, season=season,
+            episode=f"E{episode:02d}E{episode + 1:02d}" if episode == 3 else episode,
+            imdb_id=f"tt10{show}" if show != 5 else None, tvdb_id=700 + show if show % 2 else None,
+            tmdb_id=500 + show))
+  for movie in range(10):
+    for quality in ("720p", "1080p", "2160p"):
+      nzbos.append(make_nzb(f"Movie.{movie}.{quality}", MTYPE_MOVIE, added_at=1000 + movie % 4,
+                            imdb_id=f"tt20{movie % 6}", tmdb_id=900 + movie % 6))
+  add_nzbs(nzbos)
+  return nzbos
+
+
+ID_SEARCHES = [
+  "t=tvsearch&imdbid=tt100",
+  "t=tvsearch&imdbid=100&season=2",
+  "t=tvsearch&imdbid=tt101&season=1&ep=3",
+  "t=tvsearch&imdbid=tt101&ep=4",
+  "t=tvsearch&tvdbid=703",
+  "t=tvsearch&tmdbid=505&season=3",
+  "t=tvsearch&imdbid=tt102&limit=5&offset=3",
+  "t=tvsearch&imdbid=tt999",
+  "t=movie&imdbid=tt201",
+  "t=movie&tmdbid=903",
+]
+
+FEEDS = [
+  "t=tvsearch",
+  "t=movie&limit=7&offset=5",
+  "t=search",
+  "t=search&cat=5000&limit=10&offset=20",
+  "t=search&limit=9&cursor=1010:40",
+  "t=tvsearch&limit=9&cursor=1003:100",
+]
+
+
+def responses(client, queries):
+  return [client.get(f"/api?{query}").data for query in queries]
+
+
+def test_snapshot_answers_like_sql(indexer, catalog):
+  from_sql = responses(indexer, ID_SEARCHES + FEEDS)
+  main.load_snapshot()
+  from_snapshot = responses(indexer, ID_SEARCHES + FEEDS)
+  for query, sql, snapshot in zip(ID_SEARCHES + FEEDS, from_sql, from_snapshot):
+    assert sql.count(b"<item>") > 0 or query.endswith("tt999"), query
+    assert snapshot == sql, query
+
+
+def test_snapshot_rebuilds_are_spaced_out(indexer, catalog, monkeypatch):
+  monkeypatch.setattr(main, "snapshot_min_rebuild_interval", 60)
+  main.load_snapshot()
+  loaded, version = main.catalog_loaded_at, main.catalog.data_version
+  assert not main.snapshot_due(version, loaded + 600)
+  assert not main.snapshot_due(version + 1, loaded + 59)
+  assert main.snapshot_due(version + 1, loaded + 60)
+
+
+@pytest.fixture
+def response_cache(indexer, monkeypatch):
+  cache = main.ResponseCache(16, 300)
+  monkeypatch.setattr(main, "response_cache", cache)
+  return cache
+
+
+def test_data_version_bump_invalidates_cached_responses(indexer, response_cache, catalog, add_nzbs, make_nzb):
+  first = indexer.get("/api?t=movie&imdbid=tt201").data
+  assert indexer.get("/api?t=movie&imdbid=201").data == first
+  assert (response_cache.hits, response_cache.misses) == (1, 1)
+
+  add_nzbs([make_nzb("Movie.1.REMUX", MTYPE_MOVIE, 2000, imdb_id="tt201")])
+  updated = indexer.get("/api?t=movie&imdbid=tt201").data
+  assert (response_cache.hits, response_cache.misses) == (1, 2)
+  assert b"Movie.1.REMUX" in updated and b"Movie.1.REMUX" not in first
+  assert updated.count(b"<item>") == first.count(b"<item>") + 1
+
+
+def test_response_cache_lookups_are_exported_as_counters(indexer, response_cache, catalog):
+  first = indexer.get("/api?t=movie&imdbid=tt201").data
+  assert indexer.get("/api?t=movie&imdbid=tt201").data == first
+  exported = indexer.get("/metrics").data.decode().splitlines()
+  for name in ("indexer_response_cache_hits_total", "indexer_response_cache_misses_total"):
+    assert f"# TYPE {name} counter" in exported
+    assert f"{name} 1" in exported
+
+
+def test_interrupted_response_is_not_cached(indexer, response_cache, catalog):
+  response = indexer.get("/api?t=tvsearch&imdbid=tt100", buffered=False)
+  assert next(iter(response.response))
+  response.close()
+  assert response_cache.stats()["size"] == 0
+
+  assert indexer.get("/api?t=tvsearch&imdbid=tt100").data.count(b"<item>") == 24
+  assert response_cache.stats()["size"] == 1
+
+
+ATOM_LINK = "{http://www.w3.org/2005/Atom}link"
+
+
+def items_and_next(body):
+  channel = ElementTree.fromstring(body).find("channel")
+  titles = [item.findtext("title") for item in channel.iter("item")]
+  link = channel.find(ATOM_LINK)
+  return titles, link.get("href")[len("http://indexer"):] if link is not None else None
+
+
+def feed_order(conn, mtypes):
+  return [name for name, in conn.execute(
+    f"SELECT name FROM nzbs WHERE mtype IN ({', '.join('?' * len(mtypes))}) ORDER BY added_at DESC, id DESC",
+    mtypes)]
+
+
+@pytest.mark.parametrize("snapshot", [False, True], ids=["sql", "snapshot"])
+@pytest.mark.parametrize("query, mtypes", [
+  ("t=tvsearch", (MTYPE_SHOW,)),
+  ("t=movie", (MTYPE_MOVIE,)),
+  ("t=search", (MTYPE_SHOW, MTYPE_MOVIE)),
+])
+def test_cursor_walk_returns_every_row_once(indexer, catalog, snapshot, query, mtypes):
+  if snapshot:
+    main.load_snapshot()
+  walked = []
+  url = f"/api?{query}&limit=7"
+  pages = 0
+  while url:
+    titles, url = items_and_next(indexer.get(url).data)
+    walked += titles
+    pages += 1
+    assert pages <= len(catalog), "the cursor does not advance"
+  with main.db_pool.connection() as conn:
+    assert walked == feed_order(conn, mtypes)
+
+
+@pytest.mark.parametrize("query", [
+  "t=tvsearch&cursor=latest",
+  "t=search&cursor=1000",
+  "t=movie&cursor=1000:x",
+  "t=movie&limit=all",
+  "t=tvsearch&offset=-x",
+])
+def test_invalid_paging_is_a_bad_request(indexer, catalog, query):
+  assert indexer.get(f"/api?{query}").status_code == 400
+
+
+@pytest.mark.parametrize("snapshot", [False, True], ids=["sql", "snapshot"])
+@pytest.mark.parametrize("ep, episodes", [
+  ("2", ["E02"]),
+  # Episode 3 is only in the E03E04 releases, named after their first episode
+  ("3", ["E03"]),
+  ("4", ["E03", "E04"]),
+  ("9", []),
+  # Daily shows send a date, which narrows nothing
+  ("10/12", ["E01", "E02", "E03", "E04"]),
+])
+def test_ep_matches_each_episode_of_multi_episode_releases(indexer, catalog, snapshot, ep, episodes):
+  if snapshot:
+    main.load_snapshot()
+  titles, _ = items_and_next(indexer.get(f"/api?t=tvsearch&imdbid=tt101&season=1&ep={ep}").data)
+  assert titles == [f"Show.1.S01{episode}.{quality}" for episode in episodes for quality in ("1080p", "720p")]
+
+
+def test_tvdbid_and_tmdbid_search(indexer, catalog):
+  titles, _ = items_and_next(indexer.get("/api?t=tvsearch&tvdbid=703&season=2&ep=1").data)
+  assert titles == ["Show.3.S02E01.1080p", "Show.3.S02E01.720p"]
+  titles, _ = items_and_next(indexer.get("/api?t=tvsearch&tmdbid=505&season=3").data)
+  assert len(titles) == 8 and all(title.startswith("Show.5.S03") for title in titles)
+  # imdbid comes first when a request carries several ids
+  titles, _ = items_and_next(indexer.get("/api?t=tvsearch&imdbid=tt100&tvdbid=703&season=1&ep=1").data)
+  assert titles == ["Show.0.S01E01.1080p", "Show.0.S01E01.720p"]
+
+
+@pytest.mark.parametrize("query", [
+  "t=tvsearch&tvdbid=abc",
+  "t=tvsearch&tmdbid=12x",
+  "t=movie&tmdbid=tt123",
+])
+def test_invalid_ids_are_a_bad_request(indexer, catalog, query):
+  assert indexer.get(f"/api?{query}").status_code == 400
+
+
+@pytest.fixture
+def downloads(indexer, catalog, tmp_path, monkeypatch):
+  """Gives Movie.1.720p an nzb file under NZBS_DIR and turns gzip downloads on."""
+  root = tmp_path / "nzbs"
+  (root / "movies").mkdir(parents=True)
+  (root / "movies" / "Movie.1.720p.nzb").write_bytes(b"<nzb>" + b"<file/>" * 1000 + b"</nzb>")
+  conn = sqlite3.connect(main.db_path)
+  with conn:
+    conn.execute("UPDATE nzbs SET path = 'movies/Movie.1.720p.nzb' WHERE name = 'Movie.1.720p'")
+  conn.close()
+  monkeypatch.setattr(main, "nzbs_root_dir", str(root))
+  monkeypatch.setattr(main, "download_offload", "")
+  monkeypatch.setattr(main, "download_gzip", True)
+  monkeypatch.setattr(main, "download_path_cache", main.PathCache(16))
+  monkeypatch.setattr(main, "gzip_cache", main.gzcache.GzipCache(str(tmp_path / "gz"), 1 << 20))
+  monkeypatch.setattr(main, "gzip_cache_lookups", metrics.Counter(
+    "indexer_gzip_cache_lookups_total", "Compressed nzb lookups by result", ("result",)))
+  return root / "movies" / "Movie.1.720p.nzb"
+
+
+def test_download_revalidates_with_etag_and_last_modified(indexer, downloads):
+  response = indexer.get("/download/Movie.1.720p.nzb")
+  assert response.status_code == 200 and response.data == downloads.read_bytes()
+  assert "Accept-Encoding" in response.vary
+  etag, last_modified = response.headers["ETag"], response.headers["Last-Modified"]
+
+  assert indexer.get("/download/Movie.1.720p.nzb", headers={"If-None-Match": etag}).status_code == 304
+  not_modified = indexer.get("/download/Movie.1.720p.nzb", headers={"If-Modified-Since": last_modified})
+  assert not_modified.status_code == 304 and not_modified.data == b""
+  assert "Accept-Encoding" in not_modified.vary
+  # The compressed copy is a different representation, so it has its own etag
+  assert indexer.get("/download/Movie.1.720p.nzb", headers={
+    "If-None-Match": etag, "Accept-Encoding": "gzip"}).status_code == 200
+
+  st = downloads.stat()
+  os.utime(str(downloads), ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+  assert indexer.get("/download/Movie.1.720p.nzb", headers={"If-None-Match": etag}).status_code == 200
+
+
+def test_gzip_download_is_built_once_then_served_from_the_cache(indexer, downloads):
+  headers = {"Accept-Encoding": "gzip"}
+  first = indexer.get("/download/Movie.1.720p.nzb", headers=headers)
+  assert first.status_code == 200 and first.content_encoding == "gzip"
+  assert "Accept-Encoding" in first.vary
+  assert gzip.decompress(first.data) == downloads.read_bytes()
+  assert first.headers["ETag"].endswith('-gz"')
+  assert main.gzip_cache_lookups.values == {("build",): 1}
+
+  second = indexer.get("/download/Movie.1.720p.nzb", headers=headers)
+  assert second.data == first.data
+  assert main.gzip_cache_lookups.values == {("build",): 1, ("hit",): 1}
+  assert indexer.get("/download/Movie.1.720p.nzb", headers={
+    "Accept-Encoding": "gzip", "If-None-Match": first.headers["ETag"]}).status_code == 304
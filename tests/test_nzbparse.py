@@ -0,0 +1,32 @@
+import os
+
+import pytest
+
+import nzbparse
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+@pytest.mark.parametrize("fixture", [
+  "Namespaced.Movie.2019.1080p.BluRay.x264-GRP.nzb",
+  "Password.Show.S01E02.720p.WEB-DL{{secret}}.nzb",
+  "Multi.File.Release.2021.2160p.WEB-DL.nzb",
+  "No.Namespace.Release.2020.720p.HDTV.nzb",
+])
+def test_streaming_parser_matches_lordnzb(fixture):
+  path = os.path.join(FIXTURES_DIR, fixture)
+  assert nzbparse.parse_nzb_metadata_streaming(path) == nzbparse.parse_nzb_metadata_lordnzb(path)
+
+
+def test_password_is_stripped_from_name():
+  metadata = nzbparse.parse_nzb_metadata_streaming(
+    os.path.join(FIXTURES_DIR, "Password.Show.S01E02.720p.WEB-DL{{secret}}.nzb"))
+  assert metadata['name'] == "Password.Show.S01E02.720p.WEB-DL"
+
+
+def test_raw_size_sums_segments_of_every_file():
+  metadata = nzbparse.parse_nzb_metadata_streaming(
+    os.path.join(FIXTURES_DIR, "Multi.File.Release.2021.2160p.WEB-DL.nzb"))
+  # 4 files of 3 segments, sized 100000 * file number + segment index
+  assert metadata['raw_size'] == sum(3 * 100000 * i + 3 for i in range(1, 5))
@@ -0,0 +1,393 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import pytest
+from watchdog.events import (
+  DirMovedEvent, FileCreatedEvent, FileDeletedEvent, FileModifiedEvent, FileMovedEvent)
+
+import producer
+
+
+def migrated_db(path):
+  conn = sqlite3.connect(str(path))
+  producer.migrate_db(conn)
+  return conn
+
+
+def test_migrations_reach_latest_version(tmp_path):
+  conn = migrated_db(tmp_path / "nzbs.db")
+  assert conn.execute("PRAGMA user_version").fetchone()[0] == len(producer.MIGRATIONS)
+
+
+def test_query_plans_use_indexes(tmp_path):
+  # Fails (and logs the offending plans) when a query in INDEXED_QUERIES
+  # scans the table or one in COVERED_QUERIES needs it
+  conn = migrated_db(tmp_path / "nzbs.db")
+  assert producer.check_query_plans(conn)
+
+
+def write_json_lines(path, records):
+  path.write_text("".join(json.dumps(record) + "\n" for record in records))
+  return str(path)
+
+
+@pytest.fixture
+def offline_tmdb(tmp_path, monkeypatch):
+  monkeypatch.setattr(producer, "db_path", str(tmp_path / "nzbs.db"))
+  monkeypatch.setattr(producer, "db_local", threading.local())
+  movie_ids = write_json_lines(tmp_path / "movie_ids.json", [
+    {"id": 603, "original_title": "The Matrix", "popularity": 60.0},
+    {"id": 841, "original_title": "Dune", "popularity": 20.0},
+    {"id": 438631, "original_title": "Dune", "popularity": 80.0},
+    {"id": 949, "original_title": "Heat", "popularity": 30.0},
+    {"id": 1, "original_title": "Skipped", "adult": True},
+  ])
+  tv_ids = write_json_lines(tmp_path / "tv_series_ids.json", [
+    {"id": 1399, "original_name": "Game of Thrones", "popularity": 90.0},
+  ])
+  details = write_json_lines(tmp_path / "details.json", [
+    {"type": "movie", "id": 603, "title": "The Matrix", "original_title": "The Matrix",
+     "release_date": "1999-03-30", "imdb_id": "tt0133093"},
+    {"type": "movie", "id": 841, "title": "Dune", "original_title": "Dune",
+     "release_date": "1984-12-14", "imdb_id": "tt0087182"},
+    {"type": "movie", "id": 438631, "title": "Dune", "original_title": "Dune",
+     "release_date": "2021-09-15", "imdb_id": "tt1160419"},
+    {"type": "tv", "id": 1399, "name": "Game of Thrones", "original_name": "Game of Thrones",
+     "first_air_date": "2011-04-17", "external_ids": {"imdb_id": "tt0944947", "tvdb_id": 121361}},
+  ])
+  producer.import_tmdb([movie_ids], [tv_ids], [details])
+  offline = producer.OfflineTmdb()
+  offline.refresh()
+  return offline
+
+
+def test_offline_tmdb_hit(offline_tmdb):
+  assert offline_tmdb.match(producer.MTYPE_MOVIE, "The.Matrix", 1999) == (
+    603, (603, "The Matrix", "The Matrix", "1999-03-30", 1999, "tt0133093", None))
+  assert offline_tmdb.match(producer.MTYPE_SHOW, "Game of Thrones", None) == (
+    1399, (1399, "Game of Thrones", "Game of Thrones", "2011-04-17", 2011, "tt0944947", 121361))
+  # Known from the id export only, so the details still come from the API
+  assert offline_tmdb.match(producer.MTYPE_MOVIE, "Heat", 1995) == (949, None)
+  assert offline_tmdb.match(producer.MTYPE_MOVIE, "Skipped", None) is None
+
+
+def test_offline_tmdb_year_disambiguation(offline_tmdb):
+  assert offline_tmdb.match(producer.MTYPE_MOVIE, "Dune", 1984)[0] == 841
+  assert offline_tmdb.match(producer.MTYPE_MOVIE, "Dune", 2021)[0] == 438631
+  # A year either side still counts as the release's year
+  assert offline_tmdb.match(producer.MTYPE_MOVIE, "Dune", 1985)[0] == 841
+  # Without a usable year the most popular one wins
+  assert offline_tmdb.match(producer.MTYPE_MOVIE, "Dune", None)[0] == 438631
+  assert offline_tmdb.match(producer.MTYPE_MOVIE, "Dune", 2000)[0] == 438631
+
+
+class RecordingWriter(object):
+  def __init__(self):
+    self.cached = []
+
+  def cache_tmdb(self, row):
+    self.cached.append(row)
+
+
+def test_offline_tmdb_miss_falls_through_to_api(offline_tmdb, monkeypatch):
+  fetched = []
+  metadata = (42, "Unknown Film", "Unknown Film", "2020-01-01", 2020, "tt0000042", None)
+
+  def fetch_tmdb(mtype, title):
+    fetched.append((mtype, title))
+    return metadata
+
+  writer = RecordingWriter()
+  monkeypatch.setattr(producer, "offline_tmdb", offline_tmdb)
+  monkeypatch.setattr(producer, "tmdb_cache", producer.TmdbCache(16, 3600, 3600))
+  monkeypatch.setattr(producer, "fetch_tmdb", fetch_tmdb)
+  monkeypatch.setattr(producer, "get_writer", lambda: writer)
+
+  assert offline_tmdb.match(producer.MTYPE_MOVIE, "Unknown Film", 2020) is None
+  assert producer.resolve_tmdb(producer.MTYPE_MOVIE, "Unknown Film", 2020) == metadata
+  assert fetched == [(producer.MTYPE_MOVIE, "Unknown Film")]
+  assert len(writer.cached) == 1
+  # An offline hit never reaches the API
+  assert producer.resolve_tmdb(producer.MTYPE_MOVIE, "The Matrix", 1999)[0] == 603
+  assert fetched == [(producer.MTYPE_MOVIE, "Unknown Film")]
+
+
+NZB_TEMPLATE = """<?xml version="1.0" encoding="utf-8"?>
+<nzb xmlns="http://www.newzbin.com/DTD/2003/nzb">
+<file poster="poster" date="0" subject="subject"><groups><group>alt.binaries.test</group></groups>
+<segments><segment bytes="{size}" number="1">segment@test</segment></segments></file>
+</nzb>
+"""
+
+
+def write_nzb(path, size=1000):
+  path.parent.mkdir(parents=True, exist_ok=True)
+  path.write_text(NZB_TEMPLATE.format(size=size))
+  return str(path)
+
+
+@pytest.fixture
+def nzbs_dir(tmp_path, monkeypatch):
+  root = tmp_path / "nzbs"
+  root.mkdir()
+  monkeypatch.setattr(producer, "nzbs_root_dir", str(root))
+  return root
+
+
+def poll(coalescer):
+  # One pass of IngestCoalescer.run
+  coalescer.apply_removals()
+  coalescer.scan_added_dirs()
+  ready = coalescer.collect_ready()
+  if ready:
+    coalescer.ingest(ready)
+
+
+def indexed(conn):
+  return {path: (mtype, season, episode, imdb_id) for path, mtype, season, episode, imdb_id in conn.execute(
+    "SELECT path, mtype, season, episode, imdb_id FROM nzbs")}
+
+
+def fts_paths(conn, word):
+  return sorted(row[0] for row in conn.execute(
+    "SELECT path FROM nzbs_fts JOIN nzbs ON nzbs.id = nzbs_fts.rowid WHERE nzbs_fts MATCH ?", (f'"{word}"*',)))
+
+
+def episodes(conn):
+  return sorted(conn.execute(
+    "SELECT path, nzb_episodes.episode FROM nzb_episodes JOIN nzbs ON nzbs.id = nzb_episodes.nzb_id"))
+
+
+def manifest(conn):
+  return {path: (size, mtime_ns) for path, size, mtime_ns in conn.execute(
+    "SELECT path, size, mtime_ns FROM manifest")}
+
+
+def test_coalescer_settles_moves_and_deletes(nzbs_dir, writer, fake_tmdb):
+  fake_tmdb.titles["Show Name"] = (1, "Show Name", "Show Name", "2020-01-01", 2020, "tt0000001", 11)
+  coalescer = producer.IngestCoalescer(0, 0, 10)
+  handler = producer.NzbEventHandler(coalescer)
+  conn = producer.connect_db()
+
+  show = write_nzb(nzbs_dir / "shows" / "Show.Name.S01E01E02.720p.WEB-DL.nzb", 2000)
+  movie = write_nzb(nzbs_dir / "movies" / "Movie.Name.2019.1080p.BluRay.nzb")
+  handler.on_created(FileCreatedEvent(show))
+  handler.on_modified(FileModifiedEvent(show))
+  handler.on_created(FileCreatedEvent(movie))
+  # The first pass only records the files' stat data; they settle on the next
+  poll(coalescer)
+  assert indexed(conn) == {}
+  poll(coalescer)
+  assert indexed(conn) == {
+    "shows/Show.Name.S01E01E02.720p.WEB-DL.nzb": ("show", 1, "E01E02", "tt0000001"),
+    "movies/Movie.Name.2019.1080p.BluRay.nzb": ("movie", None, None, None),
+  }
+  assert fts_paths(conn, "name") == ["movies/Movie.Name.2019.1080p.BluRay.nzb",
+                                     "shows/Show.Name.S01E01E02.720p.WEB-DL.nzb"]
+  assert episodes(conn) == [("shows/Show.Name.S01E01E02.720p.WEB-DL.nzb", 1),
+                            ("shows/Show.Name.S01E01E02.720p.WEB-DL.nzb", 2)]
+  assert set(manifest(conn)) == set(indexed(conn))
+  assert manifest(conn)["shows/Show.Name.S01E01E02.720p.WEB-DL.nzb"][0] == os.path.getsize(show)
+  # One search per title, however many events its files got
+  assert sorted(fake_tmdb.searches) == [("movie", "Movie Name"), ("show", "Show Name")]
+
+  # A directory moved in one go takes its nzbs along
+  os.rename(str(nzbs_dir / "shows"), str(nzbs_dir / "tv"))
+  handler.on_moved(DirMovedEvent(str(nzbs_dir / "shows"), str(nzbs_dir / "tv")))
+  poll(coalescer)
+  poll(coalescer)
+  moved = "tv/Show.Name.S01E01E02.720p.WEB-DL.nzb"
+  assert indexed(conn)[moved] == ("show", 1, "E01E02", "tt0000001")
+  assert "shows/Show.Name.S01E01E02.720p.WEB-DL.nzb" not in indexed(conn)
+  assert fts_paths(conn, "show") == [moved]
+  assert episodes(conn) == [(moved, 1), (moved, 2)]
+  assert set(manifest(conn)) == {moved, "movies/Movie.Name.2019.1080p.BluRay.nzb"}
+
+  renamed = str(nzbs_dir / "movies" / "Movie.Name.2019.2160p.BluRay.nzb")
+  os.rename(movie, renamed)
+  handler.on_moved(FileMovedEvent(movie, renamed))
+  poll(coalescer)
+  poll(coalescer)
+  assert set(indexed(conn)) == {moved, "movies/Movie.Name.2019.2160p.BluRay.nzb"}
+
+  os.remove(str(nzbs_dir / "tv" / "Show.Name.S01E01E02.720p.WEB-DL.nzb"))
+  handler.on_deleted(FileDeletedEvent(str(nzbs_dir / "tv" / "Show.Name.S01E01E02.720p.WEB-DL.nzb")))
+  poll(coalescer)
+  assert set(indexed(conn)) == {"movies/Movie.Name.2019.2160p.BluRay.nzb"}
+  assert fts_paths(conn, "show") == []
+  assert episodes(conn) == []
+  assert set(manifest(conn)) == {"movies/Movie.Name.2019.2160p.BluRay.nzb"}
+
+
+def test_large_batches_are_parsed_in_the_pool(nzbs_dir, writer, fake_tmdb, monkeypatch):
+  monkeypatch.setattr(producer, "parse_chunk_size", 2)
+  monkeypatch.setattr(producer, "parse_workers", 2)
+  monkeypatch.setattr(producer, "parse_pool", None)
+  files = [os.path.relpath(write_nzb(nzbs_dir / f"Movie.Number.{i}.2019.1080p.nzb", 1000 + i), str(nzbs_dir))
+           for i in range(5)]
+  producer.run_ingest_pipeline(files)
+  assert set(indexed(producer.connect_db())) == set(files)
+  producer.parse_pool.shutdown()
+
+
+class BatchRecordingWriter(producer.NzbWriter):
+  """Records the kinds of the changes in every batch it commits."""
+
+  def __init__(self, batch_size, flush_interval):
+    super().__init__(batch_size, flush_interval)
+    self.batches = []
+
+  def flush(self, conn, batch):
+    super().flush(conn, batch)
+    self.batches.append([op[0] for op in batch])
+
+
+def data_version(conn):
+  return conn.execute("SELECT value FROM meta WHERE key = 'data_version'").fetchone()[0]
+
+
+def test_writer_batches_up_to_batch_size(nzb_db, make_nzb):
+  writer = BatchRecordingWriter(3, 60)
+  for i in range(7):
+    writer.add(make_nzb(f"Movie.{i}", "movie", 1000 + i))
+  writer.start()
+  writer.sync()
+  add, sync = producer.NzbWriter.ADD, producer.NzbWriter.SYNC
+  # A sync ends its batch rather than waiting out the flush interval
+  assert writer.batches == [[add] * 3, [add] * 3, [add, sync]]
+  conn = producer.connect_db()
+  assert conn.execute("SELECT COUNT(*) FROM nzbs").fetchone()[0] == 7
+  # One bump per committed batch that changed rows
+  assert data_version(conn) == 3
+
+
+def test_writer_flushes_after_the_interval(nzb_db, make_nzb):
+  writer = BatchRecordingWriter(100, 0.05)
+  writer.start()
+  writer.add(make_nzb("Movie.1", "movie", 1000))
+  conn = producer.connect_db()
+  deadline = time.monotonic() + 5
+  while not conn.execute("SELECT COUNT(*) FROM nzbs").fetchone()[0]:
+    assert time.monotonic() < deadline, "batch was never flushed"
+    time.sleep(0.01)
+  assert writer.batches == [[producer.NzbWriter.ADD]]
+
+
+def test_writer_keeps_the_manifest_in_step(nzb_db, make_nzb):
+  writer = producer.NzbWriter(100, 60)
+  writer.start()
+  conn = producer.connect_db()
+  nzbo = make_nzb("Show.S01E01E02", "show", 1000, season=1, episode="E01E02", path="shows/Show.S01E01E02.nzb")
+  writer.add(nzbo)
+  writer.sync()
+  assert conn.execute("SELECT path, size, mtime_ns, inode FROM manifest").fetchall() == [
+    ("shows/Show.S01E01E02.nzb",) + nzbo.file_stat]
+  assert conn.execute("SELECT episode FROM nzb_episodes ORDER BY episode").fetchall() == [(1,), (2,)]
+
+  # A removal and re-add of the same path in one batch are applied in order
+  changed = make_nzb("Show.S01E01E02", "show", 2000, season=1, episode="E01E02", raw_size=2000,
+                     path="shows/Show.S01E01E02.nzb")
+  writer.remove("shows/Show.S01E01E02.nzb")
+  writer.add(changed)
+  writer.sync()
+  assert conn.execute("SELECT path, raw_size FROM nzbs").fetchall() == [("shows/Show.S01E01E02.nzb", 2000)]
+  assert conn.execute("SELECT size FROM manifest").fetchall() == [(2000,)]
+
+  writer.remove("shows/Show.S01E01E02.nzb")
+  writer.sync()
+  assert conn.execute("SELECT COUNT(*) FROM nzbs").fetchone()[0] == 0
+  assert conn.execute("SELECT COUNT(*) FROM manifest").fetchone()[0] == 0
+  assert conn.execute("SELECT COUNT(*) FROM nzb_episodes").fetchone()[0] == 0
+
+
+def test_writer_counts_outcomes_and_releases_sync_on_failure(nzb_db, make_nzb):
+  writer = producer.NzbWriter(100, 60)
+  writer.start()
+  conn = producer.connect_db()
+  stats = producer.IngestStats(3)
+  existing = make_nzb("Movie.1", "movie", 1000)
+  writer.add(existing, stats)
+  writer.sync()
+  existing.existing = True
+  writer.add(existing, stats)
+  writer.sync()
+  assert (stats.written, stats.skipped, stats.failed) == (1, 1, 0)
+  version = data_version(conn)
+  # Only the tmdb_cache table changes, which readers do not depend on
+  writer.cache_tmdb(("movie", "title", 0) + (None,) * 7 + (0,))
+  writer.sync()
+  assert data_version(conn) == version
+
+  # A change that cannot be applied rolls back its whole batch, and the
+  # sync behind it still returns
+  writer.add(make_nzb("Movie.2", "movie", 1000), stats)
+  writer.defer_enrich(("movie", "title"), 1, 0, "error")
+  writer.sync()
+  assert stats.failed == 1
+  assert conn.execute("SELECT COUNT(*) FROM nzbs").fetchone()[0] == 1
+
+
+@pytest.fixture
+def enrich_worker(writer, fake_tmdb, tmp_path):
+  """A worker retrying up to 10 titles a pass, with a backoff of 60s doubling up to 600s."""
+  return producer.EnrichWorker(0, 10, 1000, 60, 600, str(tmp_path / "enrich.pause"))
+
+
+def retry_state(conn):
+  return {(mtype, title): (attempts, next_attempt_at, last_error) for mtype, title, attempts, next_attempt_at, last_error
+          in conn.execute("SELECT mtype, title, attempts, next_attempt_at, last_error FROM enrich_retry")}
+
+
+def test_enrich_backoff_doubles_up_to_the_max(enrich_worker, add_nzbs, make_nzb, fake_tmdb):
+  add_nzbs([make_nzb("Unknown.Movie.1080p", producer.MTYPE_MOVIE, 1000, title="Unknown Movie")])
+  conn = producer.connect_db()
+  for attempt, delay in enumerate([60, 120, 240, 480, 600, 600], 1):
+    started = int(time.time())
+    enrich_worker.run_pass()
+    attempts, next_attempt_at, last_error = retry_state(conn)[("movie", "Unknown Movie")]
+    assert (attempts, last_error) == (attempt, "unmatched")
+    assert started + delay <= next_attempt_at <= time.time() + delay
+    # Not due again until the delay is up
+    enrich_worker.run_pass()
+    assert len(fake_tmdb.searches) == attempt
+    conn.execute("UPDATE enrich_retry SET next_attempt_at = 0")
+    conn.commit()
+
+  fake_tmdb.titles["Unknown Movie"] = (7, "Unknown Movie", "Unknown Movie", "2001-01-01", 2001, "tt0000007", None)
+  enrich_worker.run_pass()
+  assert retry_state(conn) == {}
+  assert conn.execute("SELECT imdb_id, tmdb_id FROM nzbs").fetchall() == [("tt0000007", 7)]
+
+
+def test_enrich_waits_while_the_pause_file_exists(enrich_worker, add_nzbs, make_nzb, fake_tmdb):
+  add_nzbs([make_nzb("Unknown.Movie.1080p", producer.MTYPE_MOVIE, 1000, title="Unknown Movie")])
+  with open(enrich_worker.pause_file, "w"):
+    pass
+  thread = threading.Thread(target=enrich_worker.run_pass)
+  thread.start()
+  time.sleep(0.5)
+  assert thread.is_alive() and fake_tmdb.searches == []
+  os.remove(enrich_worker.pause_file)
+  thread.join(5)
+  assert not thread.is_alive()
+  assert fake_tmdb.searches == [("movie", "Unknown Movie")]
+
+
+def test_enrich_retries_new_titles_first_then_the_biggest(enrich_worker, writer, add_nzbs, make_nzb, fake_tmdb):
+  nzbos = []
+  for title, count in [("Small", 1), ("Large", 3), ("Retried", 5), ("Backing Off", 5)]:
+    nzbos += [make_nzb(f"{title}.{i}", producer.MTYPE_MOVIE, 1000, title=title) for i in range(count)]
+  # A show with an IMDB id is still retried for its TVDB id
+  nzbos += [make_nzb(f"Show.S01E0{episode}", producer.MTYPE_SHOW, 1000, title="Show", imdb_id="tt0000009")
+            for episode in (1, 2)]
+  nzbos.append(make_nzb("Resolved", producer.MTYPE_MOVIE, 1000, title="Resolved", imdb_id="tt0000010"))
+  add_nzbs(nzbos)
+  writer.defer_enrich((producer.MTYPE_MOVIE, "Retried", 0), 1, 0, "unmatched")
+  writer.defer_enrich((producer.MTYPE_MOVIE, "Backing Off", 0), 1, int(time.time()) + 3600, "unmatched")
+  writer.sync()
+
+  enrich_worker.run_pass()
+  assert fake_tmdb.searches == [("movie", "Large"), ("show", "Show"), ("movie", "Small"), ("movie", "Retried")]